@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Zhanhong Cheng
+"""
+from .network import *
+from .run import *
+
+__all__ = ["grid_network", "radial_network", "make_network", "build_network",
+           "bench_network", "run", "save", "load", "compare",
+           "format_comparison"]
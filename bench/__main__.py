@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Zhanhong Cheng
+"""
+import sys
+from transpy.bench.run import main
+
+sys.exit(main())
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Zhanhong Cheng
+"""
+import numpy as np
+import transpy as tp
+from transpy.classes.convert import get_id_type
+
+# Net fields of the generated link tables, see `get_field_dict`.
+FIELDS = ['LENGTH', 'capacity', 'AB_times', 'BA_times']
+KINDS = ('grid', 'radial')
+
+
+def grid_network(rows, cols, spacing=0.5, one_way=0.1, turn_nodes=0.5,
+                 turn_delay=0.3, ban_left=0.05, zones=None, vc=0.5, seed=0):
+    """生成方格网状的路网.
+
+    节点 ``(r, c)`` 的 `ID` 为 ``r * cols + c + 1``, 坐标为
+    ``(c * spacing, r * spacing)``, 相邻节点间各有一条道路.
+
+    Parameters
+    ----------
+    rows, cols : int
+        节点的行数与列数, 均不小于 2.
+    spacing : float, optional
+        相邻节点间的直线距离(km). Default: 0.5.
+
+    Other Parameters
+    ----------------
+    one_way, turn_nodes, turn_delay, ban_left, zones, vc, seed
+        见 `build_network`.
+
+    Returns
+    -------
+    node_table, link_table, turn_table, matrix
+        见 `build_network`.
+    """
+    if rows < 2 or cols < 2:
+        raise ValueError('A grid needs at least 2 rows and 2 columns.')
+    r, c = np.divmod(np.arange(rows * cols), cols)
+    x = c * spacing
+    y = r * spacing
+    node = np.arange(1, rows * cols + 1).reshape((rows, cols))
+    start = np.concatenate((node[:, :-1].ravel(), node[:-1, :].ravel()))
+    end = np.concatenate((node[:, 1:].ravel(), node[1:, :].ravel()))
+    return build_network(x, y, start, end, one_way, turn_nodes, turn_delay,
+                         ban_left, zones, vc, seed)
+
+
+def radial_network(rings, spokes, spacing=0.5, one_way=0.1, turn_nodes=0.5,
+                   turn_delay=0.3, ban_left=0.05, zones=None, vc=0.5,
+                   seed=0):
+    """生成环形放射状的路网.
+
+    中心节点的 `ID` 为 1, 第 `k` 环 (从 1 开始) 第 `s` 条射线上的节点
+    `ID` 为 ``(k - 1) * spokes + s + 2``. 射线上相邻节点间及环上相邻节点
+    间各有一条道路.
+
+    Parameters
+    ----------
+    rings : int
+        环数, 不小于 1.
+    spokes : int
+        射线数, 不小于 3.
+    spacing : float, optional
+        相邻两环的间距(km). Default: 0.5.
+
+    Other Parameters
+    ----------------
+    one_way, turn_nodes, turn_delay, ban_left, zones, vc, seed
+        见 `build_network`.
+
+    Returns
+    -------
+    node_table, link_table, turn_table, matrix
+        见 `build_network`.
+    """
+    if rings < 1 or spokes < 3:
+        raise ValueError('A radial net needs at least 1 ring and 3 spokes.')
+    k, s = np.divmod(np.arange(rings * spokes), spokes)
+    angle = 2 * np.pi * s / spokes
+    x = np.concatenate(([0.], (k + 1) * spacing * np.cos(angle)))
+    y = np.concatenate(([0.], (k + 1) * spacing * np.sin(angle)))
+    node = np.arange(2, rings * spokes + 2).reshape((rings, spokes))
+    start = np.concatenate((np.ones(spokes, np.intp), node[:-1].ravel(),
+                            node.ravel()))
+    end = np.concatenate((node[0], node[1:].ravel(),
+                          np.roll(node, -1, axis=1).ravel()))
+    return build_network(x, y, start, end, one_way, turn_nodes, turn_delay,
+                         ban_left, zones, vc, seed)
+
+
+def make_network(kind, arcs, **kwargs):
+    """按弧的数目生成路网.
+
+    Parameters
+    ----------
+    kind : {'grid', 'radial'}
+        路网的形状.
+    arcs : int
+        期望的弧的数目, 生成的路网的弧数与之相近, 但不一定相等.
+    **kwargs
+        传给 `grid_network` 或 `radial_network` 的其他参数.
+
+    Returns
+    -------
+    node_table, link_table, turn_table, matrix
+        见 `build_network`.
+    """
+    # Both shapes have about 2 links, that is 4 arcs, per node.
+    nodes = max(arcs / 4, 4)
+    if kind == 'grid':
+        side = max(int(round(np.sqrt(nodes))), 2)
+        return grid_network(side, side, **kwargs)
+    elif kind == 'radial':
+        spokes = min(max(int(round(np.sqrt(nodes))), 3), 64)
+        rings = max(int(round(nodes / spokes)), 1)
+        return radial_network(rings, spokes, **kwargs)
+    raise ValueError("Wrong kind, use {}".format(' or '.join(KINDS)))
+
+
+def build_network(x, y, start, end, one_way=0.1, turn_nodes=0.5,
+                  turn_delay=0.3, ban_left=0.05, zones=None, vc=0.5, seed=0):
+    """由节点坐标与道路两端的节点生成路网的各个表.
+
+    Parameters
+    ----------
+    x, y : ndarray
+        各节点的坐标(km), 第 `i` 个节点的 `ID` 为 ``i + 1``.
+    start, end : ndarray
+        各道路起点与终点的 `ID`, 道路的 `ID` 为其序号加 1.
+    one_way : float, optional
+        单行道所占的比例. Default: 0.1.
+    turn_nodes : float, optional
+        有转向表的交叉口所占的比例, 转向超过 255 个的交叉口除外.
+        Default: 0.5.
+    turn_delay : float, optional
+        左转的延误(min), 右转的延误为其 1/3, 直行无延误, 掉头禁止.
+        Default: 0.3.
+    ban_left : float, optional
+        禁止左转的比例. Default: 0.05.
+    zones : int, optional
+        小区的数目, 小区均匀地取自各节点. Default: 节点数的平方根.
+    vc : float, optional
+        各弧的平均饱和度大致为 `vc` (按最短路估计), 据此确定交通量.
+        Default: 0.5.
+    seed : int, optional
+        随机数种子, 同样的参数与种子得到同样的路网. Default: 0.
+
+    Returns
+    -------
+    node_table : IDTable
+        包括 `ID`, `X`, `Y` 这几个域.
+    link_table : IDTable
+        包括 `ID`, `START_NODE`, `END_NODE`, `DIR`, `LENGTH`, `capacity`,
+        `AB_times`, `BA_times` 这几个域, 生成 `Net` 时使用 `FIELDS`.
+    turn_table : IDGroupTable
+        包括 `ID`, `FROM`, `TO`, `DELAY` 这几个域, 禁止的转向 `DELAY` 为
+        INF.
+    matrix : Matrix
+        小区间的 OD 矩阵.
+    """
+    rng = np.random.RandomState(seed)
+    node_num = x.shape[0]
+    link_num = start.shape[0]
+    start = np.asarray(start, np.intp)
+    end = np.asarray(end, np.intp)
+
+    # Links
+    direction = np.zeros(link_num, np.int8)
+    single = rng.random_sample(link_num) < one_way
+    direction[single] = rng.choice([-1, 1], np.count_nonzero(single))
+    length = np.hypot(x[end - 1] - x[start - 1], y[end - 1] - y[start - 1]) \
+        * rng.uniform(1, 1.3, link_num)
+    speed = rng.choice([30., 40., 60.], link_num)
+    capacity = rng.choice([800., 1200., 1800.], link_num)
+    arc_num = 2 * link_num - np.count_nonzero(single)
+
+    # Arcs, as `get_net_data` would get them
+    forward = direction >= 0
+    backward = direction <= 0
+    link = np.concatenate((np.flatnonzero(forward), np.flatnonzero(backward)))
+    a_start = np.concatenate((start[forward], end[backward]))
+    a_end = np.concatenate((end[forward], start[backward]))
+
+    # Turns between every arc into and every arc out of the chosen nodes,
+    # but the `FLAG` of a Net counts at most 255 turns of a node.
+    with_turns = rng.random_sample(node_num + 1) < turn_nodes
+    out_count = np.bincount(a_start, minlength=node_num + 1)
+    with_turns &= out_count * np.bincount(a_end, minlength=node_num + 1) \
+        <= np.iinfo(np.uint8).max
+    in_arc = np.argsort(a_end, kind='mergesort')
+    in_arc = in_arc[with_turns[a_end[in_arc]]]
+    out_arc = np.argsort(a_start, kind='mergesort')
+    out_off = np.concatenate(([0], np.cumsum(out_count)))
+    repeats = out_count[a_end[in_arc]]
+    turn_num = int(repeats.sum())
+    first = np.repeat(np.cumsum(repeats) - repeats, repeats)
+    t_in = np.repeat(in_arc, repeats)
+    t_node = a_end[t_in]
+    t_out = out_arc[out_off[t_node] + np.arange(turn_num) - first]
+
+    in_x = x[a_end[t_in] - 1] - x[a_start[t_in] - 1]
+    in_y = y[a_end[t_in] - 1] - y[a_start[t_in] - 1]
+    out_x = x[a_end[t_out] - 1] - x[a_start[t_out] - 1]
+    out_y = y[a_end[t_out] - 1] - y[a_start[t_out] - 1]
+    cross = in_x * out_y - in_y * out_x
+    dot = in_x * out_x + in_y * out_y
+    left = cross > np.abs(dot)
+    right = -cross > np.abs(dot)
+    delay = np.zeros(turn_num, np.float64)
+    delay[left] = turn_delay
+    delay[right] = turn_delay / 3
+    delay[left & (rng.random_sample(turn_num) < ban_left)] = np.inf
+    delay[link[t_in] == link[t_out]] = np.inf
+
+    # Tables
+    id_type = get_id_type(arc_num, turn_num, link_num, node_num)
+    node_data = np.zeros(node_num, dtype={'names': ['ID', 'X', 'Y'],
+                                          'formats': [id_type, 'f8', 'f8']})
+    node_data['ID'] = np.arange(1, node_num + 1)
+    node_data['X'] = x
+    node_data['Y'] = y
+
+    link_data = np.zeros(link_num, dtype={
+        'names': ['ID', 'START_NODE', 'END_NODE', 'DIR'] + FIELDS,
+        'formats': [id_type, id_type, id_type, 'i1', 'f8', 'f8', 'f8',
+                    'f8']})
+    link_data['ID'] = np.arange(1, link_num + 1)
+    link_data['START_NODE'] = start
+    link_data['END_NODE'] = end
+    link_data['DIR'] = direction
+    link_data['LENGTH'] = length
+    link_data['capacity'] = capacity
+    link_data['AB_times'] = link_data['BA_times'] = length / speed * 60
+
+    turn_data = np.zeros(turn_num, dtype={
+        'names': ['ID', 'FROM', 'TO', 'DELAY'],
+        'formats': [id_type, id_type, id_type, 'f8']})
+    turn_data['ID'] = t_node
+    turn_data['FROM'] = link[t_in] + 1
+    turn_data['TO'] = link[t_out] + 1
+    turn_data['DELAY'] = delay
+
+    # Zones and demand
+    if zones is None:
+        zones = int(round(np.sqrt(node_num)))
+    zones = min(max(zones, 2), node_num)
+    zone_id = np.unique(np.linspace(1, node_num, zones).round()).astype(
+        id_type)
+    zones = zone_id.shape[0]
+    demand = rng.random_sample((zones, zones))
+    np.fill_diagonal(demand, 0)
+    # Zones are about sqrt(nodes) / 2 arcs apart on average.
+    hops = max(np.sqrt(node_num) / 2, 1)
+    demand *= vc * capacity.mean() * arc_num / (hops * demand.sum())
+    matrix = tp.Matrix(demand, id_type)
+    matrix.row_idx = zone_id
+    matrix.col_idx = zone_id
+
+    return tp.IDTable(node_data), tp.IDTable(link_data), \
+        tp.IDGroupTable(turn_data), matrix
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Zhanhong Cheng
+"""
+import json
+import platform
+import sys
+from time import perf_counter
+import numpy as np
+import transpy as tp
+from transpy.classes import convert as cv
+from transpy.compute.assignment import AssignConfig, all_or_nothing, \
+    user_equilibrium
+from transpy.compute.core import turn_dijikstra, ShortestPathWorkspace
+from transpy.compute.shortest_way import get_sp_param
+from transpy.bench.network import FIELDS, KINDS, make_network
+
+CASES = ('get_net_data', 'update_net_flag', 'turn_dijikstra',
+         'all_or_nothing', 'user_equilibrium')
+FORMAT_VERSION = 1
+
+
+def timeit(func, repeat=3, setup=None):
+    """多次执行 `func`, 返回每次所用的时间(s).
+
+    Parameters
+    ----------
+    func : callable
+    repeat : int, optional
+        执行的次数. Default: 3.
+    setup : callable, optional
+        每次执行前调用, 其返回值作为 `func` 的参数, 不计入时间.
+
+    Returns
+    -------
+    runs : list[float]
+    result
+        最后一次执行 `func` 的返回值.
+    """
+    runs = []
+    result = None
+    for _ in range(max(repeat, 1)):
+        args = setup() if setup else ()
+        start = perf_counter()
+        result = func(*args)
+        runs.append(perf_counter() - start)
+    return runs, result
+
+
+def bench_network(kind, size, cases=CASES, repeat=3, sources=10,
+                  max_iteration=5, **kwargs):
+    """在一个生成的路网上测试各个算法的耗时.
+
+    Parameters
+    ----------
+    kind : {'grid', 'radial'}
+    size : int
+        期望的弧的数目, 见 `make_network`.
+    cases : sequence of str, optional
+        要测试的项目, 为 `CASES` 的子集. Default: `CASES`.
+    repeat : int, optional
+        每个项目执行的次数, 记录最短的时间. `user_equilibrium` 只执行一次.
+        Default: 3.
+    sources : int, optional
+        `turn_dijikstra` 搜索的起点 (小区) 数. Default: 10.
+    max_iteration : int, optional
+        `user_equilibrium` 的迭代次数, 不检查收敛. Default: 5.
+    **kwargs
+        传给 `make_network` 的其他参数.
+
+    Returns
+    -------
+    list[dict]
+        每个项目一条记录, 包括 `kind`, `size`, `arcs`, `nodes`, `turns`,
+        `zones`, `case`, `seconds` (最短时间), `runs` (各次时间) 与 `calls`
+        (每次执行中调用的次数).
+    """
+    for case in cases:
+        if case not in CASES:
+            raise ValueError("Unknown case '{}', use {}".format(
+                case, ', '.join(CASES)))
+    node_table, link_table, turn_table, matrix = make_network(kind, size,
+                                                              **kwargs)
+    id_type = matrix.id_type
+    net = tp.Net(link_table, list(FIELDS), turn_table, id_type)
+    info = {'kind': kind, 'size': size, 'arcs': len(net),
+            'nodes': len(node_table), 'turns': len(turn_table),
+            'zones': matrix.shape[0]}
+    results = []
+
+    def record(case, runs, calls=1, **extra):
+        rec = dict(info, case=case, seconds=min(runs), runs=runs,
+                   calls=calls)
+        rec.update(extra)
+        results.append(rec)
+
+    if 'get_net_data' in cases:
+        runs, _ = timeit(lambda: cv.get_net_data(link_table._data,
+                                                 list(FIELDS), id_type),
+                         repeat)
+        record('get_net_data', runs)
+
+    if 'update_net_flag' in cases:
+        # A fresh net and an unsorted turn table each time, sorting the turn
+        # table is part of the work.
+        def setup():
+            return (tp.Net(link_table, list(FIELDS), id_type=id_type),
+                    tp.IDGroupTable(turn_table._data.copy()))
+        runs, _ = timeit(cv.update_net_flag, repeat, setup)
+        record('update_net_flag', runs)
+
+    if 'turn_dijikstra' in cases:
+        flag, turn_idx, from_link, to_link, delay = get_sp_param(net, 'all')
+        data = net._data
+        time = np.ascontiguousarray(data['times'], np.float64)
+        workspace = ShortestPathWorkspace(net)
+        origins = matrix.row_idx[:sources]
+
+        def search():
+            for source in origins:
+                turn_dijikstra(net.idx, data['ID'], data['END_NODE'], time,
+                               flag, source, 0, np.inf, 0, turn_idx,
+                               from_link, to_link, delay, workspace)
+        runs, _ = timeit(search, repeat)
+        record('turn_dijikstra', runs, len(origins))
+
+    cfg = AssignConfig()
+    cfg.time_field = 'times'
+    cfg.capacity_field = 'capacity'
+    cfg.print_frequency = 0
+    if 'all_or_nothing' in cases:
+        cfg.method = 'AON'
+        runs, _ = timeit(lambda: all_or_nothing(net, matrix, link_table, cfg),
+                         repeat)
+        record('all_or_nothing', runs)
+
+    if 'user_equilibrium' in cases:
+        cfg.method = 'UE'
+        cfg.convergence = 0
+        cfg.max_iteration = max_iteration
+        runs, (_, _, summary) = timeit(
+            lambda: user_equilibrium(net, matrix, link_table, cfg), 1)
+        record('user_equilibrium', runs,
+               iterations=len(summary.relative_gap) + 1,
+               relative_gap=(float(summary.relative_gap[-1])
+                             if summary.relative_gap else None))
+
+    return results
+
+
+def run(kinds=KINDS, sizes=(1000, 10000), **kwargs):
+    """对各种形状与规模的路网执行 `bench_network`.
+
+    Parameters
+    ----------
+    kinds : sequence of str, optional
+        Default: `KINDS`.
+    sizes : sequence of int, optional
+        Default: (1000, 10000).
+    **kwargs
+        传给 `bench_network` 的其他参数.
+
+    Returns
+    -------
+    dict
+        可直接写入 JSON 的结果, 包括 `version`, `environment` 与 `results`.
+    """
+    results = []
+    for kind in kinds:
+        for size in sizes:
+            results.extend(bench_network(kind, size, **kwargs))
+    return {'version': FORMAT_VERSION, 'environment': environment(),
+            'results': results}
+
+
+def environment():
+    """记录测试环境的字典."""
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'machine': platform.machine()}
+
+
+def save(report, path):
+    """将 `run` 的结果写入 JSON 文件."""
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
+
+
+def load(path):
+    """读取 `save` 写入的 JSON 文件."""
+    with open(path) as f:
+        report = json.load(f)
+    if report.get('version') != FORMAT_VERSION:
+        raise ValueError('{} is not a benchmark result of version {}'.format(
+            path, FORMAT_VERSION))
+    return report
+
+
+def compare(report, baseline, tolerance=0.1):
+    """将一次测试结果与基准结果相比较.
+
+    Parameters
+    ----------
+    report, baseline : dict
+        `run` 或 `load` 得到的结果.
+    tolerance : float, optional
+        耗时之比超出 ``[1 / (1 + tolerance), 1 + tolerance]`` 才算有变化.
+        Default: 0.1.
+
+    Returns
+    -------
+    list[dict]
+        `report` 中的每条记录一行, 包括 `kind`, `size`, `case`, `baseline`,
+        `seconds`, `ratio` 与 `status`. `status` 为 'slower', 'faster',
+        'same' 或 'new' (基准中没有该项).
+    """
+    base = {(r['kind'], r['size'], r['case']): r['seconds']
+            for r in baseline['results']}
+    rows = []
+    for rec in report['results']:
+        old = base.get((rec['kind'], rec['size'], rec['case']))
+        if old is None:
+            ratio, status = None, 'new'
+        else:
+            ratio = rec['seconds'] / old if old > 0 else np.inf
+            if ratio > 1 + tolerance:
+                status = 'slower'
+            elif ratio * (1 + tolerance) < 1:
+                status = 'faster'
+            else:
+                status = 'same'
+        rows.append({'kind': rec['kind'], 'size': rec['size'],
+                     'case': rec['case'], 'baseline': old,
+                     'seconds': rec['seconds'], 'ratio': ratio,
+                     'status': status})
+    return rows
+
+
+def format_comparison(rows):
+    """将 `compare` 的结果排成文本表格."""
+    lines = ['{:<7}{:>9}  {:<18}{:>11}{:>11}{:>8}  {}'.format(
+        'kind', 'size', 'case', 'baseline', 'seconds', 'ratio', 'status')]
+    for row in rows:
+        old = '-' if row['baseline'] is None else \
+            '{:.4g}'.format(row['baseline'])
+        ratio = '-' if row['ratio'] is None else '{:.2f}'.format(row['ratio'])
+        lines.append('{:<7}{:>9}  {:<18}{:>11}{:>11.4g}{:>8}  {}'.format(
+            row['kind'], row['size'], row['case'], old, row['seconds'],
+            ratio, row['status']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """命令行入口, ``python -m transpy.bench -h`` 查看用法."""
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog='python -m transpy.bench',
+        description='Time transpy on generated grid and radial nets.')
+    parser.add_argument('--kinds', nargs='+', choices=KINDS, default=KINDS)
+    parser.add_argument('--sizes', nargs='+', type=int,
+                        default=[1000, 10000], help='arcs of each net')
+    parser.add_argument('--cases', nargs='+', choices=CASES, default=CASES)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--sources', type=int, default=10,
+                        help='origins searched by turn_dijikstra')
+    parser.add_argument('--iterations', type=int, default=5,
+                        help='iterations of user_equilibrium')
+    parser.add_argument('--zones', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='write the JSON result here')
+    parser.add_argument('--baseline', help='JSON result to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    report = run(args.kinds, args.sizes, cases=args.cases,
+                 repeat=args.repeat, sources=args.sources,
+                 max_iteration=args.iterations, zones=args.zones,
+                 seed=args.seed)
+    if args.output:
+        save(report, args.output)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        sys.stdout.write('\n')
+    if args.baseline:
+        rows = compare(report, load(args.baseline), args.tolerance)
+        sys.stderr.write(format_comparison(rows) + '\n')
+        if any(row['status'] == 'slower' for row in rows):
+            return 1
+    return 0
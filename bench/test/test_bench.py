@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Zhanhong Cheng
+"""
+import numpy as np
+import nose.tools as nt
+import os
+import tempfile
+import transpy as tp
+from transpy.bench import grid_network, radial_network, make_network, \
+    bench_network, run, save, load, compare
+from transpy.bench.run import CASES
+from transpy.bench.network import FIELDS
+
+
+def test_networks():
+    for tables in (grid_network(4, 5, seed=1), radial_network(3, 6, seed=1)):
+        node_table, link_table, turn_table, matrix = tables
+        links = link_table._data
+        net = tp.Net(link_table, list(FIELDS), turn_table)
+        nt.assert_equal(len(net), 2 * len(links) -
+                        np.count_nonzero(links['DIR']))
+        nt.assert_true(np.isin(matrix.row_idx, node_table['ID']).all())
+        nt.assert_equal(matrix.data.trace(), 0)
+
+        # Every turn goes from an arc into its node to an arc out of it,
+        # U-turns are banned.
+        data = net._data
+        arcs = set(zip(data['START_NODE'], data['END_NODE'], data['ID']))
+        ends = {}
+        for s, e, i in arcs:
+            ends.setdefault(i, []).append((s, e))
+        for node, fro, to, delay in turn_table._data:
+            nt.assert_true(any(e == node for _, e in ends[fro]))
+            nt.assert_true(any(s == node for s, _ in ends[to]))
+            if fro == to:
+                nt.assert_equal(delay, np.inf)
+        nt.assert_not_equal(data['FLAG'].max(), 0)
+
+    # Same seed, same net
+    a = make_network('grid', 500, seed=3)[1]._data
+    b = make_network('grid', 500, seed=3)[1]._data
+    np.testing.assert_array_equal(a, b)
+    nt.assert_raises(ValueError, make_network, 'ring', 500)
+
+
+def test_run_and_compare():
+    report = run(['grid', 'radial'], [300], repeat=1, sources=2,
+                 max_iteration=2)
+    results = report['results']
+    nt.assert_equal([r['case'] for r in results], list(CASES) * 2)
+    for r in results:
+        nt.assert_true(r['seconds'] > 0)
+    ue = [r for r in results if r['case'] == 'user_equilibrium'][0]
+    nt.assert_equal(ue['iterations'], 2)
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.json')
+    save(report, path)
+    baseline = load(path)
+    rows = compare(report, baseline)
+    nt.assert_equal({row['status'] for row in rows}, {'same'})
+
+    for r in baseline['results']:
+        r['seconds'] /= 2
+    baseline['results'].pop()
+    rows = compare(report, baseline)
+    nt.assert_equal(rows[-1]['status'], 'new')
+    nt.assert_equal({row['status'] for row in rows[:-1]}, {'slower'})
+
+    nt.assert_raises(ValueError, bench_network, 'grid', 300,
+                     cases=['dijkstra'])
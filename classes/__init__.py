@@ -8,4 +8,4 @@ from .net import *
 from .matrix import *
 
 __all__ = ["Table", "IDTable", "IDGroupTable", "add_field", "merge_two_table",
-           "Net", "Matrix","zero_matrix"]
+           "Net", "Matrix", "SparseMatrix", "zero_matrix"]
@@ -4,11 +4,39 @@
 """
 import numpy as np
 import re
-from itertools import product
+import warnings
 import transpy as tp
 
 ID_TYPE = tp.ID_TYPE
 NULL = tp.NONE
+ID_TYPES = (np.uint16, np.uint32)
+
+
+def get_id_type(*nums):
+    """确定能容纳给定编号/行号的最窄的无符号整数类型.
+
+    每种类型的最大值被保留作 `NONE`(无效值), 故 `nums` 均需小于该最大值.
+
+    Parameters
+    ----------
+    *nums : int
+        需要容纳的编号或行号, 如最大的节点 `ID`, 弧的条数等.
+
+    Returns
+    -------
+    dtype : type
+        `np.uint16` 或 `np.uint32`.
+
+    Raises
+    ------
+    OverflowError :
+        `nums` 超出了 `np.uint32` 的范围.
+    """
+    max_num = max(nums) if nums else 0
+    for dtype in ID_TYPES:
+        if max_num < np.iinfo(dtype).max:
+            return dtype
+    raise OverflowError('{} is too big for {}'.format(max_num, ID_TYPES[-1]))
 
 
 def get_field_dict(fields):
@@ -94,74 +122,139 @@ def get_net_len(dir_field):
     -------
     int : `net` 的行数.
     """
-    n = 2 * len(dir_field)
-    for i in dir_field:
-        if i != 0:
-            n -= 1
-    return n
+    return 2 * len(dir_field) - int(np.count_nonzero(dir_field))
+
+
+def csr_offsets(keys, size=None):
+    """由各元素的行号计算压缩行(CSR)表示的偏移数组.
+
+    Parameters
+    ----------
+    keys : ndarray
+        各元素所在的行号, 非负整数, 无需排序.
+    size : int, optional
+        行数, 不小于 ``keys.max() + 1``. Default: ``keys.max() + 1``.
+
+    Returns
+    -------
+    offsets : ndarray
+        长度为 ``size + 1`` 的 ``np.intp`` 数组. 元素按行号稳定排序后, 第
+        `k` 行的元素为 ``offsets[k]:offsets[k + 1]``.
+    """
+    keys = np.asarray(keys)
+    if size is None:
+        size = int(keys.max()) + 1 if keys.shape[0] else 0
+    offsets = np.zeros(size + 1, np.intp)
+    np.cumsum(np.bincount(keys, minlength=size), out=offsets[1:])
+    return offsets
+
+
+def csr_index(keys, size=None, then=()):
+    """建立压缩行(CSR)索引, 即偏移数组与排序用的置换数组.
+
+    Parameters
+    ----------
+    keys : ndarray
+        各元素所在的行号, 非负整数, 无需排序.
+    size : int, optional
+        见 `csr_offsets`.
+    then : sequence of ndarray, optional
+        同一行内的元素依次按这些数组排序, 均相等时保持原有的顺序.
+        Default: 保持原有的顺序.
+
+    Returns
+    -------
+    offsets : ndarray
+        见 `csr_offsets`.
+    perm : ndarray
+        ``keys[perm]`` 由小到大排列, 第 `k` 行的元素为
+        ``perm[offsets[k]:offsets[k + 1]]``.
+    """
+    keys = np.asarray(keys)
+    if then:
+        perm = np.lexsort(tuple(then[::-1]) + (keys,))
+    else:
+        perm = np.argsort(keys, kind='stable')
+    return csr_offsets(keys, size), perm
 
 
-# noinspection PyUnboundLocalVariable
-def get_idx(column):
+def get_idx(column, dtype=ID_TYPE, size=None):
     """计算索引数组.
 
+    编号为 `n` 的元素为 ``idx[n - 1]:idx[n]``, 比最小的编号还小的那些编号的
+    索引为 `NONE`.
+
     Parameters
     ----------
     column : ndarray
         需索引的那一列, 应事先从小到大排序过.
+    dtype : data-type, optional
+        索引数组的类型, 其最大值作为 `NONE`. Default: `ID_TYPE`.
+    size : int, optional
+        索引数组的长度, 不小于 ``column[-1] + 1``. 大于 `column` 中最大编号
+        的那些编号的索引范围为空. Default: ``column[-1] + 1``.
 
     Returns
     -------
     idx : ndarray
         索引数组.
+
+    See Also
+    --------
+    csr_offsets
     """
-    column_len = len(column)
-    idx = np.full((column[-1] + 1,), NULL, np.uint16)
-    last_id = column[0]  # todo net 里应该有个最小的ID标记，不然不知道是否无效
-    idx[last_id - 1] = 0
-    for i in range(column_len):
-        now_id = column[i]
-        if now_id != last_id:
-            idx[now_id - 1] = i
-            idx[last_id] = i
-            last_id = now_id
-    idx[now_id] = i + 1
+    if size is None:
+        size = int(column[-1]) + 1
+    idx = csr_offsets(column, size)[1:].astype(dtype)
+    idx[:max(int(column[0]) - 1, 0)] = np.iinfo(dtype).max
     return idx
 
 
-def get_trace(idx, data_part, r_data_part):
+def get_trace(idx, data_part, r_data_part, dtype=ID_TYPE):
     """计算正向与反向星型表示法中的对应关系的数组.
 
+    两者中 `START_NODE`, `ID`, `END_NODE` 都相同的行相对应, 排序后一次合并
+    得到, 与 `idx` 无关.
+
     Parameters
     ----------
     idx : ndarray
-        正向索引数组.
+        正向索引数组, 仅为兼容而保留.
     data_part : structured array
         正向的 `Net` 数据, 应包括 `ID`,`START_NODE`,`END_NODE` 三个域.
     r_data_part : structured array
         反向 `Net` 数据, 应包括 `ID`,`START_NODE`,`END_NODE` 三个域.
+    dtype : data-type, optional
+        `trace` 的类型, 应与 `idx` 一致. Default: `ID_TYPE`.
 
     Returns
     -------
     trace : ndarray
-        正向与反向星型表示法中的对应关系的数组.
+        正向与反向星型表示法中的对应关系的数组, 反向的第 `i` 行为正向的第
+        ``trace[i]`` 行. 有多行可对应时取正向中的第一行, 无对应时为 `NONE`.
     """
-    column_len = data_part.shape[0]
-    dtype = np.min_scalar_type(column_len)
-    trace = np.empty(column_len, dtype)
-    for i in range(column_len):
-        start_node = r_data_part[i]['START_NODE']
-        end_node = r_data_part[i]['END_NODE']
-        ID = r_data_part[i]['ID']
-        for j in range(idx[start_node - 1], idx[start_node]):
-            if data_part[j]['END_NODE'] == end_node and \
-                            data_part[j]['ID'] == ID:
-                trace[i] = j
-                break
+    num = data_part.shape[0]
+    keys = [np.concatenate((data_part[name], r_data_part[name]))
+            for name in ('START_NODE', 'ID', 'END_NODE')]
+    # Within equal keys the forward rows come first, in their own order.
+    side = np.repeat([0, 1], [num, r_data_part.shape[0]])
+    order = np.lexsort([side] + keys[::-1])
+    new = np.zeros(order.shape, bool)
+    new[:1] = True
+    for key in keys:
+        key = key[order]
+        new[1:] |= key[1:] != key[:-1]
+    first = order[np.flatnonzero(new)][np.cumsum(new) - 1]
+
+    reverse = order >= num
+    first = first[reverse]
+    found = first < num
+    trace = np.full(r_data_part.shape[0], np.iinfo(dtype).max, dtype)
+    trace[order[reverse][found] - num] = first[found]
     return trace
 
 
-def get_net_data(street_data, fields):
+def get_net_data(street_data, fields, id_type=None):
     """将存储道路信息的表进行转换. 得到 `Net` 所需的数据.
 
     Parameters
@@ -171,6 +264,9 @@ def get_net_data(street_data, fields):
     fields : list[str]
         A list of fields which need to be included in `Net`, apart from
         ['ID', 'START_NODE', 'END_NODE','DIR'].
+    id_type : data-type, optional
+        `Net` 中 `ID`, `START_NODE`, `END_NODE` 及各索引数组的类型.
+        Default: 根据道路数目与最大的编号由 `get_id_type` 自动确定.
 
     Returns
     -------
@@ -201,49 +297,46 @@ def get_net_data(street_data, fields):
         if street_data[value[0]].dtype != street_data[value[1]].dtype:
             raise TypeError("{0} and {1} has different dtype".
                             format(value[0], value[1]))
-    formats = [ID_TYPE, ID_TYPE, ID_TYPE] + \
+    num = get_net_len(street_data['DIR'])
+    if id_type is None:
+        id_type = get_id_type(num, street_data['ID'].max(),
+                              street_data['START_NODE'].max(),
+                              street_data['END_NODE'].max())
+    formats = [id_type, id_type, id_type] + \
               [street_data[a[0]].dtype for a in fields_dict.values()] + \
               ['u1']
 
     # 初始化net
-    num = get_net_len(street_data['DIR'])
     data = np.zeros((num,), dtype=({'names': names, 'formats': formats}))
 
-    # fill net with street_data
-    def fill(data, d_i, street_data, s_i, fields_dict):
-        data[d_i]['START_NODE'] = street_data[s_i]['START_NODE']
-        data[d_i]['END_NODE'] = street_data[s_i]['END_NODE']
-        data[d_i]['ID'] = street_data[s_i]['ID']
-        for key, value in fields_dict.items():
-            data[d_i][key] = street_data[s_i][value[0]]
-
-    def fill_reverse(data, d_i, street_data, s_i, fields_dict):
-        data[d_i]['START_NODE'] = street_data[s_i]['END_NODE']
-        data[d_i]['END_NODE'] = street_data[s_i]['START_NODE']
-        data[d_i]['ID'] = street_data[s_i]['ID']
-        for key, value in fields_dict.items():
-            data[d_i][key] = street_data[s_i][value[1]]
-
-    d_i = 0  # d_i: data's idx, s_i: street_data's idx
-    for s_i in range(len(street_data)):
-        if street_data[s_i]['DIR'] == 0:
-            fill(data, d_i, street_data, s_i, fields_dict)
-            d_i += 1
-            fill_reverse(data, d_i, street_data, s_i, fields_dict)
-        elif street_data[s_i]['DIR'] > 0:
-            fill(data, d_i, street_data, s_i, fields_dict)
-        else:
-            fill_reverse(data, d_i, street_data, s_i, fields_dict)
-        d_i += 1
+    # Rows of a two-way street are its forward arc then its reverse arc, as
+    # if the streets were expanded one by one.
+    direction = street_data['DIR']
+    forward = direction >= 0
+    backward = direction <= 0
+    row = np.cumsum(forward.astype(np.intp) + backward) - backward
+    f_row = row[forward] - 1
+    b_row = row[backward]
+    for name in builtin_fields:
+        data[name][f_row] = street_data[name][forward]
+    data['START_NODE'][b_row] = street_data['END_NODE'][backward]
+    data['END_NODE'][b_row] = street_data['START_NODE'][backward]
+    data['ID'][b_row] = street_data['ID'][backward]
+    for key, value in fields_dict.items():
+        data[key][f_row] = street_data[value[0]][forward]
+        data[key][b_row] = street_data[value[1]][backward]
 
     # Sort data, get idx, r_idx and trace
-    data = np.sort(data, order=['START_NODE', 'ID', 'END_NODE'])
-    r_data_part = np.sort(data[['START_NODE', 'END_NODE', 'ID']],
-                          order=['END_NODE', 'ID', 'START_NODE'])
-    idx = get_idx(data['START_NODE'])
-    r_idx = get_idx(r_data_part['END_NODE'])
+    data = data[np.lexsort((data['END_NODE'], data['ID'],
+                            data['START_NODE']))]
+    r_data_part = data[['START_NODE', 'END_NODE', 'ID']][
+        np.lexsort((data['START_NODE'], data['ID'], data['END_NODE']))]
+    # Both indexes cover every node, a node may only have arcs one way.
+    size = max(data['START_NODE'][-1], r_data_part['END_NODE'][-1]) + 1
+    idx = get_idx(data['START_NODE'], id_type, size)
+    r_idx = get_idx(r_data_part['END_NODE'], id_type, size)
     trace = get_trace(idx, data[['START_NODE', 'END_NODE', 'ID']],
-                      r_data_part)
+                      r_data_part, id_type)
 
     return data, idx, r_idx, trace
 
@@ -252,39 +345,82 @@ def update_net_flag(net, turn_table):
     """
     更新 `net` 中的转向延误标志列.
 
+    每条弧的 `FLAG` 为转向表中该弧所在交叉口从该弧的第一个转向起到该交叉口
+    最后一个转向的行数, 转向表中没有的弧为 0.
+
     Parameters
     ----------
     net : Net
     turning_table : IDGroupTable
         转向表
-    
+
+    Returns
+    -------
+    unmatched : ndarray
+        排序后的 `turn_table` 中无法与 `net` 对应的转向的行号, 即 `FROM`
+        不是以 `ID` 为终点的道路或 `TO` 不是以 `ID` 为起点的道路.
+
+    Raises
+    ------
+    OverflowError :
+        某交叉口的转向太多, `FLAG` 超出了 255.
+
     Notes
     -----
-    如果对于某顶点, `turn_table` 中的转向与 `net` 中的边不对应, 那么直接忽略
-    该转向, 不会抛出提示或错误.
+    如果对于某顶点, `turn_table` 中的转向与 `net` 中的边不对应, 那么忽略
+    该转向, 并以一个警告一并列出这些转向.
     """
     if not turn_table.sorted():
         turn_table.sort_and_idx()
-    from_street = 0
     turning_data = turn_table._data
-    turning_idx = turn_table.idx
     net_data = net._data
-    r_idx = net.r_idx
-    trace = net.trace
-    for i in range(len(turn_table)):
-        turning_rec = turning_data[i]
-        foo = turning_rec['FROM']
-        if from_street == foo:
-            continue
-        from_street = foo
-        node = turning_rec['ID']
-        line1 = r_idx[node - 1]  # todo 这里加个错误检查机制，万一net中没有响应的node呢
-        line2 = r_idx[node]
-        target_lines = trace[line1:line2]
-        aim_ids = net_data['ID'][target_lines]
-        target_line = target_lines[aim_ids == from_street][0]
-        flag = turning_idx[node] - i
-        net_data[target_line]['FLAG'] = flag
+    node = turning_data['ID']
+    from_link = turning_data['FROM']
+    to_link = turning_data['TO']
+
+    # The turns of an arc start where (ID, FROM) changes.
+    start = np.ones(node.shape[0], bool)
+    start[1:] = (node[1:] != node[:-1]) | (from_link[1:] != from_link[:-1])
+    start = np.flatnonzero(start)
+    flag = turn_table.idx[node[start]].astype(np.intp) - start
+
+    # Arcs into a node, by (END_NODE, ID), are in the order of trace.
+    into = net.trace
+    arc, found = _join(_pair_key(net_data['END_NODE'][into],
+                                 net_data['ID'][into]),
+                       _pair_key(node[start], from_link[start]))
+    arc = into[arc[found]]
+    flag = flag[found]
+    if flag.shape[0] and flag.max() > np.iinfo(net_data['FLAG'].dtype).max:
+        raise OverflowError('Too many turns at node {}, FLAG is {}.'.format(
+            node[start[found][flag.argmax()]], flag.max()))
+    net_data['FLAG'][arc] = flag
+
+    # Arcs out of a node, by (START_NODE, ID), are in the order of the net.
+    _, to_found = _join(_pair_key(net_data['START_NODE'], net_data['ID']),
+                        _pair_key(node, to_link))
+    from_found = np.repeat(found, np.diff(np.append(start, node.shape[0])))
+    unmatched = np.flatnonzero(~(from_found & to_found))
+    if unmatched.shape[0]:
+        warnings.warn('{} turns do not match the net and are ignored, the '
+                      'first ones (ID, FROM, TO): {}'.format(
+                          unmatched.shape[0],
+                          turning_data[['ID', 'FROM', 'TO']][unmatched[:5]]
+                          .tolist()))
+    return unmatched
+
+
+def _pair_key(a, b):
+    """将两列编号合为一列可排序的 ``np.uint64`` 键."""
+    return (a.astype(np.uint64) << np.uint64(32)) | b.astype(np.uint64)
+
+
+def _join(keys, query):
+    """在已排序的 `keys` 中查找 `query`, 返回第一个相等者的位置与是否找到."""
+    pos = np.searchsorted(keys, query)
+    found = pos < keys.shape[0]
+    found[found] = keys[pos[found]] == query[found]
+    return pos, found
 
 
 def net_to_turn_table(net, node_id=None, names=None, formats=None,
@@ -294,6 +430,9 @@ def net_to_turn_table(net, node_id=None, names=None, formats=None,
     对 `net` 中指定的 `node_ID` 生成转向表, 可设定新转向表的域, 如果同时
     提供了一个旧表 `base_table`, 新生成的转向表会拷贝旧表中对应的数据.
 
+    每个交叉口的转向为驶入该点的各条弧与驶出该点的各条弧的所有组合, 由
+    `net` 的正向与反向星型表示一次生成, 不逐个交叉口循环.
+
     Parameters
     ----------
     net : net
@@ -307,6 +446,8 @@ def net_to_turn_table(net, node_id=None, names=None, formats=None,
         `format` 为 `names` 中各个域对应的格式, 长度需和 `names` 相同.
     base_table : IDGroupTable, optional
         一个现有的转向表, 如果有的话, 可将其中相对应的数据复制到新生成的转向表中.
+        `ID`, `FROM`, `TO` 都相同的转向相对应, 复制 `DELAY` 及 `names` 中
+        `base_table` 也有的域.
     exclude : bool, optional
         是否排除形心点(产生与吸引点). 若要排除产生于吸引点, 需提供 `node_table`,
         根据 `node_table` 中的 `type` 域判断该节点是否为形心点. Default: True.
@@ -315,7 +456,7 @@ def net_to_turn_table(net, node_id=None, names=None, formats=None,
 
     Returns
     -------
-    turn_table : IDGroupTable
+    turn_table : structured array
         基于 `net` 生成的转向表, 按 ``['ID','FROM','TO']`` 升序排列过.
     """
     if exclude:
@@ -323,7 +464,7 @@ def net_to_turn_table(net, node_id=None, names=None, formats=None,
             print('No node_table, so the output turning_table may '
                   'contain centroid.')
             exclude = False
-        elif 'type' not in node_table.fields:
+        elif 'type' not in node_table.names:
             print("No 'type' fields in node_table, so the output "
                   "turning_table may contain centroid.")
             exclude = False
@@ -339,84 +480,64 @@ def net_to_turn_table(net, node_id=None, names=None, formats=None,
     if len(set(names)) != num:
         raise ValueError('names not unique')
     builtin_names = ['ID', 'FROM', 'TO', 'DELAY']
-    foo = []
-    for name in builtin_names:
-        if name in names:
-            foo.append(names.index(name))
-    for i in foo:
-        names.__delitem__(i)
-        formats.__delitem__(i)
-    copy_fields = set()
+    formats = [f for name, f in zip(names, formats)
+               if name not in builtin_names]
+    names = [name for name in names if name not in builtin_names]
+    copy_fields = []
     if base_table:
-        base_table.sort_idx()
-        copy_fields = set(names).intersection(base_table.names)
+        copy_fields = [name for name in ['DELAY'] + names
+                       if name in base_table.names]
     names = builtin_names + names
-    formats = [ID_TYPE, ID_TYPE, ID_TYPE, 'f8'] + formats
-
-    def get_node_link(data, field, node_id):
-        """
-        找到以节点为起/终点的道路信息.
-
-        Parameters
-        ----------
-        data : structured array
-            就是 `net._data`.
-        field : {'START_NODE', 'END_NODE'}
-            为 `'START_NODE'` 时统计以给定节点为起点的道路信息,
-            为 `'START_NODE'` 时统计以给定节点为终点的道路信息.
-        node_id : set
-            A set of nodes's ID which need to be counted.
-
-        Returns
-        -------
-        dict :
-            返回字典的键为 `node` 的 `ID`, 值为以 `node` 为起点/终点的所有
-            道路的 `ID` 组成的列表.
-        """
-        link_dict = {i: [] for i in node_id}
-        for line in data:
-            ID = line[field]
-            if ID in node_id:
-                link_dict[ID].append(line['ID'])
-        return link_dict
-
-    # Get the `nodes`, which is a set of target nodes.
-    nodes = set(net._data['START_NODE'])
-    nodes.intersection_update(set(net._data['END_NODE']))
+    formats = [net.id_type, net.id_type, net.id_type, 'f8'] + formats
+
+    # Arcs into node n are trace[in_off[n]:in_off[n + 1]] and arcs out of it
+    # net rows out_off[n]:out_off[n + 1], both in the order of link ID.
+    data = net._data
+    size = net.idx.shape[0]
+    out_off = csr_offsets(data['START_NODE'], size)
+    in_off = csr_offsets(data['END_NODE'], size)
+    out_num = np.diff(out_off)
+    chosen = (out_num > 0) & (np.diff(in_off) > 0)
     if node_id is not None:
-        node_id = set(node_id)
-        nodes.intersection_update(node_id)
-        if len(nodes) < node_id:
+        node_id = np.unique(np.asarray(node_id, np.intp))
+        inside = (node_id > 0) & (node_id < size)
+        inside[inside] = chosen[node_id[inside]]
+        if not inside.all():
             print('Some node_IDs not in net, have removed them.')
-    start_dict = get_node_link(net._data, 'START_NODE', nodes)
-    end_dict = get_node_link(net._data, 'END_NODE', nodes)
-
-    # Determine the number of lines of the turning_table.
-    line_num = 0
-    for node in nodes:
-        if exclude:
-            line_num = node_table.ID_map[node]
-            foo = node_table._data[line_num]['type']
-            if foo != 255:
-                line_num += len(start_dict[node]) * len(end_dict[node])
-                continue
-        line_num += len(start_dict[node]) * len(end_dict[node])
+        chosen = np.zeros(size, bool)
+        chosen[node_id[inside]] = True
+    if exclude:
+        nodes = node_table._data
+        centroid = nodes['ID'][nodes['type'] == 255]
+        chosen[centroid[centroid < size]] = False
+
+    # Every arc into a chosen node is paired with every arc out of it.
+    in_arc = net.trace[chosen[data['END_NODE'][net.trace]]]
+    node = data['END_NODE'][in_arc]
+    repeats = out_num[node]
+    line_num = int(repeats.sum())
+    first = np.cumsum(repeats) - repeats
+    out_arc = np.repeat(out_off[node] - first, repeats) + np.arange(line_num)
+    in_arc = np.repeat(in_arc, repeats)
 
     turning_table = np.zeros((line_num,), dtype={'names': names,
                                                  'formats': formats})
-    # Now begin to fill in the table.
-    i = 0
-    for node in nodes:
-        pro = product(end_dict[node], start_dict[node])
-        for mem in pro:
-            turning_table[i]['ID'] = node
-            turning_table[i]['FROM'] = mem[0]
-            turning_table[i]['TO'] = mem[1]
-            if copy_fields:
-                copy_line = base_table.get_line_num(node, mem[0], mem[1])
-                for name in copy_fields:
-                    turning_table[i][name] = base_table[copy_line][name]
-            i += 1
-
-    turning_table.sort(order=['ID', 'FROM', 'TO'])
+    turning_table['ID'] = data['END_NODE'][in_arc]
+    turning_table['FROM'] = data['ID'][in_arc]
+    turning_table['TO'] = data['ID'][out_arc]
+
+    if copy_fields and line_num:
+        # Join on (ID, FROM, TO), with (ID, FROM) ranked to fit one key.
+        base = base_table._data
+        ranks = np.unique(np.concatenate((
+            _pair_key(turning_table['ID'], turning_table['FROM']),
+            _pair_key(base['ID'], base['FROM']))), return_inverse=True)[1]
+        keys = _pair_key(ranks[line_num:], base['TO'])
+        order = np.argsort(keys, kind='stable')
+        pos, found = _join(keys[order],
+                           _pair_key(ranks[:line_num], turning_table['TO']))
+        rows = order[pos[found]]
+        for name in copy_fields:
+            turning_table[name][found] = base[name][rows]
+
     return turning_table
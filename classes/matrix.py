@@ -3,9 +3,21 @@
 @author: Zhanhong Cheng
 """
 import numpy as np
+import transpy as tp
+from transpy.classes.convert import csr_offsets
 
 
-def zero_matrix(rows, cols, dtype=np.float64):
+def _check_idx(idx, id_type):
+    """检查索引是否在[1, `id_type` 的最大值)内, 最大值留作 NONE."""
+    limit = np.iinfo(id_type).max
+    max_idx = max(idx)
+    min_idx = min(idx)
+    if max_idx >= limit or min_idx < 1:
+        raise ValueError("index's range out of [1,{})".format(limit))
+    return np.asarray(idx, dtype=id_type)
+
+
+def zero_matrix(rows, cols, dtype=np.float64, id_type=tp.ID_TYPE):
     """Generate an all-zero Matrix.
 
     Parameters
@@ -17,13 +29,15 @@ def zero_matrix(rows, cols, dtype=np.float64):
     dtype : data-type, optional
         The desired data-type for the array, e.g., `numpy.int32`.
         Default is `numpy.float64`.
+    id_type : data-type, optional
+        The data-type of `row_idx` and `col_idx`. Default is `ID_TYPE`.
 
     Returns
     -------
     Matrix : An all-zero Matrix with the given rows, cols and dtype.
     """
     data = np.zeros((rows, cols), dtype)
-    return Matrix(data)
+    return Matrix(data, id_type)
 
 
 class Matrix(object):
@@ -35,13 +49,17 @@ class Matrix(object):
 
     矩阵类由3个部分组成, `data` 为一矩阵的主体部分, `row_idx` 表示 `data` 中的
     每一行对应在 `Table` 中的 `ID`. `col_idx` 表示 `data` 中的每一列对应在
-    `Table` 中的 `ID`. 目前 `ID` 的范围限制在 [1,65535] 之间.
+    `Table` 中的 `ID`. `ID` 的范围由 `id_type` 决定, 默认为 `np.uint16`,
+    即 [1,65535], 节点编号更大时可用 `np.uint32`.
 
     Parameters
     ----------
     data : array_like
         矩阵数据的主体部分. 数据必须为 `ndarray` 或者能转换为 `ndarray` 的
         类型. 且转换后的 `ndarray` 必须是2维的, 数值类型的, 否则将会抛出错误.
+    id_type : data-type, optional
+        `row_idx` 与 `col_idx` 的类型, 应与 `Net.id_type` 相容.
+        Default: `ID_TYPE`.
 
     Attributes
     ----------
@@ -57,6 +75,8 @@ class Matrix(object):
         矩阵的形状.
     dtype : data-type
         矩阵中的数据类型.
+    id_type : data-type
+        `row_idx` 与 `col_idx` 的类型.
 
     Notes
     -----
@@ -66,9 +86,10 @@ class Matrix(object):
     进行操作.
     """
 
-    def __init__(self, data):
-        self._row_idx = np.array([], dtype=np.uint16)
-        self._col_idx = np.array([], dtype=np.uint16)
+    def __init__(self, data, id_type=tp.ID_TYPE):
+        self._id_type = id_type
+        self._row_idx = np.array([], dtype=id_type)
+        self._col_idx = np.array([], dtype=id_type)
         self._data = None
         self.data = data
 
@@ -102,9 +123,9 @@ class Matrix(object):
         self._data = data
         row_num, col_num = data.shape
         if row_num != len(self._row_idx):
-            self.row_idx = np.arange(1, row_num + 1, 1, dtype=np.uint16)
+            self.row_idx = np.arange(1, row_num + 1, 1, dtype=self._id_type)
         if col_num != len(self._col_idx):
-            self.col_idx = np.arange(1, col_num + 1, 1, dtype=np.uint16)
+            self.col_idx = np.arange(1, col_num + 1, 1, dtype=self._id_type)
 
     @property
     def row_idx(self):
@@ -130,14 +151,13 @@ class Matrix(object):
             raise ValueError("col_idx's shape is not {}".format((cols,)))
         self._col_idx = idx
 
-    @staticmethod
-    def _check_idx(idx):
-        """检查索引是否在[1,65535]内."""
-        max_idx = max(idx)
-        min_idx = min(idx)
-        if max_idx > 65535 or min_idx < 0:
-            raise ValueError("index's range out of [1,65535]")
-        return np.asarray(idx, dtype=np.uint16)
+    @property
+    def id_type(self):
+        return self._id_type
+
+    def _check_idx(self, idx):
+        """检查索引是否在[1, `id_type` 的最大值)内."""
+        return _check_idx(idx, self._id_type)
 
     @property
     def shape(self):
@@ -152,3 +172,199 @@ class Matrix(object):
 
     def __setitem__(self, key, value):
         self._data[key] = value
+
+
+class SparseMatrix(object):
+    """以 CSR(compressed sparse row) 形式保存的稀疏矩阵.
+
+    大部分元素为 0 的 OD 矩阵(如货车 OD)用稠密的 `Matrix` 保存既费内存,
+    分配时也要逐个检查每个元素. `SparseMatrix` 只保存非零元素: 第 i 行的
+    非零元素位于第 ``indices[indptr[i]:indptr[i + 1]]`` 列, 其值为
+    ``values[indptr[i]:indptr[i + 1]]``, 每行内列号递增. `row_idx` 与
+    `col_idx` 的含义与 `Matrix` 相同. 全有全无分配时只对非零元素加载流量,
+    全为 0 的行不搜索最短路.
+
+    Parameters
+    ----------
+    indptr : array_like
+        长度为行数加 1 的递增整数序列, 第一个元素为 0.
+    indices : array_like
+        每个非零元素所在的列号(从 0 开始).
+    values : array_like
+        每个非零元素的值.
+    shape : tuple
+        矩阵的形状.
+    id_type : data-type, optional
+        `row_idx` 与 `col_idx` 的类型. Default: `ID_TYPE`.
+
+    Attributes
+    ----------
+    indptr, indices : ndarray
+        类型为 ``np.intp``.
+    values : ndarray
+    row_idx, col_idx : ndarray
+        初始值分别为 1~行数 与 1~列数 的序列.
+    shape : tuple
+    nnz : int
+        非零元素的个数.
+    dtype, id_type : data-type
+
+    See Also
+    --------
+    Matrix
+    """
+
+    def __init__(self, indptr, indices, values, shape, id_type=tp.ID_TYPE):
+        indptr = np.asarray(indptr, np.intp)
+        indices = np.asarray(indices, np.intp)
+        values = np.asarray(values)
+        rows, cols = shape
+        if indptr.shape != (rows + 1,) or indptr[0] != 0 or \
+                np.any(np.diff(indptr) < 0):
+            raise ValueError("indptr should be an increasing sequence of "
+                             "length {} starting at 0.".format(rows + 1))
+        if indices.shape != (indptr[-1],) or values.shape != indices.shape:
+            raise ValueError("Length of indices and values should be "
+                             "{}.".format(indptr[-1]))
+        if indices.shape[0] and (indices.min() < 0 or indices.max() >= cols):
+            raise ValueError("indices out of [0,{}).".format(cols))
+        if not values.dtype.isbuiltin:
+            raise TypeError("{} is unacceptable, use int or float type.".
+                            format(values.dtype))
+        self._id_type = id_type
+        self._shape = (rows, cols)
+        self.indptr = indptr
+        self.indices = indices
+        self.values = values
+        self._row_idx = np.arange(1, rows + 1, 1, dtype=id_type)
+        self._col_idx = np.arange(1, cols + 1, 1, dtype=id_type)
+
+    @classmethod
+    def from_triplets(cls, O, D, flow, row_idx=None, col_idx=None,
+                      id_type=tp.ID_TYPE):
+        """由 (起点, 终点, 流量) 三元组构造稀疏矩阵.
+
+        三元组通常来自 `load_txt_table` 读取的 `O`, `D`, `flow` 表. 相同的
+        OD 对的流量相加, 流量为 0 的不保存.
+
+        Parameters
+        ----------
+        O, D : array_like
+            起点与终点的 `ID`.
+        flow : array_like
+            流量.
+        row_idx, col_idx : array_like, optional
+            矩阵的行列索引, 须包括 `O` 与 `D` 中的所有 `ID`. 默认为 `O` 与
+            `D` 中出现的 `ID` 从小到大排列.
+        id_type : data-type, optional
+            Default: `ID_TYPE`.
+
+        Returns
+        -------
+        SparseMatrix
+        """
+        O = np.asarray(O)
+        D = np.asarray(D)
+        flow = np.asarray(flow)
+        row_idx = np.unique(O) if row_idx is None else np.asarray(row_idx)
+        col_idx = np.unique(D) if col_idx is None else np.asarray(col_idx)
+        rows = _find(row_idx, O, 'O')
+        cols = _find(col_idx, D, 'D')
+
+        # Sort cells by row then column, and sum the same cells.
+        order = np.lexsort((cols, rows))
+        rows = rows[order]
+        cols = cols[order]
+        flow = flow[order]
+        first = np.ones(rows.shape[0], bool)
+        first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+        start = np.flatnonzero(first)
+        if start.shape[0] < rows.shape[0]:
+            flow = np.add.reduceat(flow, start)
+            rows = rows[start]
+            cols = cols[start]
+        nonzero = flow != 0
+        rows = rows[nonzero]
+
+        matrix = cls(csr_offsets(rows, row_idx.shape[0]), cols[nonzero],
+                     flow[nonzero], (row_idx.shape[0], col_idx.shape[0]),
+                     id_type)
+        matrix.row_idx = row_idx
+        matrix.col_idx = col_idx
+        return matrix
+
+    @classmethod
+    def from_matrix(cls, matrix):
+        """由稠密的 `Matrix` 构造稀疏矩阵, 保留其 `row_idx` 与 `col_idx`."""
+        rows, cols = np.nonzero(matrix.data)
+        sparse = cls(csr_offsets(rows, matrix.shape[0]), cols,
+                     matrix.data[rows, cols], matrix.shape, matrix.id_type)
+        sparse.row_idx = matrix.row_idx
+        sparse.col_idx = matrix.col_idx
+        return sparse
+
+    def to_matrix(self):
+        """转换为稠密的 `Matrix`."""
+        data = np.zeros(self._shape, self.values.dtype)
+        rows = np.repeat(np.arange(self._shape[0]), np.diff(self.indptr))
+        data[rows, self.indices] = self.values
+        matrix = Matrix(data, self._id_type)
+        matrix.row_idx = self._row_idx
+        matrix.col_idx = self._col_idx
+        return matrix
+
+    def row(self, i):
+        """第 `i` 行的非零元素, 返回列号与值."""
+        start, stop = self.indptr[i], self.indptr[i + 1]
+        return self.indices[start:stop], self.values[start:stop]
+
+    @property
+    def row_idx(self):
+        return self._row_idx
+
+    @row_idx.setter
+    def row_idx(self, idx):
+        idx = _check_idx(idx, self._id_type)
+        if idx.shape != (self._shape[0],):
+            raise ValueError("row_idx's shape is not {}".format(
+                (self._shape[0],)))
+        self._row_idx = idx
+
+    @property
+    def col_idx(self):
+        return self._col_idx
+
+    @col_idx.setter
+    def col_idx(self, idx):
+        idx = _check_idx(idx, self._id_type)
+        if idx.shape != (self._shape[1],):
+            raise ValueError("col_idx's shape is not {}".format(
+                (self._shape[1],)))
+        self._col_idx = idx
+
+    @property
+    def id_type(self):
+        return self._id_type
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def nnz(self):
+        return self.indices.shape[0]
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+
+def _find(idx, ids, name):
+    """`ids` 中每个 `ID` 在 `idx` 中的位置."""
+    order = np.argsort(idx, kind='mergesort')
+    pos = np.searchsorted(idx, ids, sorter=order)
+    pos[pos == idx.shape[0]] = 0
+    pos = order[pos]
+    if ids.shape[0] and np.any(idx[pos] != ids):
+        raise ValueError("Some {} are not in the index.".format(name))
+    return pos
@@ -7,9 +7,18 @@ from transpy.classes import convert as cv
 
 
 class Net(object):
-    def __init__(self, street_table, fields, turn_table=None):
+    def __init__(self, street_table, fields, turn_table=None, id_type=None):
+        if id_type is None:
+            # uint16 for small nets to keep the cache footprint, else uint32.
+            street_data = street_table._data
+            turn_num = len(turn_table) if turn_table else 0
+            id_type = cv.get_id_type(cv.get_net_len(street_data['DIR']),
+                                     turn_num, street_data['ID'].max(),
+                                     street_data['START_NODE'].max(),
+                                     street_data['END_NODE'].max())
+        self.id_type = id_type
         self._data, self.idx, self.r_idx, self.trace = \
-            cv.get_net_data(street_table._data, fields)
+            cv.get_net_data(street_table._data, fields, id_type)
         self.turn_table = None
         if turn_table:
             cv.update_net_flag(self, turn_table)
@@ -22,6 +31,11 @@ class Net(object):
         """返回表中数据各列的域名."""
         return self._data.dtype.names
 
+    @property
+    def none(self):
+        """`id_type` 的最大值, 用来表示无效的编号或行号."""
+        return np.iinfo(self.id_type).max
+
     @property
     def dtype(self):
         """表中数据各列的数据类型信息."""
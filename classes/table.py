@@ -5,7 +5,7 @@
 import numpy as np
 from heapq import heappop, heappush, heapify
 from collections import Iterable
-from transpy.classes.convert import get_idx
+from transpy.classes.convert import get_idx, get_id_type, csr_index
 from transpy.classes.tool import check_positive, check_int
 
 # noinspection PyAttributeOutsideInit
@@ -428,10 +428,16 @@ class IDGroupTable(Table):
             self.changed = True
 
     def sort_and_idx(self,order=['ID','FROM','TO']):
-        """将表排序，并更新转向表的索引."""
+        """将表排序，并更新转向表的索引.
+
+        表先按 `ID` 排序, 同一 `ID` 内再按 `order` 中的其他域排序."""
         self.pack()
-        self._data.sort(order=order)
-        self.idx = get_idx(self._data['ID'])
+        data = self._data
+        _, perm = csr_index(data['ID'], then=[data[name] for name in order
+                                              if name != 'ID'])
+        data[:] = data[perm]
+        column = data['ID']
+        self.idx = get_idx(column, get_id_type(len(column), column[-1]))
         self.update_group_map()
         self.__sorted = True
 
@@ -9,7 +9,9 @@ import transpy as tp
 import os
 from transpy.classes.convert import *
 import nose.tools as nt
+import warnings
 from transpy.compute.shortest_way import single_source_shortest_way
+from transpy.bench.network import grid_network, FIELDS
 
 point_data, line_data, link_data, turn_table, _ = load_raw_test_data()
 link_table = tp.IDTable(link_data)
@@ -35,6 +37,116 @@ def test_update_net_flag(net, turning_table):
                             np.array([4, 5, 6, 2], np.uint8))
 
 
+def test_get_id_type():
+    nt.assert_equal(get_id_type(0, 65534), np.uint16)
+    nt.assert_equal(get_id_type(400000, 10), np.uint32)
+    nt.assert_raises(OverflowError, get_id_type, 2 ** 32)
+
+
+def test_net_id_type():
+    net32 = tp.Net(link_table, fields=['ID', 'LENGTH', 'DIR'],
+                   turn_table=turn_table, id_type=np.uint32)
+    nt.assert_equal(net.id_type, np.uint16)
+    for arr in (net32.idx, net32.r_idx, net32.trace, net32['END_NODE']):
+        nt.assert_equal(arr.dtype, np.uint32)
+    valid = net.idx != net.none
+    np.testing.assert_equal(net32.idx[valid], net.idx[valid])
+    np.testing.assert_equal(net32.idx[~valid], net32.none)
+    np.testing.assert_equal(net32.trace, net.trace)
+
+
+def test_get_idx():
+    np.testing.assert_equal(get_idx(np.array([2, 2, 5, 6]), np.uint16, 9),
+                            [65535, 0, 2, 2, 2, 3, 4, 4, 4])
+
+    # Node 4 is only left and node 1 only entered, both indexes still cover
+    # them.
+    street = np.array([(1, 2, 1, 1), (2, 2, 3, 0), (3, 4, 3, 1)],
+                      dtype={'names': ['ID', 'START_NODE', 'END_NODE', 'DIR'],
+                             'formats': ['u2', 'u2', 'u2', 'i1']})
+    _, idx, r_idx, _ = get_net_data(street, [])
+    np.testing.assert_equal(idx, [65535, 0, 2, 3, 4])
+    np.testing.assert_equal(r_idx, [0, 1, 2, 4, 4])
+
+
+def test_csr_index():
+    keys = np.array([3, 1, 3, 0, 1], np.uint16)
+    np.testing.assert_equal(csr_offsets(keys), [0, 1, 3, 3, 5])
+    np.testing.assert_equal(csr_offsets(keys, 6), [0, 1, 3, 3, 5, 5, 5])
+    offsets, perm = csr_index(keys)
+    np.testing.assert_equal(perm, [3, 1, 4, 0, 2])
+    offsets, perm = csr_index(keys, then=[np.array([0, 2, 1, 0, 1])])
+    np.testing.assert_equal(perm, [3, 4, 1, 0, 2])
+
+    # Forward and reverse rows are matched on all three fields.
+    dt = {'names': ['START_NODE', 'END_NODE', 'ID'], 'formats': ['u2'] * 3}
+    data = np.array([(1, 2, 1), (1, 2, 2), (2, 1, 1)], dt)
+    r_data = np.array([(2, 1, 1), (1, 2, 1), (1, 2, 2), (3, 1, 4)], dt)
+    np.testing.assert_equal(get_trace(None, data, r_data),
+                            [2, 0, 1, 65535])
+
+
+def test_get_net_data():
+    street = np.array([(3, 1, 2, 0, 1., 2.), (1, 3, 2, -1, 3., 4.),
+                       (2, 2, 3, 1, 5., 6.)],
+                      dtype={'names': ['ID', 'START_NODE', 'END_NODE', 'DIR',
+                                       'AB_times', 'BA_times'],
+                             'formats': ['u2', 'u2', 'u2', 'i1', 'f8', 'f8']})
+    nt.assert_equal(get_net_len(street['DIR']), 4)
+    data, _, _, _ = get_net_data(street, ['AB_times', 'BA_times'])
+    nt.assert_equal(data.dtype.names,
+                    ('START_NODE', 'END_NODE', 'ID', 'times', 'FLAG'))
+    np.testing.assert_equal(data['START_NODE'], [1, 2, 2, 2])
+    np.testing.assert_equal(data['END_NODE'], [2, 3, 3, 1])
+    np.testing.assert_equal(data['ID'], [3, 1, 2, 3])
+    np.testing.assert_equal(data['times'], [1., 4., 5., 2.])
+
+
+def test_update_net_flag_bulk():
+    street = np.array([(1, 1, 2, 0), (2, 2, 3, 0)],
+                      dtype={'names': ['ID', 'START_NODE', 'END_NODE', 'DIR'],
+                             'formats': ['u2', 'u2', 'u2', 'i1']})
+    # Link 2 ends the turns of node 2 and starts those of node 3, and link 1
+    # never reaches node 3.
+    turns = np.array([(3, 2, 2, 0.), (2, 2, 2, np.inf), (3, 1, 2, 0.),
+                      (2, 1, 1, np.inf), (2, 2, 1, 1.), (2, 1, 2, 0.)],
+                     dtype={'names': ['ID', 'FROM', 'TO', 'DELAY'],
+                            'formats': ['u2', 'u2', 'u2', 'f8']})
+    small = tp.Net(tp.IDTable(street), ['DIR'])
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        unmatched = update_net_flag(small, tp.IDGroupTable(turns))
+    np.testing.assert_equal(unmatched, [4])
+    nt.assert_equal(len(caught), 1)
+    nt.assert_true('1 turns' in str(caught[0].message))
+    np.testing.assert_equal(small['FLAG'], [4, 0, 1, 2])
+
+
+def test_net_to_turn_table_bulk():
+    _, links, turns, _ = grid_network(3, 3, one_way=0, turn_nodes=1)
+    small = tp.Net(links, list(FIELDS))
+    turns = np.sort(turns._data, order=['ID', 'FROM', 'TO'])
+    full = net_to_turn_table(small, exclude=False)
+    np.testing.assert_equal(full[['ID', 'FROM', 'TO']],
+                            turns[['ID', 'FROM', 'TO']])
+
+    # The centre is a centroid, 4 links in and 4 out.
+    nodes = np.zeros(9, dtype={'names': ['ID', 'type'],
+                               'formats': ['u2', 'u1']})
+    nodes['ID'] = np.arange(1, 10)
+    nodes['type'][4] = 255
+    part = net_to_turn_table(small, node_table=tp.IDTable(nodes))
+    nt.assert_equal(part.shape[0], full.shape[0] - 16)
+    nt.assert_false((part['ID'] == 5).any())
+    part = net_to_turn_table(small, node_id=[2, 1, 42], exclude=False)
+    np.testing.assert_equal(np.unique(part['ID']), [1, 2])
+
+    copied = net_to_turn_table(small, names=['DELAY', 'volume'],
+                               formats=['f8', 'f8'], exclude=False,
+                               base_table=tp.IDGroupTable(turns[::-1].copy()))
+    np.testing.assert_equal(copied['DELAY'], turns['DELAY'])
+
+
 if __name__ == '__main__':
     # a = test_net_to_turn_table(net)
     # test_update_net_flag(net, turn_table)
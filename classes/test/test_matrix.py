@@ -8,3 +8,35 @@ import transpy as tp
 import os
 from transpy.classes.convert import *
 import nose.tools as nt
+
+
+def test_check_idx():
+    matrix = tp.zero_matrix(2, 2)
+    nt.assert_raises(ValueError, setattr, matrix, 'row_idx', [1, 70000])
+    # 0 is not an ID and the maximum is NONE.
+    nt.assert_raises(ValueError, setattr, matrix, 'row_idx', [0, 1])
+    nt.assert_raises(ValueError, setattr, matrix, 'row_idx', [1, 65535])
+    matrix.row_idx = [1, 65534]
+    matrix = tp.zero_matrix(2, 2, id_type=np.uint32)
+    matrix.row_idx = [1, 70000]
+    nt.assert_equal(matrix.row_idx.dtype, np.uint32)
+
+
+def test_sparse_matrix():
+    O = [3, 1, 3, 1, 2]
+    D = [1, 2, 1, 3, 2]
+    flow = [1., 2., 3., 0., 5.]
+    sparse = tp.SparseMatrix.from_triplets(O, D, flow)
+    np.testing.assert_array_equal(sparse.indptr, [0, 1, 2, 3])
+    np.testing.assert_array_equal(sparse.indices, [1, 1, 0])
+    np.testing.assert_array_equal(sparse.values, [2., 5., 4.])
+    np.testing.assert_array_equal(sparse.row_idx, [1, 2, 3])
+    dense = sparse.to_matrix()
+    np.testing.assert_array_equal(dense.data, [[0, 2, 0], [0, 5, 0],
+                                               [4, 0, 0]])
+    again = tp.SparseMatrix.from_matrix(dense)
+    np.testing.assert_array_equal(again.indptr, sparse.indptr)
+    np.testing.assert_array_equal(again.values, sparse.values)
+    np.testing.assert_array_equal(again.col_idx, dense.col_idx)
+    nt.assert_raises(ValueError, tp.SparseMatrix.from_triplets, O, D, flow,
+                     [1, 2])
@@ -2,14 +2,30 @@
 """
 @author: Zhanhong Cheng
 """
+import copy
+import json
+import logging
+import os
+from contextlib import contextmanager
+from time import perf_counter, process_time
 import numpy as np
 import transpy as tp
-from transpy.compute.core import c_all_or_nothing
+from transpy.compute.core import c_all_or_nothing, \
+    c_sparse_all_or_nothing, ShortestPathWorkspace
 from transpy.compute.shortest_way import get_sp_param
+from transpy.compute.parallel import ProcessAON
+from transpy.compute.vdf import VDFGroups
 
 NONE = tp.NONE
 INF = np.inf
 ID_TYPE = tp.ID_TYPE
+# Bytes of a row block read from a memory-mapped OD matrix, see
+# `AssignConfig.block_rows`.
+BLOCK_BYTES = 64 * 2 ** 20
+# Phases timed in each iteration, see `AssignSummary.wall_time`.
+PHASES = ('loading', 'vdf', 'line_search', 'convergence')
+
+logger = logging.getLogger(__name__)
 
 
 class AssignConfig:
@@ -18,7 +34,10 @@ class AssignConfig:
     Attributes
     ----------
     method : str
-        Currently 'AON' or 'UE'.
+        'AON', 'UE', 'CFW', 'BFW' or 'SUE'. `user_equilibrium` 在 'CFW' 时使
+        用共轭 Frank-Wolfe 算法, 'BFW' 时使用双共轭 Frank-Wolfe 算法
+        (Mitradjieva & Lindberg, 2013), 'SUE' 时进行随机用户均衡分配, 见
+        `stochastic_user_equilibrium`, 其余情况使用 Frank-Wolfe 算法.
     time_field : str
         The field to access time from data.
     capacity_field : str
@@ -38,8 +57,62 @@ class AssignConfig:
     global_beta : float
     convergence : float
     max_iteration : int
+    vdf : str
+        路阻函数的名称, 'bpr', 'conical', 'akcelik' 或 'tabulated' 等
+        `VDF_REGISTRY` 中注册的函数. Default: 'bpr'.
+    vdf_options : dict
+        创建 `vdf` 时的参数, 如 'tabulated' 的 `ratio` 与 `factor`.
+        Default: `None`.
     arc_type_field : str
-    arc_type_dict : dict
+    arc_type_dict : list of tuple
+        (arc_type, dict) 对, dict 中为该类弧的参数. 其中 'vdf' 与
+        'vdf_options' 指定该类弧的路阻函数及创建时的参数, 见 `VDFGroups`.
+    threads : int
+        Number of threads used to search and load origins in each
+        All-or-Nothing assignment. Results are deterministic for a fixed
+        number of threads. Default: 1.
+    processes : int
+        When bigger than 1, origins are assigned by a pool of `processes`
+        processes, with the net and matrix published once in shared memory.
+        For deployments where OpenMP is not available. Default: 1.
+    loading : {'path', 'tree'}
+        全有全无分配中加载流量的方式, 为 'path' 时从每个终点沿最短路回溯,
+        为 'tree' 时按确定顺序的逆序扫描一遍最短路树, 每个起点的代价与弧数
+        成正比, 适用于小区较多的情形. Default: 'path'.
+    line_search : {'newton', 'secant'}
+        `user_equilibrium` 中求步长的方法, 为 'newton' 时使用带区间保护的
+        牛顿法, 为 'secant' 时使用 `double_secant10`. Default: 'newton'.
+    line_search_tolerance : float
+        求步长的允许误差, 目标函数沿搜索方向的导数的绝对值不超过其在步长
+        为 0 处的 `line_search_tolerance` 倍时停止. Default: 1e-4.
+    toll_field : str
+        多车种分配中的收费所在的域, 车种的广义费用为路阻加上收费除以该车种
+        的时间价值, 见 `AssignClass`. Default: `None`.
+    block_rows : int
+        全有全无分配时每次从 OD 矩阵读入的行数. 为 0 时, 若矩阵的数据是
+        `np.memmap` 或不是 float64 类型, 每次读入约 `BLOCK_BYTES` 字节,
+        否则一次读入整个矩阵. Default: 0.
+    sue_theta : float
+        随机用户均衡中 Logit 模型的离散参数, 单位为路阻单位的倒数, 越大越
+        接近用户均衡. Default: 1.0.
+    select_links : array_like, optional
+        选择路段分析的路段 ID, `user_equilibrium` 记录使用每条所选路段(任
+        一方向)的 OD 流量, 见 `AssignSummary.select_link`. Default: `None`.
+    select_zones : array_like, optional
+        选择小区分析的起点小区 ID, `user_equilibrium` 记录从每个所选小区
+        出发的路段流量, 见 `AssignSummary.select_zone`. 这两项中的 ID 不能
+        重复, 也不能用于 'SUE'. Default: `None`.
+    trace_file : str, optional
+        给出时, 分配结束后把各阶段的计时写为 Chrome trace-event 格式的
+        JSON 文件, 可在 chrome://tracing 或 Perfetto 中查看, 见
+        `AssignSummary.write_trace`. Default: `None`.
+    print_frequency : int
+        每隔多少次迭代以 INFO 级别向 ``logging.getLogger(
+        'transpy.compute.assignment')`` 记录一次迭代情况, 为 0 时不记录,
+        见 `log_iteration`. Default: 1.
+    hooks : list of callable, optional
+        `user_equilibrium` 每次迭代后依次调用的函数, 参数为
+        `IterationInfo`, 返回真值时提前结束分配. Default: `None`.
     """
 
     def __init__(self):
@@ -55,9 +128,23 @@ class AssignConfig:
         self.global_beta = 4
         self.convergence = 0.001
         self.max_iteration = 20
+        self.vdf = 'bpr'
+        self.vdf_options = None
         self.arc_type_field = None
         self.arc_type_dict = None
         self.print_frequency = 1
+        self.threads = 1
+        self.processes = 1
+        self.loading = 'path'
+        self.line_search = 'newton'
+        self.line_search_tolerance = 1e-4
+        self.toll_field = None
+        self.block_rows = 0
+        self.sue_theta = 1.0
+        self.select_links = None
+        self.select_zones = None
+        self.trace_file = None
+        self.hooks = None
 
 
 class AssignSummary:
@@ -73,15 +160,183 @@ class AssignSummary:
         A list to record `relative-gap` in every iteration.
     equilibrium_reached : bool
         When assignment reached convergence, it's `True`, else `False`.
+    path_store_nbytes : int
+        Bytes taken by the stored paths, 0 if paths are not stored.
+    routes : Routes or None
+        `path_equilibrium` 得到的有流量的路径, 其他分配方法为 `None`.
+    settled_nodes : ndarray or None
+        Number of nodes settled by the shortest path search of each origin
+        in the last All-or-Nothing assignment, `None` if not recorded.
+    select_link : dict or None
+        路段 ID 到 `SparseMatrix` 的字典, 其中为使用该路段的 OD 流量, 与
+        路段流量一样按迭代步长平均. 多车种分配时为车种名称到这样的字典的
+        字典. 未设置 `cfg.select_links` 时为 `None`.
+    select_zone : IDTable or None
+        从所选小区出发的路段流量, 每个小区有 ``AB_FLOW_<zone>``,
+        ``BA_FLOW_<zone>`` 两个域, 多车种分配时为标准车当量. 未设置
+        `cfg.select_zones` 时为 `None`.
+    warm_start : WarmStart or None
+        可作为下一次分配初始解的结果.
+    iterations_saved : int or None
+        从 `WarmStart` 开始的分配比得到它的冷启动分配少用的迭代次数,
+        冷启动或不知道冷启动的迭代次数时为 `None`.
+    wall_time, cpu_time : dict
+        `PHASES` 中各阶段到每次迭代所用墙钟时间与 CPU 时间(秒)的列表的字
+        典. 'loading' 为最短路搜索与加载, 'vdf' 为更新路阻, 'line_search'
+        为求搜索方向与步长并更新流量, 'convergence' 为计算相对间隙等. 列
+        表的第 0 项为主循环之前的初始分配. 由 `user_equilibrium` 与
+        `stochastic_user_equilibrium` 记录.
+    searches : int
+        最短路搜索的次数.
+    workspace_nbytes : int
+        最短路与加载所用工作数组的最大字节数, 不含进程池中的.
+    trace : list
+        各阶段的 Chrome trace 事件, 见 `write_trace`.
+    stopped_by_hook : bool
+        分配是否因 `cfg.hooks` 的要求而提前结束.
     """
     __slots__ = ('step','max_flow_change','relative_gap',
-                 'equilibrium_reached')
+                 'equilibrium_reached', 'path_store_nbytes', 'routes',
+                 'settled_nodes', 'select_link', 'select_zone', 'warm_start',
+                 'iterations_saved', 'wall_time', 'cpu_time', 'searches',
+                 'workspace_nbytes', 'trace', 'stopped_by_hook')
 
     def __init__(self):
         self.step = []
         self.max_flow_change = []
         self.relative_gap = []
         self.equilibrium_reached = False
+        self.path_store_nbytes = 0
+        self.routes = None
+        self.settled_nodes = None
+        self.select_link = None
+        self.select_zone = None
+        self.warm_start = None
+        self.iterations_saved = None
+        self.wall_time = {}
+        self.cpu_time = {}
+        self.searches = 0
+        self.workspace_nbytes = 0
+        self.trace = []
+        self.stopped_by_hook = False
+
+    def write_trace(self, path):
+        """把 `trace` 写为 Chrome trace-event 格式的 JSON 文件."""
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.trace,
+                       'displayTimeUnit': 'ms'}, f)
+
+
+class PhaseTimer:
+    """记录分配各阶段所用时间的计时器.
+
+    ``with timer.phase(name):`` 中的墙钟时间与 CPU 时间累加到 `summary`
+    当前迭代的记录中, 并记为一个 trace 事件. CPU 时间为整个进程的, 包括
+    各线程所用的时间.
+
+    Parameters
+    ----------
+    summary : AssignSummary
+    """
+
+    def __init__(self, summary):
+        self.summary = summary
+        self.iteration = 0
+        self._start = perf_counter()
+        self._pid = os.getpid()
+        for phase in PHASES:
+            summary.wall_time[phase] = [0.0]
+            summary.cpu_time[phase] = [0.0]
+
+    def next_iteration(self):
+        """开始下一次迭代的计时."""
+        self.iteration += 1
+        for phase in PHASES:
+            self.summary.wall_time[phase].append(0.0)
+            self.summary.cpu_time[phase].append(0.0)
+
+    @contextmanager
+    def phase(self, name):
+        """计时阶段 `name`, 它是 `PHASES` 之一."""
+        wall, cpu = perf_counter(), process_time()
+        try:
+            yield
+        finally:
+            wall_used = perf_counter() - wall
+            cpu_used = process_time() - cpu
+            self.summary.wall_time[name][-1] += wall_used
+            self.summary.cpu_time[name][-1] += cpu_used
+            self.summary.trace.append(
+                {'name': name, 'cat': 'assignment', 'ph': 'X',
+                 'ts': (wall - self._start) * 1e6, 'dur': wall_used * 1e6,
+                 'pid': self._pid, 'tid': 0,
+                 'args': {'iteration': self.iteration,
+                          'cpu_ms': cpu_used * 1e3}})
+
+
+class IterationInfo:
+    """每次迭代后传给 `cfg.hooks` 中各函数的迭代情况.
+
+    `arcs_flow` 与 `time` 是分配所用数组的只读视图, 其内容在下次迭代中会
+    被改写, 需要保留时应复制.
+
+    Attributes
+    ----------
+    iteration : int
+    arcs_flow : ndarray
+        更新后的弧流量, 多车种分配时为标准车当量.
+    time : ndarray
+        本次迭代全有全无分配所用的路阻.
+    step : float
+    relative_gap : float
+    max_flow_change : float
+    summary : AssignSummary
+        到本次迭代为止的分配记录.
+    """
+    __slots__ = ('iteration', 'arcs_flow', 'time', 'step', 'relative_gap',
+                 'max_flow_change', 'summary')
+
+    def __init__(self, arcs_flow, time, summary):
+        self.arcs_flow = _read_only(arcs_flow)
+        self.time = _read_only(time)
+        self.summary = summary
+        self.iteration = 0
+        self.step = self.relative_gap = self.max_flow_change = np.nan
+
+
+def _read_only(arr):
+    view = arr.view()
+    view.flags.writeable = False
+    return view
+
+
+def run_hooks(hooks, info, iteration, step, relative_gap, max_flow_change):
+    """更新 `info` 并依次调用 `hooks`, 有函数要求停止时返回 `True`."""
+    info.iteration = iteration
+    info.step = step
+    info.relative_gap = relative_gap
+    info.max_flow_change = max_flow_change
+    stop = False
+    for hook in hooks:
+        if hook(info):
+            stop = True
+    if stop:
+        info.summary.stopped_by_hook = True
+    return stop
+
+
+def log_iteration(iteration, relative_gap, max_flow_change, step=None):
+    """以 INFO 级别记录一次迭代, 各值也作为日志记录的同名属性."""
+    extra = {'iteration': iteration, 'step': step,
+             'relative_gap': relative_gap,
+             'max_flow_change': max_flow_change}
+    if step is None:
+        logger.info('Iter%d: relative_gap=%s, max_flow_change=%s',
+                    iteration, relative_gap, max_flow_change, extra=extra)
+    else:
+        logger.info('Iter%d: step=%s, relative_gap=%s, max_flow_change=%s',
+                    iteration, step, relative_gap, max_flow_change,
+                    extra=extra)
 
 
 class Counter:
@@ -99,13 +354,225 @@ class Counter:
             return True
 
 
+class AssignCache:
+    """同一网络上多次分配共用的准备数据.
+
+    `get_sp_param`, `prepare_focus_nodes`, `net_to_table_mapping`, 转向结果
+    表的 `ID`, `FROM`, `TO`, 路阻函数的分组与最短路的工作数组都只在第一次
+    用到时计算, 之后的分配直接使用. 在此期间网络, 路段表与 `cfg` 中除
+    `preload_field` 以外的参数不应改变.
+
+    Parameters
+    ----------
+    net : Net
+    link_table : IDTable
+    """
+
+    def __init__(self, net, link_table):
+        self.net = net
+        self.link_table = link_table
+        self._sp_param = {}
+        self._focus = None
+        self._mapping = None
+        self._turn_data = None
+        self._vdf = None
+        self._preload = {}
+        self._workspace = {}
+
+    def sp_param(self, turn_delay_type):
+        """同 ``get_sp_param(net, turn_delay_type)``."""
+        if turn_delay_type not in self._sp_param:
+            self._sp_param[turn_delay_type] = get_sp_param(self.net,
+                                                           turn_delay_type)
+        return self._sp_param[turn_delay_type]
+
+    def workspace(self, threads):
+        """`threads` 个线程的 `ShortestPathWorkspace`, 各车种依次分配时
+        共用."""
+        if threads not in self._workspace:
+            self._workspace[threads] = ShortestPathWorkspace(self.net,
+                                                             threads)
+        return self._workspace[threads]
+
+    @property
+    def workspace_nbytes(self):
+        """所有工作数组的字节数."""
+        return sum(w.nbytes for w in self._workspace.values())
+
+    def focus_nodes(self, focus_nodes):
+        """同 `prepare_focus_nodes`, 每次返回新的全 0 `turns_flow`."""
+        if self._focus is None:
+            self._focus = prepare_focus_nodes(self.net, focus_nodes)
+        a, b, turns_flow = self._focus
+        return a, b, np.zeros_like(turns_flow)
+
+    def vdf(self, cfg):
+        """按 `cfg` 分组的 `VDFGroups`, 预加载流量为 `cfg.preload_field`."""
+        data = self.net._data
+        shape = data.shape
+        type_field = cfg.arc_type_field
+        type_dict = cfg.arc_type_dict
+        field = cfg.preload_field or None
+        if field is not None and field not in self._preload:
+            self._preload[field] = get_assign_param(data, field, type_field,
+                                                    type_dict)
+        preload_flow = self._preload.get(field)
+        if self._vdf is None:
+            time0 = get_assign_param(data, cfg.time_field, type_field,
+                                     type_dict)
+            capacity = get_assign_param(data, cfg.capacity_field, type_field,
+                                        type_dict)
+            self._vdf = VDFGroups(data, cfg, full_param(time0, shape),
+                                  full_param(capacity, shape), preload_flow)
+        else:
+            self._vdf.set_preload(preload_flow)
+        return self._vdf
+
+    def link_flow(self, arcs_flow):
+        """同 `net_to_link_flow`."""
+        return net_to_link_flow(self.link_table, self.net, arcs_flow,
+                                self.mapping())
+
+    def arcs_flow(self, link_flow):
+        """`link_flow` 的逆变换, 由路段流量得到弧流量."""
+        mapping = self.mapping()
+        direction = self.link_table['DIR']
+        arcs_flow = np.zeros(self.net._data.shape, np.float64)
+        ab = direction >= 0
+        arcs_flow[mapping['AB'][ab]] = link_flow['AB_FLOW'][ab]
+        ba = direction <= 0
+        arcs_flow[mapping['BA'][ba]] = link_flow['BA_FLOW'][ba]
+        return arcs_flow
+
+    def mapping(self):
+        """同 `net_to_table_mapping`."""
+        if self._mapping is None:
+            self._mapping = net_to_table_mapping(self.net, self.link_table)
+        return self._mapping
+
+    def turn_data(self, a, b, turns_flow):
+        """同 `_get_turn_data_from_runtime`."""
+        if self._turn_data is None:
+            self._turn_data = _get_turn_data_from_runtime(self.net, a, b,
+                                                          turns_flow)
+        turn_data = self._turn_data.copy()
+        turn_data['FLOW'] = turns_flow
+        return turn_data
+
+
+class WarmStart:
+    """作为下一次分配的初始解的分配结果.
+
+    分配结束后由 `AssignSummary.warm_start` 得到, 也可以由已知的流量直接
+    构造. 新的 OD 矩阵是 `matrices` 的倍数时(需求乘以同一倍数, 或需求不
+    变而网络的路阻参数改变), 流量按该倍数缩放后即为可行的初始解. 网络的
+    弧与转向应与得到该结果时相同.
+
+    Parameters
+    ----------
+    matrices : list
+        各车种的 OD 矩阵.
+    arcs_flow : list of ndarray
+        各车种以辆计的弧流量.
+    turns_flow : list of ndarray, optional
+        各车种在 `cfg.focus_nodes` 的转向上的流量, 与 `turn_data` 的行对应.
+        Default: `None`.
+    iterations : int, optional
+        冷启动分配所用的迭代次数, 用于计算 `iterations_saved`.
+        Default: `None`.
+    bushes : list, optional
+        `bush_equilibrium` 中每个起点的 bush ``(links, flows)``.
+        Default: `None`.
+    routes : Routes, optional
+        `path_equilibrium` 得到的路径, 继续分配时会向其 `store` 中加入新的
+        路径. Default: `None`.
+    """
+    __slots__ = ('matrices', 'arcs_flow', 'turns_flow', 'iterations',
+                 'bushes', 'routes')
+
+    def __init__(self, matrices, arcs_flow, turns_flow=None, iterations=None,
+                 bushes=None, routes=None):
+        self.matrices = matrices
+        self.arcs_flow = arcs_flow
+        self.turns_flow = turns_flow
+        self.iterations = iterations
+        self.bushes = bushes
+        self.routes = routes
+
+    def scales(self, matrices):
+        """`matrices` 中各车种的矩阵是 `self.matrices` 的多少倍.
+
+        Raises
+        ------
+        ValueError :
+            车种数不同, 或有矩阵不是原矩阵的倍数.
+        """
+        if len(matrices) != len(self.matrices):
+            raise ValueError('The warm start has {} classes, got {}.'.
+                             format(len(self.matrices), len(matrices)))
+        scales = []
+        for old, new in zip(self.matrices, matrices):
+            scale = _demand_scale(old, new)
+            if scale is None:
+                raise ValueError('The matrix is not a multiple of the one of '
+                                 'the warm start.')
+            scales.append(scale)
+        return scales
+
+
+def _cold_iterations(summary, warm_start):
+    """冷启动的迭代次数, 从 `warm_start` 开始时同时记录节省的次数."""
+    iterations = len(summary.relative_gap)
+    if warm_start is None:
+        return iterations
+    if warm_start.iterations is not None:
+        summary.iterations_saved = warm_start.iterations - iterations
+    return warm_start.iterations
+
+
+def _demand_scale(old, new, axis=None):
+    """`new` 的流量是 `old` 的多少倍, 不成比例时为 `None`.
+
+    `axis` 为 1 时逐行比较(只用于 `Matrix`), 返回每行的倍数, 不成比例的
+    行为 NAN.
+    """
+    if not (np.array_equal(old.row_idx, new.row_idx) and
+            np.array_equal(old.col_idx, new.col_idx)):
+        return None
+    old_sparse = isinstance(old, tp.SparseMatrix)
+    if old_sparse != isinstance(new, tp.SparseMatrix):
+        return None
+    if old_sparse:
+        if not (np.array_equal(old.indptr, new.indptr) and
+                np.array_equal(old.indices, new.indices)):
+            return None
+        x, y = old.values, new.values
+    else:
+        x, y = old._data, new._data
+    x = np.asarray(x, np.float64)
+    y = np.asarray(y, np.float64)
+    if axis is None:
+        total = x.sum()
+        if total == 0:
+            return None
+        scale = y.sum() / total
+        return scale if np.allclose(y, scale * x, 1e-9, 0) else None
+    total = x.sum(axis)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = y.sum(axis) / total
+    same = np.all(np.isclose(y, scale[:, None] * x, 1e-9, 0), axis) & \
+        (total > 0)
+    scale[~same] = np.nan
+    return scale
+
+
 def all_or_nothing(net, matrix, link_table, cfg):
     """全有全无分配.
 
     Parameters
     ----------
     net : Net
-    matrix : Matrix
+    matrix : Matrix or SparseMatrix
     link_table : IDTable
     cfg : AssignConfig
 
@@ -125,15 +592,15 @@ def all_or_nothing(net, matrix, link_table, cfg):
     data = net._data
     time = get_assign_param(data, cfg.time_field, cfg.arc_type_field,
                             cfg.arc_type_dict)
-    flag, turn_idx, from_link, to_link, delay, dist, node_pred, arc_pred = \
-        get_sp_param(net, cfg.turn_delay_type)
     a, b, turns_flow = prepare_focus_nodes(net, cfg.focus_nodes)
     arcs_flow = np.zeros(data.shape, np.float64)
 
-    c_all_or_nothing(matrix._row_idx, matrix._col_idx, matrix._data,
-                     net.idx, data['ID'], data['END_NODE'], time,
-                     flag, turn_idx, from_link, to_link, delay, dist,
-                     node_pred, arc_pred, arcs_flow, a, b, turns_flow)
+    aon, pool = get_aon(net, matrix, cfg, a, b, turns_flow)
+    try:
+        aon(time, arcs_flow, turns_flow)
+    finally:
+        if pool is not None:
+            pool.close()
 
     flow_data = net_to_link_flow(link_table, net, arcs_flow)
     turn_data = _get_turn_data_from_runtime(net, a, b, turns_flow)
@@ -141,125 +608,566 @@ def all_or_nothing(net, matrix, link_table, cfg):
     return flow_data, turn_data
 
 
-def user_equilibrium(net, matrix, link_table, cfg):
+def user_equilibrium(net, matrix, link_table, cfg, cache=None,
+                     initial_time=None, warm_start=None):
     """用户均衡分配.
 
+    多车种分配时各车种共用一次路阻函数的计算(按标准车当量的总流量), 再以
+    各自的广义费用分别进行全有全无分配, 步长由统一的目标函数确定.
+
     Parameters
     ----------
     net : Net
-    matrix : Matrix
+    matrix : Matrix, SparseMatrix or list
+        一个 OD 矩阵, 或多车种分配中由 `AssignClass` 组成的列表, 列表中
+        也可以是 ``(matrix, pce, cost, turn_delay_type)`` 元组.
     link_table : IDTable
     cfg : AssignConfig
+    cache : AssignCache, optional
+        同一网络上多次分配时共用的准备数据. Default: `None`.
+    initial_time : ndarray, optional
+        第一次全有全无分配使用的路阻, 如由上一时段的流量得到的路阻, 默认
+        为零流量(含预加载)时的路阻. Default: `None`.
+    warm_start : WarmStart, optional
+        以其中按需求倍数缩放的流量为初始解, 不进行第一次全有全无分配
+        (SUE 不支持).
+        `summary.iterations_saved` 中记录比冷启动少用的迭代次数.
+        Default: `None`.
 
     Returns
     -------
     flow_data : structured array
         一个记录着分配结果的结构数组，它包括 `ID`, `AB_FLOW`, `BA_FLOW` 这几个域.
+        多车种分配时 `AB_FLOW`, `BA_FLOW` 为标准车当量的总流量, 另有各车种
+        以辆计的 ``AB_FLOW_<name>``, ``BA_FLOW_<name>`` 域.
     turn_data : structured array
         一个记录着交叉口转向流量的结构数组，它包括 `ID`, `FROM`, `TO`, `FLOW` 这
-        几个域. 只有在 `cfg.focus_node` 中指明的交叉口才记录转向.
+        几个域. 只有在 `cfg.focus_node` 中指明的交叉口才记录转向. 多车种
+        分配时另有各车种的 ``FLOW_<name>`` 域.
     summary : AssignSummary
         记录着分配迭代过程的结构.
 
     See Also
     --------
-    all_or_nothing
+    all_or_nothing, AssignClass, stochastic_user_equilibrium,
+    multi_period_equilibrium
     """
+    if cfg.method == 'SUE':
+        if isinstance(matrix, (list, tuple)):
+            raise ValueError('Multi-class assignment is not supported by '
+                             'SUE.')
+        if warm_start is not None:
+            raise ValueError('Warm start is not supported by SUE, use '
+                             'initial_time.')
+        if cfg.select_links is not None or cfg.select_zones is not None:
+            raise ValueError('Select-link and select-zone analysis are not '
+                             'supported by SUE.')
+        from transpy.compute.sue import stochastic_user_equilibrium
+        return stochastic_user_equilibrium(net, matrix, link_table, cfg,
+                                           cache, initial_time)
+
     # Basic setup
     summary = AssignSummary()
     data = net._data
-    type_field = cfg.arc_type_field
-    type_dict = cfg.arc_type_dict
-    time0 = get_assign_param(data, cfg.time_field, type_field, type_dict)
-    time = time0.copy()
-    flag, turn_idx, from_link, to_link, delay, dist, node_pred, arc_pred = \
-        get_sp_param(net, cfg.turn_delay_type)
+    shape = data.shape
     counter = Counter(cfg.print_frequency)
+    if cfg.line_search not in ('newton', 'secant'):
+        raise ValueError("Wrong line_search, use 'newton' or 'secant'")
+    multi_class = isinstance(matrix, (list, tuple))
+    classes = get_assign_classes(matrix, data, cfg)
+    if cache is None:
+        cache = AssignCache(net, link_table)
 
-    # Setup about BPR function parameters
-    capacity = get_assign_param(data, cfg.capacity_field, type_field,
-                                type_dict)
-    alpha = get_assign_param(data, cfg.alpha_field, type_field, type_dict,
-                             cfg.global_alpha)
-    beta = get_assign_param(data, cfg.beta_field, type_field, type_dict,
-                            cfg.global_beta)
+    # Setup about volume-delay functions, arcs are grouped once.
+    vdf = cache.vdf(cfg)
 
     # Setup about focus node
-    a, b, turns_flow1 = prepare_focus_nodes(net, cfg.focus_nodes)
-    turns_flow2 = turns_flow1.copy()
-    if a.shape[0] == 1:
-        turns_diff = None
-    else:
-        turns_diff = turns_flow1.copy()
-
-    # Setup about preload
-    if cfg.preload_field:
-        preload_flow = get_assign_param(data, cfg.preload_field, type_field,
-                                        type_dict)
-        # Update time before first assignment
-        bpr_fun(time0, alpha, beta, capacity, time, preload_flow)
-    else:
-        preload_flow = None
-
-    arcs_flow1 = np.zeros(data.shape, np.float64)
+    a, b, turns_flow1 = cache.focus_nodes(cfg.focus_nodes)
+    count_turn = a.shape[0] != 1
+    turn_num = turns_flow1.shape[0]
+    # Select-link and select-zone flows follow the turns flow of each class,
+    # they are kept behind it in one vector and averaged the same way.
+    selecting = cfg.select_links is not None or cfg.select_zones is not None
+    track = count_turn or selecting
+
+    # Total flow in passenger car units.
+    arcs_flow1 = np.zeros(shape, np.float64)
     arcs_flow2 = arcs_flow1.copy()
     diff = arcs_flow1.copy()
-    f = lambda x: derivative(x, arcs_flow1, diff, time0, alpha, beta,
-                             capacity, preload_flow)
-    c_all_or_nothing(matrix._row_idx, matrix._col_idx, matrix._data,
-                     net.idx, data['ID'], data['END_NODE'], time,
-                     flag, turn_idx, from_link, to_link, delay, dist,
-                     node_pred, arc_pred, arcs_flow1, a, b, turns_flow1)
-
-    # Main loop
-    for i in range(1, cfg.max_iteration):
-        # Update road time
-        bpr_fun(time0, alpha, beta, capacity, time, arcs_flow1, preload_flow)
-
-        c_all_or_nothing(matrix._row_idx, matrix._col_idx, matrix._data,
-                         net.idx, data['ID'], data['END_NODE'], time,
-                         flag, turn_idx, from_link, to_link, delay, dist,
-                         node_pred, arc_pred, arcs_flow2, a, b, turns_flow2)
-
-        # Find the best update step.
-        np.subtract(arcs_flow2, arcs_flow1, diff)
-        step = double_secant10(0, 1, f)
-        summary.step.append(step)
-        # Update arcs flow.
-        diff *= step
-        arcs_flow1 += diff
-
-        # Update turns flow.
-        if turns_diff is not None:
-            np.subtract(turns_flow2, turns_flow1, turns_diff)
-            turns_diff *= step
-            turns_flow1 += turns_diff
-
-        # Max Flow Change
-        diff = np.abs(diff, diff)
-        max_flow_change = diff.max()
-        summary.max_flow_change.append(max_flow_change)
-        # Relative Gap
-        relative_gap = 1 - np.sum(time * arcs_flow2) / np.sum(time * arcs_flow1)
-        summary.relative_gap.append(relative_gap)
-
-        # whether print to screen
-        if counter.add():
-            print('Iter{}: step={}, relative_gap={}, max_flow_change={}'.
-                  format(i, step, relative_gap, max_flow_change))
-
-        # Check convergence
-        if relative_gap <= cfg.convergence:
-            break
-        arcs_flow2.fill(0)
-        turns_flow2.fill(0)
-
-    flow_data = net_to_link_flow(link_table, net, arcs_flow1)
-    turn_data = _get_turn_data_from_runtime(net, a, b, turns_flow1)
+    # Update time before first assignment, for preload.
+    time = np.empty(shape, np.float64)
+    timer = PhaseTimer(summary)
+    hooks = cfg.hooks
+    if hooks:
+        info = IterationInfo(arcs_flow1, time, summary)
+    with timer.phase('vdf'):
+        vdf.update(arcs_flow1, time)
+
+    # Flows of each class. A single class with pce 1 and no extra cost
+    # works on the total flows directly.
+    single = len(classes) == 1 and classes[0].pce == 1 and \
+        classes[0].extra is None
+    states = []
+    rows = 0
+    for c in classes:
+        state = _ClassState(c, rows)
+        rows = state.rows.stop
+        if selecting:
+            state.select = get_select_flows(c.matrix, cfg, shape[0])
+            select_num = sum(x.size for x in state.select)
+        else:
+            select_num = 0
+        if single:
+            state.flow1, state.flow2 = arcs_flow1, arcs_flow2
+        else:
+            state.flow1 = np.zeros(shape, np.float64)
+            state.flow2 = np.zeros(shape, np.float64)
+        state.turns1 = np.zeros(turn_num + select_num, np.float64)
+        if single:
+            turns_flow1 = state.turns1[:turn_num]
+        state.turns2 = state.turns1.copy()
+        state.turns_diff = state.turns1.copy() if track else None
+        if c.extra is not None:
+            state.weight = np.empty(shape, np.float64)
+        states.append(state)
+
+    # Setup about line search
+    tolerance = cfg.line_search_tolerance
+    f = lambda x: vdf.line_derivative(x, arcs_flow1, diff)[0] + offset
+
+    # Setup about conjugate directions, the previous two target points
+    # (arcs flow and turns flow) are kept.
+    method = cfg.method
+    conjugate = method in ('CFW', 'BFW')
+    hessian = np.empty(shape, np.float64) if conjugate else None
+    target1 = target2 = None
+    step = offset = 0
+
+    if warm_start is not None:
+        if initial_time is not None:
+            raise ValueError('Give either initial_time or warm_start.')
+        if selecting:
+            raise ValueError('Select-link and select-zone analysis need a '
+                             'cold start.')
+        if count_turn and (warm_start.turns_flow is None or any(
+                t.shape[0] != turn_num for t in warm_start.turns_flow)):
+            raise ValueError('The warm start has no turns flow at the focus '
+                             'nodes.')
+        scales = warm_start.scales([state.cls.matrix for state in states])
+
+    summary.settled_nodes = np.zeros(rows, np.intp)
+    try:
+        for state in states:
+            state.aon, state.pool = get_aon(net, state.cls.matrix, cfg, a, b,
+                                            state.turns1[:turn_num],
+                                            state.cls.turn_delay_type, cache)
+
+        def assign(flow_name, turns_name, total, time):
+            """AON of every class, and the total flow of them."""
+            with timer.phase('loading'):
+                for state in states:
+                    turns = getattr(state, turns_name)
+                    state.aon(state.cost(time), getattr(state, flow_name),
+                              turns[:turn_num],
+                              summary.settled_nodes[state.rows],
+                              _split_select(turns[turn_num:], state.select)
+                              if selecting else None)
+                if not single:
+                    _pcu_sum(states, flow_name, total)
+            # Origins without demand are not searched.
+            summary.searches += np.count_nonzero(summary.settled_nodes)
+            summary.workspace_nbytes = max(summary.workspace_nbytes,
+                                           cache.workspace_nbytes)
+
+        if warm_start is None:
+            assign('flow1', 'turns1', arcs_flow1,
+                   time if initial_time is None else
+                   np.asarray(initial_time, np.float64))
+        else:
+            for k, state in enumerate(states):
+                np.multiply(warm_start.arcs_flow[k], scales[k], state.flow1)
+                if count_turn:
+                    np.multiply(warm_start.turns_flow[k], scales[k],
+                                state.turns1[:turn_num])
+            if not single:
+                _pcu_sum(states, 'flow1', arcs_flow1)
+
+        # Main loop
+        for i in range(1, cfg.max_iteration):
+            timer.next_iteration()
+            # Update road time, and the Hessian for conjugate directions.
+            with timer.phase('vdf'):
+                vdf.update(arcs_flow1, time, hessian)
+
+            assign('flow2', 'turns2', arcs_flow2, time)
+
+            with timer.phase('line_search'):
+                # The target point to move towards, the AON flow for FW.
+                target = arcs_flow2
+                for state in states:
+                    state.target = state.flow2
+                    state.turns_target = state.turns2
+                if conjugate:
+                    coef = conjugate_coefficients(
+                        method, arcs_flow1, arcs_flow2, target1, target2,
+                        step, hessian)
+                    target = _combine(coef, arcs_flow2, target1, target2)
+                    target2, target1 = target1, target
+                    for state in states:
+                        if not single:
+                            state.target = _combine(
+                                coef, state.flow2, state.target1,
+                                state.target2)
+                            state.target2, state.target1 = \
+                                state.target1, state.target
+                        if track:
+                            state.turns_target = _combine(
+                                coef, state.turns2, state.turns_target1,
+                                state.turns_target2)
+                            state.turns_target2, state.turns_target1 = \
+                                state.turns_target1, state.turns_target
+
+                # Find the best update step, the extra costs are linear in
+                # flow.
+                np.subtract(target, arcs_flow1, diff)
+                offset = 0
+                for state in states:
+                    if state.cls.extra is not None:
+                        offset += state.cls.pce * (
+                            state.cls.extra.dot(state.target) -
+                            state.cls.extra.dot(state.flow1))
+                if cfg.line_search == 'newton':
+                    step, _ = vdf.line_search(arcs_flow1, diff, tolerance,
+                                              offset=offset)
+                else:
+                    step = double_secant10(0, 1, f, tolerance * abs(f(0)))
+                summary.step.append(step)
+
+                # Update arcs flow.
+                if not single:
+                    for state in states:
+                        state.flow1 += step * (state.target - state.flow1)
+                diff *= step
+                if single:
+                    arcs_flow1 += diff
+                else:
+                    _pcu_sum(states, 'flow1', arcs_flow1)
+
+                # Update turns flow.
+                if track:
+                    for state in states:
+                        np.subtract(state.turns_target, state.turns1,
+                                    state.turns_diff)
+                        state.turns_diff *= step
+                        state.turns1 += state.turns_diff
+
+            with timer.phase('convergence'):
+                # Max Flow Change
+                diff = np.abs(diff, diff)
+                max_flow_change = diff.max()
+                summary.max_flow_change.append(max_flow_change)
+                # Relative Gap
+                sptt = tstt = 0
+                for state in states:
+                    cost = state.cost(time)
+                    sptt += state.cls.pce * np.sum(cost * state.flow2)
+                    tstt += state.cls.pce * np.sum(cost * state.flow1)
+                relative_gap = 1 - sptt / tstt
+                summary.relative_gap.append(relative_gap)
+
+                # whether to log
+                if counter.add():
+                    log_iteration(i, relative_gap, max_flow_change, step)
+
+            if hooks and run_hooks(hooks, info, i, step, relative_gap,
+                                   max_flow_change):
+                break
+            # Check convergence
+            if relative_gap <= cfg.convergence:
+                break
+            for state in states:
+                state.flow2.fill(0)
+                state.turns2.fill(0)
+            arcs_flow2.fill(0)
+    finally:
+        for state in states:
+            if state.pool is not None:
+                state.pool.close()
+
+    if not single:
+        turns_flow1 = states[0].cls.pce * states[0].turns1[:turn_num]
+        for state in states[1:]:
+            turns_flow1 += state.cls.pce * state.turns1[:turn_num]
+    if selecting:
+        _select_summary(summary, states, cfg, cache, turn_num, multi_class)
+    summary.warm_start = WarmStart(
+        [state.cls.matrix for state in states],
+        [state.flow1 for state in states],
+        [state.turns1[:turn_num] for state in states],
+        _cold_iterations(summary, warm_start))
+    flow_data = cache.link_flow(arcs_flow1)
+    turn_data = cache.turn_data(a, b, turns_flow1)
+    if multi_class:
+        names = [state.cls.name for state in states]
+        flow_data = tp.add_field(
+            flow_data, [d + '_FLOW_' + n for n in names for d in ('AB', 'BA')],
+            ['f8'] * 2 * len(names))
+        turn_data = tp.add_field(turn_data, ['FLOW_' + n for n in names],
+                                 ['f8'] * len(names))
+        for state in states:
+            name = state.cls.name
+            link_flow = cache.link_flow(state.flow1)
+            flow_data['AB_FLOW_' + name] = link_flow['AB_FLOW']
+            flow_data['BA_FLOW_' + name] = link_flow['BA_FLOW']
+            turn_data['FLOW_' + name] = state.turns1[:turn_num]
+    if cfg.trace_file:
+        summary.write_trace(cfg.trace_file)
 
     return flow_data, turn_data, summary
 
 
+def multi_period_equilibrium(net, periods, link_table, cfg,
+                             warm_start=False):
+    """多时段用户均衡分配.
+
+    各时段在同一网络上依次进行 `user_equilibrium`, 网络的准备数据(见
+    `AssignCache`)只计算一次.
+
+    Parameters
+    ----------
+    net : Net
+    periods : list of tuple
+        每个时段一个 ``(period_name, matrix, preload_field, duration)`` 元
+        组. `matrix` 同 `user_equilibrium`, 为该时段每小时的需求;
+        `preload_field` 为该时段预加载流量所在的域, 可为 `None`;
+        `duration` 为该时段的小时数.
+    link_table : IDTable
+    cfg : AssignConfig
+        各时段共用的参数, 其中的 `preload_field` 不使用.
+    warm_start : bool, optional
+        为 `True` 时, 每个时段的第一次全有全无分配使用上一时段的流量加上本
+        时段的预加载流量所得的路阻. Default: False.
+
+    Returns
+    -------
+    flow_data : structured array
+        形状为 ``(时段数, 路段数)``, 第 `k` 行是第 `k` 个时段的
+        `user_equilibrium` 结果, 另有 `PERIOD` 域, 以及流量乘以时段长度的
+        `AB_VOLUME`, `BA_VOLUME` 域.
+    turn_data : structured array
+        形状为 ``(时段数, 转向数)``, 另有 `PERIOD` 与 `VOLUME` 域.
+    summaries : dict
+        时段名称到该时段 `AssignSummary` 的映射.
+
+    See Also
+    --------
+    user_equilibrium
+    """
+    if len(periods) == 0:
+        raise ValueError('No period to assign.')
+    names = [p[0] for p in periods]
+    if len(set(names)) != len(names):
+        raise ValueError('Names of the periods should be unique.')
+    name_type = 'U{}'.format(max(len(str(n)) for n in names))
+    cache = AssignCache(net, link_table)
+    period_cfg = copy.copy(cfg)
+    flows, turns, summaries = [], [], {}
+    last_flow = None
+    for name, matrix, preload_field, duration in periods:
+        period_cfg.preload_field = preload_field
+        initial_time = None
+        if warm_start and last_flow is not None:
+            initial_time = np.empty(net._data.shape, np.float64)
+            cache.vdf(period_cfg).update(cache.arcs_flow(last_flow),
+                                         initial_time)
+        flow_data, turn_data, summary = user_equilibrium(
+            net, matrix, link_table, period_cfg, cache, initial_time)
+        last_flow = flow_data
+        summaries[name] = summary
+
+        flow_data = tp.add_field(flow_data,
+                                 ['PERIOD', 'AB_VOLUME', 'BA_VOLUME'],
+                                 [name_type, 'f8', 'f8'])
+        flow_data['PERIOD'] = name
+        flow_data['AB_VOLUME'] = flow_data['AB_FLOW'] * duration
+        flow_data['BA_VOLUME'] = flow_data['BA_FLOW'] * duration
+        turn_data = tp.add_field(turn_data, ['PERIOD', 'VOLUME'],
+                                 [name_type, 'f8'])
+        turn_data['PERIOD'] = name
+        turn_data['VOLUME'] = turn_data['FLOW'] * duration
+        flows.append(flow_data)
+        turns.append(turn_data)
+
+    return np.stack(flows), np.stack(turns), summaries
+
+
+class AssignClass:
+    """多车种分配中的一个车种.
+
+    Parameters
+    ----------
+    matrix : Matrix or SparseMatrix
+        该车种以辆计的 OD 矩阵.
+    pce : float, optional
+        车辆换算系数, 路阻函数按各车种流量乘以 `pce` 之和计算. Default: 1.
+    cost : str, float or None, optional
+        为 str 时是 `Net` 中的一个域, 其值(以时间计)加到路阻上作为该车种
+        的广义费用; 为数值时是该车种的时间价值(VOT), 广义费用为路阻加上
+        ``cfg.toll_field`` 除以 VOT; 为 `None` 时只用路阻. Default: `None`.
+    turn_delay_type : {'no', 'only_ban', 'all'}, optional
+        该车种计算转向延误的方式, 为 `None` 时使用 ``cfg.turn_delay_type``.
+        Default: `None`.
+    name : str, optional
+        结果中该车种的域名后缀, 默认为车种在列表中的序号(从 1 开始).
+
+    Attributes
+    ----------
+    extra : ndarray or None
+        由 `get_assign_classes` 根据 `cost` 得到的每条弧的额外费用.
+    """
+    __slots__ = ('matrix', 'pce', 'cost', 'turn_delay_type', 'name',
+                 'extra')
+
+    def __init__(self, matrix, pce=1, cost=None, turn_delay_type=None,
+                 name=None):
+        self.matrix = matrix
+        self.pce = pce
+        self.cost = cost
+        self.turn_delay_type = turn_delay_type
+        self.name = name
+        self.extra = None
+
+
+def get_assign_classes(matrix, data, cfg):
+    """把 `user_equilibrium` 的 `matrix` 参数整理为 `AssignClass` 的列表.
+
+    Parameters
+    ----------
+    matrix : Matrix, SparseMatrix or list
+    data : structured array
+        ``Net._data``.
+    cfg : AssignConfig
+
+    Returns
+    -------
+    list of AssignClass
+        每个车种的 `extra` 已经求出.
+    """
+    if not isinstance(matrix, (list, tuple)):
+        return [AssignClass(matrix)]
+    classes = []
+    for k, c in enumerate(matrix):
+        if not isinstance(c, AssignClass):
+            c = AssignClass(*c)
+        if c.name is None:
+            c.name = str(k + 1)
+        if not c.pce > 0:
+            raise ValueError('pce of class {} should be positive.'.
+                             format(c.name))
+        if isinstance(c.cost, str):
+            c.extra = full_param(get_assign_param(
+                data, c.cost, cfg.arc_type_field, cfg.arc_type_dict),
+                data.shape)
+        elif c.cost is not None and cfg.toll_field:
+            if not c.cost > 0:
+                raise ValueError('VOT of class {} should be positive.'.
+                                 format(c.name))
+            c.extra = full_param(get_assign_param(
+                data, cfg.toll_field, cfg.arc_type_field, cfg.arc_type_dict),
+                data.shape) / c.cost
+        classes.append(c)
+    if len(set(c.name for c in classes)) != len(classes):
+        raise ValueError('Names of the classes should be unique.')
+    return classes
+
+
+class _ClassState:
+    """`user_equilibrium` 中一个车种的流量与工作数组."""
+    __slots__ = ('cls', 'rows', 'aon', 'pool', 'weight', 'flow1', 'flow2',
+                 'turns1', 'turns2', 'turns_diff', 'target', 'target1',
+                 'target2', 'turns_target', 'turns_target1',
+                 'turns_target2', 'select')
+
+    def __init__(self, cls, start):
+        self.cls = cls
+        self.rows = slice(start, start + cls.matrix.shape[0])
+        self.aon = self.pool = self.weight = self.select = None
+        self.target = self.target1 = self.target2 = None
+        self.turns_target = self.turns_target1 = self.turns_target2 = None
+
+    def cost(self, time):
+        """该车种的广义费用."""
+        if self.weight is None:
+            return time
+        return np.add(time, self.cls.extra, self.weight)
+
+
+def _split_select(flat, select):
+    """把 `flat` 按 `select` 中各数组的形状分为 ``(sel_flow, zone_flow)``."""
+    sel_flow, zone_flow = select
+    return (flat[:sel_flow.size].reshape(sel_flow.shape),
+            flat[sel_flow.size:].reshape(zone_flow.shape))
+
+
+def _select_summary(summary, states, cfg, cache, turn_num, multi_class):
+    """由各车种的选择分析结果填写 `summary.select_link` 与
+    `summary.select_zone`."""
+    links = list(cfg.select_links) if cfg.select_links is not None else []
+    zones = list(cfg.select_zones) if cfg.select_zones is not None else []
+    class_link = {}
+    zone_flow = 0
+    for state in states:
+        sel_flow, flow = _split_select(state.turns1[turn_num:], state.select)
+        zone_flow = zone_flow + state.cls.pce * flow
+        matrix = state.cls.matrix
+        if isinstance(matrix, tp.SparseMatrix):
+            rows = np.repeat(np.arange(matrix.shape[0]),
+                             np.diff(matrix.indptr))
+            cols = np.asarray(matrix.indices)
+        else:
+            rows, cols = np.divmod(np.flatnonzero(matrix.data),
+                                   matrix.shape[1])
+        row_idx = np.asarray(matrix.row_idx)[rows]
+        col_idx = np.asarray(matrix.col_idx)[cols]
+        result = {}
+        for k, link in enumerate(links):
+            values = sel_flow[k]
+            used = values > 0
+            result[link] = tp.SparseMatrix.from_triplets(
+                row_idx[used], col_idx[used], values[used],
+                matrix.row_idx, matrix.col_idx)
+        class_link[state.cls.name] = result
+    if links:
+        summary.select_link = class_link if multi_class else \
+            class_link[states[0].cls.name]
+    if zones:
+        data = None
+        for k, zone in enumerate(zones):
+            link_flow = cache.link_flow(zone_flow[k])
+            if data is None:
+                names = [d + '_FLOW_' + str(z) for z in zones
+                         for d in ('AB', 'BA')]
+                data = np.zeros(link_flow.shape,
+                                [('ID', link_flow.dtype['ID'])] +
+                                [(name, 'f8') for name in names])
+                data['ID'] = link_flow['ID']
+            data['AB_FLOW_' + str(zone)] = link_flow['AB_FLOW']
+            data['BA_FLOW_' + str(zone)] = link_flow['BA_FLOW']
+        summary.select_zone = tp.IDTable(data)
+
+
+def _pcu_sum(states, name, out):
+    """各车种的流量乘以 pce 之和."""
+    np.multiply(getattr(states[0], name), states[0].cls.pce, out)
+    for state in states[1:]:
+        out += state.cls.pce * getattr(state, name)
+
+
+def full_param(value, shape):
+    """把 `get_assign_param` 得到的参数扩展为每条弧一个值的连续数组."""
+    return np.array(np.broadcast_to(value, shape), np.float64)
+
+
 def bpr_fun(time0, alpha, beta, capacity, time1, arcs_flow,
             preload_flow=None):
     """BPR函数.
@@ -276,6 +1184,97 @@ def bpr_fun(time0, alpha, beta, capacity, time1, arcs_flow,
     time1 *= time0
 
 
+def bpr_derivative(time0, alpha, beta, capacity, der, arcs_flow,
+                   preload_flow=None):
+    """BPR函数对流量的导数.
+
+    der = time0 * alpha * beta * (arcs_flow / capacity) ** (beta - 1) /
+    capacity
+    """
+    np.copyto(der, arcs_flow)
+    if preload_flow is not None:
+        der += preload_flow
+    der /= capacity
+    der **= beta - 1
+    der *= alpha
+    der *= beta
+    der *= time0
+    der /= capacity
+
+
+def conjugate_coefficients(method, arcs_flow, aon_flow, target1, target2,
+                           step, hessian, delta=1e-4):
+    """共轭与双共轭 Frank-Wolfe 算法中新目标点的组合系数.
+
+    新的目标点为 ``c0 * aon_flow + c1 * target1 + c2 * target2``, 使得搜索
+    方向与前一个(CFW)或前两个(BFW)搜索方向关于目标函数的 Hessian 矩阵共轭.
+    系数非负且和为 1, 所以目标点仍是可行解; 不满足时依次退化为 CFW 与 FW.
+
+    Parameters
+    ----------
+    method : {'CFW', 'BFW'}
+    arcs_flow : ndarray
+        当前的弧流量.
+    aon_flow : ndarray
+        本次全有全无分配的弧流量.
+    target1, target2 : ndarray or None
+        前一次与前两次迭代的目标点, 没有时为 `None`.
+    step : float
+        上一次迭代的步长.
+    hessian : ndarray
+        Hessian 矩阵的对角线, 即路阻函数在 `arcs_flow` 处的导数.
+    delta : float, optional
+        `c0` 的下限, 以免搜索方向与之前的方向过于接近. Default: 1e-4.
+
+    Returns
+    -------
+    c0, c1, c2 : float
+    """
+    if target1 is None:
+        return 1.0, 0.0, 0.0
+    d_fw = aon_flow - arcs_flow
+    h1 = hessian * (target1 - arcs_flow)
+
+    if method == 'BFW' and target2 is not None:
+        h2 = hessian * (step * target1 + (1 - step) * target2 - arcs_flow)
+        e1 = target1 - aon_flow
+        e2 = target2 - aon_flow
+        # Solve c1, c2 from h1 . d = 0 and h2 . d = 0, where
+        # d = d_fw + c1 * e1 + c2 * e2 is the new search direction.
+        m11, m12 = h1.dot(e1), h1.dot(e2)
+        m21, m22 = h2.dot(e1), h2.dot(e2)
+        det = m11 * m22 - m12 * m21
+        if det != 0 and np.isfinite(det):
+            r1, r2 = -h1.dot(d_fw), -h2.dot(d_fw)
+            c1 = (r1 * m22 - r2 * m12) / det
+            c2 = (m11 * r2 - m21 * r1) / det
+            c0 = 1 - c1 - c2
+            if c0 >= delta and c1 >= 0 and c2 >= 0:
+                return c0, c1, c2
+
+    # Conjugate to the previous direction only.
+    num = h1.dot(d_fw)
+    den = num - h1.dot(target1 - arcs_flow)
+    if den != 0 and np.isfinite(den):
+        c1 = num / den
+        if 0 <= c1 <= 1 - delta:
+            return 1 - c1, c1, 0.0
+    # Restart from the Frank-Wolfe direction, otherwise the direction
+    # stays close to the previous one, along which the objective has
+    # already been minimized, and the step stalls.
+    return 1.0, 0.0, 0.0
+
+
+def _combine(coef, aon_flow, target1, target2):
+    """按 `conjugate_coefficients` 的系数组合出新的目标点."""
+    target = aon_flow * coef[0]
+    if coef[1]:
+        target += coef[1] * target1
+    if coef[2]:
+        target += coef[2] * target2
+    return target
+
+
 def derivative(step, arcs_flow1, diff, time0, alpha, beta, capacity,
                preload_flow):
     """The derivative which need to be zeros in iteration.
@@ -466,7 +1465,7 @@ def get_assign_param(data, field, type_field=None,
                          format(param[lines[0]], field, lines[0]))
 
 
-def net_to_link_flow(link_table, net, arcs_flow):
+def net_to_link_flow(link_table, net, arcs_flow, mapping=None):
     """将与网络文件对应的弧流量转换为路段流量.
 
     Parameters
@@ -474,6 +1473,8 @@ def net_to_link_flow(link_table, net, arcs_flow):
     link_table : IDTable
     net : Net
     arcs_flow : ndarray
+    mapping : structured array, optional
+        已经得到的 ``net_to_table_mapping(net, link_table)``.
 
     Returns
     -------
@@ -481,10 +1482,11 @@ def net_to_link_flow(link_table, net, arcs_flow):
         A structured array which contains fields of `ID`, `AB_FLOW`
         and `BA_FLOW`.
     """
-    mapping = net_to_table_mapping(net, link_table)
+    if mapping is None:
+        mapping = net_to_table_mapping(net, link_table)
     link_flow = np.empty(len(link_table),
                       dtype={'names': ['ID', 'AB_FLOW', 'BA_FLOW'],
-                             'formats': [ID_TYPE, 'f8', 'f8']})
+                             'formats': [net.id_type, 'f8', 'f8']})
     link_flow['ID'] = link_table['ID']
     link_flow['AB_FLOW'] = arcs_flow[mapping['AB']]
     link_flow['AB_FLOW'][link_table['DIR'] < 0] = np.nan
@@ -492,11 +1494,252 @@ def net_to_link_flow(link_table, net, arcs_flow):
     link_flow['BA_FLOW'][link_table['DIR'] > 0] = np.nan
     return link_flow
 
+def get_aon(net, matrix, cfg, a, b, turns_flow, turn_delay_type=None,
+            cache=None):
+    """准备全有全无分配所需的数据, 返回执行分配的函数.
+
+    Parameters
+    ----------
+    net : Net
+    matrix : Matrix or SparseMatrix
+        为 `SparseMatrix` 时只加载非零元素, 全为 0 的行不搜索最短路. 为
+        `Matrix` 时按 `get_row_blocks` 分块读入.
+    cfg : AssignConfig
+    a, b, turns_flow : ndarray
+        由 `prepare_focus_nodes` 得到的转向流量索引.
+    turn_delay_type : {'no', 'only_ban', 'all'}, optional
+        为 `None` 时使用 ``cfg.turn_delay_type``. Default: `None`.
+    cache : AssignCache, optional
+        从中取得转向参数与工作数组. Default: `None`.
+
+    Returns
+    -------
+    aon : function
+        ``aon(time, arcs_flow, turns_flow, settled_count=None,
+        select=None)``, 以 `time` 为路阻进行全有全无分配, 结果累加到
+        `arcs_flow` 与 `turns_flow` 中. 每个起点的最短路搜索在其所有有流量
+        的终点确定后即停止, 给出 `settled_count` 时其中记录每个起点搜索确
+        定的节点数. 给出 `select` 时进行 `cfg.select_links` 与
+        `cfg.select_zones` 的选择分析, 它是由 `get_select_flows` 得到的
+        ``(sel_flow, zone_flow)``, 结果累加到其中; `cfg` 中未设置选择分析
+        时给出 `select` 会引发 ValueError.
+    pool : ProcessAON or None
+        当 ``cfg.processes > 1`` 时为所用的进程池, 用完后需调用其 `close`
+        方法; 否则为 `None`.
+    """
+    data = net._data
+    if turn_delay_type is None:
+        turn_delay_type = cfg.turn_delay_type
+    if cache is None:
+        flag, turn_idx, from_link, to_link, delay = \
+            get_sp_param(net, turn_delay_type)
+    else:
+        flag, turn_idx, from_link, to_link, delay = \
+            cache.sp_param(turn_delay_type)
+    sources, targets = get_od_idx(net, matrix)
+    threads = cfg.threads
+    if cfg.loading not in ('path', 'tree'):
+        raise ValueError("Wrong loading, use 'path' or 'tree'")
+    tree = cfg.loading == 'tree'
+
+    sparse = isinstance(matrix, tp.SparseMatrix)
+    sel_arc, zone_row = get_select_index(net, matrix, cfg)
+    selecting = sel_arc.shape[0] != 1 or np.any(zone_row >= 0)
+
+    if cfg.processes > 1:
+        if selecting:
+            raise ValueError('Select-link and select-zone analysis are not '
+                             'supported with processes > 1.')
+        block_rows = 0
+        if not sparse and matrix.shape[0] > 0:
+            start, stop = get_row_blocks(matrix, cfg.block_rows)[0]
+            block_rows = stop - start
+        pool = ProcessAON(net, sources, targets,
+                          matrix if sparse else matrix._data, flag,
+                          turn_idx, from_link, to_link, delay, a, b,
+                          turns_flow, cfg.processes, threads, tree,
+                          block_rows)
+        return pool.all_or_nothing, pool
+
+    # Allocated once, every iteration reuses the same work arrays.
+    if cache is None:
+        workspace = ShortestPathWorkspace(net, threads)
+    else:
+        workspace = cache.workspace(threads)
+
+    # Select-link flows are kept for the non-zero OD cells only (see
+    # `get_select_flows`), a dense matrix is loaded by its cells then.
+    if selecting and not sparse:
+        matrix = tp.SparseMatrix.from_matrix(matrix)
+        sparse = True
+
+    if sparse:
+        values = np.asarray(matrix.values, np.float64)
+
+        def aon(time, arcs_flow, turns_flow, settled_count=None,
+                select=None):
+            if select is not None:
+                select = (sel_arc, select[0], zone_row, select[1])
+            c_sparse_all_or_nothing(sources, targets, matrix.indptr,
+                                    matrix.indices, values, net.idx,
+                                    data['ID'], data['END_NODE'], time, flag,
+                                    turn_idx, from_link, to_link, delay,
+                                    arcs_flow, a, b, turns_flow, workspace,
+                                    tree, settled_count, select)
+        return aon, None
+
+    blocks = get_row_blocks(matrix, cfg.block_rows)
+
+    def aon(time, arcs_flow, turns_flow, settled_count=None, select=None):
+        if select is not None:
+            raise ValueError('No select-link or select-zone analysis is set '
+                             'in cfg.')
+        for start, stop in blocks:
+            block = np.asarray(matrix._data[start:stop], np.float64)
+            c_all_or_nothing(sources[start:stop], targets, block, net.idx,
+                             data['ID'], data['END_NODE'], time, flag,
+                             turn_idx, from_link, to_link, delay, arcs_flow,
+                             a, b, turns_flow, workspace, tree,
+                             None if settled_count is None else
+                             settled_count[start:stop])
+    return aon, None
+
+
+def get_select_index(net, matrix, cfg):
+    """由 `cfg.select_links` 与 `cfg.select_zones` 得到选择分析的索引.
+
+    Parameters
+    ----------
+    net : Net
+    matrix : Matrix or SparseMatrix
+    cfg : AssignConfig
+
+    Returns
+    -------
+    sel_arc : ndarray
+        每条弧所属路段在 `cfg.select_links` 中的序号, 不是所选路段时为 -1.
+        没有所选路段时长度为 1.
+    zone_row : ndarray
+        `matrix` 每一行的起点在 `cfg.select_zones` 中的序号, 不是所选小区
+        时为 -1.
+
+    Raises
+    ------
+    ValueError :
+        如果所选路段不在 `net` 中, 或所选路段、小区有重复.
+    """
+    links = np.asarray(cfg.select_links if cfg.select_links is not None
+                       else [], np.int64)
+    zones = np.asarray(cfg.select_zones if cfg.select_zones is not None
+                       else [], np.int64)
+    for name, ids in (('link', links), ('zone', zones)):
+        unique, counts = np.unique(ids, return_counts=True)
+        if np.any(counts > 1):
+            raise ValueError('Selected {}(s) {} repeated.'.
+                             format(name, list(unique[counts > 1])))
+    if links.shape[0] == 0:
+        sel_arc = np.full(1, -1, np.intp)
+    else:
+        arc_id = np.asarray(net._data['ID'], np.int64)
+        missing = np.setdiff1d(links, arc_id)
+        if missing.shape[0]:
+            raise ValueError('Selected link(s) {} not in net.'.
+                             format(list(missing)))
+        order = np.argsort(links, kind='stable')
+        pos = np.searchsorted(links[order], arc_id)
+        pos[pos == links.shape[0]] = 0
+        found = links[order][pos] == arc_id
+        sel_arc = np.where(found, order[pos], -1).astype(np.intp)
+    row_idx = np.asarray(matrix.row_idx, np.int64)
+    zone_row = np.full(row_idx.shape[0], -1, np.intp)
+    for k, zone in enumerate(zones):
+        zone_row[row_idx == zone] = k
+    return sel_arc, zone_row
+
+
+def get_select_flows(matrix, cfg, arc_num):
+    """为选择分析准备全 0 的结果数组.
+
+    Parameters
+    ----------
+    matrix : Matrix or SparseMatrix
+    cfg : AssignConfig
+    arc_num : int
+        网络的弧数.
+
+    Returns
+    -------
+    sel_flow : ndarray
+        ``sel_flow[k]`` 为使用第 `k` 条所选路段的 OD 流量, 只记录非零的
+        OD 单元格: `matrix` 为 `SparseMatrix` 时与其 `values` 对应, 为
+        `Matrix` 时与 ``np.flatnonzero(matrix.data)`` 对应.
+    zone_flow : ndarray
+        ``zone_flow[k]`` 为第 `k` 个所选小区出发的弧流量.
+    """
+    link_num = len(cfg.select_links) if cfg.select_links is not None else 0
+    zone_num = len(cfg.select_zones) if cfg.select_zones is not None else 0
+    if isinstance(matrix, tp.SparseMatrix):
+        nnz = matrix.nnz
+    else:
+        nnz = np.count_nonzero(matrix.data)
+    return (np.zeros((link_num, nnz), np.float64),
+            np.zeros((zone_num, arc_num), np.float64))
+
+
+def get_row_blocks(matrix, block_rows=0):
+    """把 OD 矩阵的行分块, 全有全无分配时逐块读入.
+
+    Parameters
+    ----------
+    matrix : Matrix
+    block_rows : int, optional
+        每块的行数, 见 ``AssignConfig.block_rows``. Default: 0.
+
+    Returns
+    -------
+    list of tuple
+        每块的起止行号 ``(start, stop)``.
+    """
+    rows, cols = matrix.shape
+    data = matrix.data
+    if block_rows <= 0:
+        if isinstance(data, np.memmap) or data.dtype != np.float64:
+            block_rows = max(BLOCK_BYTES // (8 * max(cols, 1)), 1)
+        else:
+            block_rows = max(rows, 1)
+    return [(start, min(start + block_rows, rows))
+            for start in range(0, rows, block_rows)]
+
+
+def get_od_idx(net, matrix):
+    """得到与 `net` 的编号类型一致的 OD 矩阵行列索引.
+
+    Parameters
+    ----------
+    net : Net
+    matrix : Matrix or SparseMatrix
+
+    Returns
+    -------
+    sources, targets : ndarray
+        ``matrix.row_idx`` 与 ``matrix.col_idx``, 类型为 ``net.id_type``.
+    """
+    sources = matrix.row_idx
+    targets = matrix.col_idx
+    none = net.none
+    if sources.max() >= none or targets.max() >= none:
+        raise OverflowError("Matrix's index out of net's ID range "
+                            "[1,{}).".format(none))
+    return (np.asarray(sources, net.id_type),
+            np.asarray(targets, net.id_type))
+
+
 def prepare_focus_nodes(net, focus_nodes):
     """为需要记录转向的交叉口准备相关数据."""
     data = net._data
+    id_type = net.id_type
     if focus_nodes is None or len(focus_nodes) == 0:
-        a = np.full((1, ), NONE, ID_TYPE)
+        a = np.full((1, ), net.none, id_type)
         b = a
         turns_flow = np.zeros((1, ), 'f8')
         return a, b, turns_flow
@@ -504,10 +1747,13 @@ def prepare_focus_nodes(net, focus_nodes):
         if focus_nodes == 'all':
             focus_nodes = np.unique(data['START_NODE'])
         else:
-            focus_nodes = np.array(focus_nodes, ID_TYPE, copy=False)
-        a = np.full(data.shape, NONE, ID_TYPE)
+            focus_nodes = np.array(focus_nodes, id_type, copy=False)
+        a = np.full(data.shape, net.none, id_type)
         b = a.copy()
         lines = _runtime_turn_idx(net, focus_nodes, a, b)
+        if lines >= net.none:
+            raise OverflowError('Too many turns ({}) at focus nodes for '
+                                '{}.'.format(lines, np.dtype(id_type)))
         turns_flow = np.zeros((lines,), np.float64)
         return a, b, turns_flow
 
@@ -524,27 +1770,28 @@ def _runtime_turn_idx(net, nodes, a, b):
 
     Returns
     -------
-    total_line : ID_TYPE
+    total_line : int
     """
     idx = net.idx
     r_idx = net.r_idx
     trace = net.trace
+    none = net.none
     a_line = 0
     total_line = 0
     for i in range(nodes.shape[0]):
         node = nodes[i]
 
         start_a = r_idx[node - 1]
-        if start_a == NONE:
+        if start_a == none:
             continue
         end_a = r_idx[node]
-        if end_a == NONE:
+        if end_a == none:
             continue
         start_b = idx[node - 1]
-        if start_b == NONE:
+        if start_b == none:
             continue
         end_b = idx[node]
-        if end_b == NONE:
+        if end_b == none:
             continue
 
         in_arc_num = end_a - start_a
@@ -584,7 +1831,8 @@ def net_to_table_mapping(net, link_table):
     net_id = net._data['ID']
     net_start = net._data['START_NODE']
     mapping = np.empty(len(link_table), dtype={'names': ['AB', 'BA'],
-                                               'formats': [ID_TYPE, ID_TYPE]})
+                                               'formats': [net.id_type,
+                                                           net.id_type]})
     ID_map = link_table.ID_map
     link_start = link_table['START_NODE']
     _dir = link_table['DIR']
@@ -621,14 +1869,15 @@ def _get_turn_data_from_runtime(net, a, b, turns_flow):
     _id = data['ID']
     end_node = data['END_NODE']
     idx = net.idx
+    id_type = net.id_type
     turn_data = np.zeros(turns_flow.shape,
                          dtype={'names': ['ID', 'FROM', 'TO', 'FLOW'],
-                                'formats': [ID_TYPE, ID_TYPE, ID_TYPE,
+                                'formats': [id_type, id_type, id_type,
                                             np.float64]})
     turn_data['FLOW'] = turns_flow
     for from_arc in range(a.shape[0]):
         from_stride = a[from_arc]
-        if from_stride != NONE:
+        if from_stride != net.none:
             from_link = _id[from_arc]
             node_id = end_node[from_arc]
             start_b = idx[node_id - 1]
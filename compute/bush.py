@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Zhanhong Cheng
+"""
+import numpy as np
+import transpy as tp
+from transpy.compute.assignment import AssignSummary, Counter, \
+    log_iteration, get_assign_param, prepare_focus_nodes, get_od_idx, \
+    bpr_fun, bpr_derivative, net_to_link_flow, full_param, WarmStart, \
+    _get_turn_data_from_runtime, _demand_scale, _cold_iterations
+from transpy.compute.shortest_way import get_sp_param
+from transpy.classes.convert import csr_offsets
+from transpy.compute.core import turn_dijikstra, ShortestPathWorkspace
+from transpy.compute.vdf import VDFGroups
+from transpy.compute.bush_core import BushKernel, transition_delay
+
+INF = np.inf
+
+
+def bush_equilibrium(net, matrix, link_table, cfg, passes=3,
+                     warm_start=None):
+    """基于 bush 的用户均衡分配 (Algorithm B).
+
+    每个起点保留一个无环的子网络 (bush), 每次迭代先向 bush 中加入能缩短
+    路径的弧, 再在 bush 内最长与最短的已用路径之间按牛顿法转移流量, 最后
+    删去无流量的弧. 与 `user_equilibrium` 相比收敛到很小的相对间隙要快得多.
+    由于考虑转向延误时一个节点可能被多条弧经过, bush 建立在弧之间的转向上.
+
+    Parameters
+    ----------
+    net : Net
+    matrix : Matrix
+        稠密的 OD 矩阵, 不支持 `SparseMatrix`.
+    link_table : IDTable
+    cfg : AssignConfig
+        使用其中的 `time_field`, `capacity_field`, `alpha_field`,
+        `beta_field`, `preload_field`, `turn_delay_type`, `focus_nodes`,
+        `convergence`, `max_iteration` 与 `print_frequency`. 路阻函数只能
+        是 BPR, 即 `cfg.vdf` 与 `cfg.arc_type_dict` 中的 'vdf' 均为 'bpr'.
+    passes : int, optional
+        每次迭代中每个 bush 转移流量的最多轮数. Default: 3.
+    warm_start : WarmStart, optional
+        由 `bush_equilibrium` 得到的结果. 需求是原来倍数的起点以按该倍数
+        缩放的原 bush 开始, 其余起点以最短路树开始. Default: `None`.
+
+    Returns
+    -------
+    flow_data : structured array
+        一个记录着分配结果的结构数组，它包括 `ID`, `AB_FLOW`, `BA_FLOW` 这几个域.
+    turn_data : structured array
+        一个记录着交叉口转向流量的结构数组，它包括 `ID`, `FROM`, `TO`, `FLOW` 这
+        几个域. 只有在 `cfg.focus_node` 中指明的交叉口才记录转向.
+    summary : AssignSummary
+        记录着分配迭代过程的结构, 没有步长, `step` 中记为 NAN. 相对间隙计
+        入了转向延误. `warm_start` 中保存了每个起点的 bush.
+
+    See Also
+    --------
+    user_equilibrium
+    """
+    # Basic setup
+    if not isinstance(matrix, tp.Matrix):
+        raise TypeError('bush_equilibrium needs a dense Matrix.')
+    summary = AssignSummary()
+    data = net._data
+    shape = data.shape
+    type_field = cfg.arc_type_field
+    type_dict = cfg.arc_type_dict
+    counter = Counter(cfg.print_frequency)
+
+    # Setup about BPR function parameters, the kernel needs full arrays.
+    def full(value):
+        return full_param(value, shape)
+
+    time0 = full(get_assign_param(data, cfg.time_field, type_field,
+                                  type_dict))
+    capacity = full(get_assign_param(data, cfg.capacity_field, type_field,
+                                     type_dict))
+    # The kernel moves flow by the times and derivatives of BPR.
+    if not VDFGroups(data, cfg, time0, capacity).single_bpr:
+        raise ValueError('bush_equilibrium supports only the BPR function.')
+    alpha = full(get_assign_param(data, cfg.alpha_field, type_field,
+                                  type_dict, cfg.global_alpha))
+    beta = full(get_assign_param(data, cfg.beta_field, type_field,
+                                 type_dict, cfg.global_beta))
+    if cfg.preload_field:
+        preload_flow = full(get_assign_param(data, cfg.preload_field,
+                                             type_field, type_dict))
+    else:
+        preload_flow = np.zeros(shape, np.float64)
+
+    arcs_flow = np.zeros(shape, np.float64)
+    time = np.empty(shape, np.float64)
+    der = np.empty(shape, np.float64)
+    bpr_fun(time0, alpha, beta, capacity, time, arcs_flow, preload_flow)
+
+    # Setup about shortest path and the bush kernel
+    flag, turn_idx, from_link, to_link, delay = \
+        get_sp_param(net, cfg.turn_delay_type)
+    sources, targets = get_od_idx(net, matrix)
+    workspace = ShortestPathWorkspace(net)
+    trans = get_transitions(net, flag, turn_idx, from_link, to_link, delay)
+    kernel = BushKernel(trans['node_start'], trans['end_node'],
+                        trans['t_off'], trans['t_head'], trans['t_tail'],
+                        trans['t_delay'], time0, alpha, beta, capacity,
+                        preload_flow, time, der, arcs_flow)
+    targets_p = np.asarray(targets, np.intp)
+    none = net.none
+
+    def shortest_path(source):
+        # Search all arcs, not only until every node is reached.
+        turn_dijikstra(net.idx, data['ID'], data['END_NODE'], time, flag,
+                       source, 0, INF, np.iinfo(np.intp).max, turn_idx,
+                       from_link, to_link, delay, workspace)
+        return workspace.result()
+
+    # Initial bushes are the shortest path trees at free flow, or the
+    # bushes of the warm start scaled to the demand of their origin.
+    if warm_start is None:
+        scales = np.full(sources.shape[0], np.nan)
+    elif warm_start.bushes is None:
+        raise ValueError('The warm start has no bushes.')
+    else:
+        scales = _demand_scale(warm_start.matrices[0], matrix, 1)
+        if scales is None:
+            scales = np.full(sources.shape[0], np.nan)
+    trans_num = trans['t_head'].shape[0]
+    arc_num = shape[0]
+    bushes = []
+    for i, source in enumerate(sources):
+        if not np.isnan(scales[i]):
+            links, flows = warm_start.bushes[i]
+            flows = flows * scales[i]
+            # Arcs flow is the flow of the links into the arcs.
+            into = links < trans_num
+            np.add.at(arcs_flow, trans['t_head'][links[into]], flows[into])
+            entry = links >= trans_num + arc_num
+            np.add.at(arcs_flow, links[entry] - trans_num - arc_num,
+                      flows[entry])
+            bushes.append((links, flows))
+            continue
+        dist, node_pred, arc_pred = shortest_path(source)
+        settled = workspace.settled[0, :workspace.counts[0, 2]]
+        links, flows, _ = kernel.init_origin(
+            source, np.asarray(settled, np.intp), _as_intp(arc_pred, none),
+            _as_intp(node_pred, none), targets_p, matrix._data[i])
+        bushes.append((links, flows))
+    bpr_fun(time0, alpha, beta, capacity, time, arcs_flow, preload_flow)
+    bpr_derivative(time0, alpha, beta, capacity, der, arcs_flow,
+                   preload_flow)
+
+    # Main loop
+    for i in range(1, cfg.max_iteration):
+        last_flow = arcs_flow.copy()
+        turn_cost = 0
+        for j, source in enumerate(sources):
+            links, flows, cost = kernel.equilibrate(source, bushes[j][0],
+                                                    bushes[j][1], passes)
+            bushes[j] = (links, flows)
+            turn_cost += cost
+        summary.step.append(np.nan)
+
+        # Max Flow Change
+        max_flow_change = np.abs(arcs_flow - last_flow).max()
+        summary.max_flow_change.append(max_flow_change)
+
+        # Relative Gap, the shortest paths are searched with current time.
+        sptt = 0
+        for j, source in enumerate(sources):
+            dist, node_pred, _ = shortest_path(source)
+            pred = node_pred[targets]
+            reached = (pred != none) & (targets != source)
+            sptt += np.sum(matrix._data[j][reached] * dist[pred[reached]])
+        tstt = np.sum(time * arcs_flow) + turn_cost
+        relative_gap = 1 - sptt / tstt
+        summary.relative_gap.append(relative_gap)
+
+        # whether to log
+        if counter.add():
+            log_iteration(i, relative_gap, max_flow_change)
+
+        # Check convergence
+        if relative_gap <= cfg.convergence:
+            summary.equilibrium_reached = True
+            break
+
+    # Turns flow at focus nodes
+    a, b, turns_flow = prepare_focus_nodes(net, cfg.focus_nodes)
+    if a.shape[0] != 1:
+        t_tail, t_head = trans['t_tail'], trans['t_head']
+        trans_num = t_head.shape[0]
+        for links, flows in bushes:
+            turns = links < trans_num
+            tail = t_tail[links[turns]]
+            head = t_head[links[turns]]
+            focus = a[tail] != none
+            np.add.at(turns_flow,
+                      a[tail[focus]].astype(np.intp) + b[head[focus]],
+                      flows[turns][focus])
+
+    flow_data = net_to_link_flow(link_table, net, arcs_flow)
+    turn_data = _get_turn_data_from_runtime(net, a, b, turns_flow)
+    summary.warm_start = WarmStart([matrix], [arcs_flow], [turns_flow],
+                                   _cold_iterations(summary, warm_start),
+                                   bushes=bushes)
+
+    return flow_data, turn_data, summary
+
+
+def get_transitions(net, flag, turn_idx, from_link, to_link, delay):
+    """计算弧与弧之间的转向 (transition), 供 `BushKernel` 使用.
+
+    弧 `a` 之后可以连接其终点的所有出弧, 这些转向的编号为
+    ``t_off[a]:t_off[a + 1]``.
+
+    Parameters
+    ----------
+    net : Net
+    flag, turn_idx, from_link, to_link, delay : ndarray
+        由 `get_sp_param` 得到的转向参数.
+
+    Returns
+    -------
+    dict
+        包括 `node_start`, `end_node`, `t_off`, `t_head`, `t_tail` 与
+        `t_delay`, 整数数组均为 ``np.intp`` 类型.
+    """
+    data = net._data
+    start_node = np.asarray(data['START_NODE'], np.intp)
+    end_node = np.asarray(data['END_NODE'], np.intp)
+    node_num = max(start_node.max(), end_node.max()) + 1
+    # Arcs of node n are node_start[n]:node_start[n + 1].
+    node_start = csr_offsets(start_node, node_num)
+
+    out_num = node_start[end_node + 1] - node_start[end_node]
+    t_off = np.zeros(end_node.shape[0] + 1, np.intp)
+    np.cumsum(out_num, out=t_off[1:])
+    t_tail = np.repeat(np.arange(end_node.shape[0], dtype=np.intp), out_num)
+    t_head = (node_start[end_node[t_tail]] +
+              np.arange(t_off[-1], dtype=np.intp) - t_off[t_tail])
+
+    t_delay = np.empty(t_head.shape, np.float64)
+    transition_delay(node_start, np.asarray(data['ID'], np.intp), end_node,
+                     flag, np.asarray(turn_idx, np.intp),
+                     np.asarray(from_link, np.intp),
+                     np.asarray(to_link, np.intp), delay, t_off, t_delay)
+    return {'node_start': node_start, 'end_node': end_node, 't_off': t_off,
+            't_head': t_head, 't_tail': t_tail, 't_delay': t_delay}
+
+
+def _as_intp(arr, none):
+    """Cast an index array to ``np.intp`` with -1 as NONE."""
+    out = np.asarray(arr, np.intp)
+    out[arr == none] = -1
+    return out
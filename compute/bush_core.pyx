@@ -0,0 +1,595 @@
+# -*- python -*-
+"""Bush-based user equilibrium kernels written in Cython.
+
+A bush is the acyclic sub-graph used by the flow of one origin. With turning
+delay a node may be passed through by several arcs, so like
+``core.turn_dijikstra`` a bush is built over arcs: its vertices are the arcs
+(row numbers of ``Net._data``) and its links are the transitions between
+consecutive arcs. Link ids are numbered as follow, `T` is the number of
+transitions and `A` the number of arcs:
+
+    * ``0 <= l < T``: transition from arc ``t_tail[l]`` to arc ``t_head[l]``.
+    * ``T <= l < T + A``: exit link from arc ``l - T`` to the destination it
+      ends at.
+    * ``T + A <= l < T + 2A``: entry link from the origin to arc
+      ``l - T - A``.
+
+Vertex ``A`` is the origin (root), vertex ``A + 1 + n`` is the destination
+node `n`.
+
+Author: Zhanhong Cheng
+"""
+import numpy as np
+
+cimport numpy as np
+cimport cython
+from libc.math cimport pow
+
+ctypedef np.float64_t DTYPE_t
+ctypedef np.uint8_t UTYPE8_t
+
+cdef DTYPE_t INF = np.inf
+
+
+cdef class BushKernel:
+    """Equilibrate the bushes of a net one origin after another.
+
+    The arcs flow, time and time derivative arrays are shared with the
+    caller and updated in place whenever flow is shifted, so every origin
+    sees the costs left by the previous one.
+
+    Parameters
+    ----------
+    node_start : ndarray
+        Arcs of node `n` are ``node_start[n]:node_start[n + 1]``.
+    end_node : ndarray
+        A field of Net, ``Net['END_NODE']``.
+    t_off : ndarray
+        Transitions from arc `a` are ``t_off[a]:t_off[a + 1]``.
+    t_head, t_tail : ndarray
+        The arc after and before each transition.
+    t_delay : ndarray
+        Turning delay of each transition, INF or NAN if banned.
+    time0, alpha, beta, capacity, preload : ndarray
+        Parameters of the BPR function, see `bpr_fun`.
+    time, der, arcs_flow : ndarray
+        Arcs time, derivative of time and total arcs flow, updated in place.
+
+    All index arrays are of type ``np.intp``.
+    """
+    cdef Py_ssize_t arc_num, trans_num, root
+    cdef Py_ssize_t[::1] node_start, end_node, t_off, t_head, t_tail
+    cdef DTYPE_t[::1] t_delay, time0, alpha, beta, capacity, preload
+    cdef DTYPE_t[::1] time, der, arcs_flow
+    # Work arrays, valid for the origin in hand only.
+    cdef UTYPE8_t[::1] in_bush
+    cdef DTYPE_t[::1] flow, lab_min, lab_max
+    cdef Py_ssize_t[::1] pred_min, pred_max, indeg, order, pos, stamp
+    cdef Py_ssize_t[::1] links, seg_min, seg_max
+    cdef Py_ssize_t n_order, n_links, generation, o_start, o_end
+
+    def __init__(self, node_start, end_node, t_off, t_head, t_tail, t_delay,
+                 time0, alpha, beta, capacity, preload, time, der,
+                 arcs_flow):
+        self.node_start = node_start
+        self.end_node = end_node
+        self.t_off = t_off
+        self.t_head = t_head
+        self.t_tail = t_tail
+        self.t_delay = t_delay
+        self.time0 = time0
+        self.alpha = alpha
+        self.beta = beta
+        self.capacity = capacity
+        self.preload = preload
+        self.time = time
+        self.der = der
+        self.arcs_flow = arcs_flow
+
+        self.arc_num = end_node.shape[0]
+        self.trans_num = t_head.shape[0]
+        self.root = self.arc_num
+        vertex_num = self.arc_num + 1 + node_start.shape[0]
+        link_num = self.trans_num + 2 * self.arc_num
+        self.in_bush = np.zeros(link_num, np.uint8)
+        self.flow = np.zeros(link_num, np.float64)
+        self.links = np.empty(link_num, np.intp)
+        self.lab_min = np.empty(vertex_num, np.float64)
+        self.lab_max = np.empty(vertex_num, np.float64)
+        self.pred_min = np.empty(vertex_num, np.intp)
+        self.pred_max = np.empty(vertex_num, np.intp)
+        self.indeg = np.empty(vertex_num, np.intp)
+        self.order = np.empty(vertex_num, np.intp)
+        self.pos = np.empty(vertex_num, np.intp)
+        self.stamp = np.zeros(vertex_num, np.intp)
+        self.seg_min = np.empty(vertex_num, np.intp)
+        self.seg_max = np.empty(vertex_num, np.intp)
+        self.generation = 0
+        self.n_links = 0
+        self.n_order = 0
+
+    @property
+    def nbytes(self):
+        """Total bytes of the work arrays."""
+        cdef Py_ssize_t link_num = self.in_bush.shape[0]
+        cdef Py_ssize_t vertex_num = self.lab_min.shape[0]
+        # in_bush, flow and links; lab_min, lab_max and 8 index arrays.
+        return (link_num * (sizeof(UTYPE8_t) + sizeof(DTYPE_t) +
+                            sizeof(Py_ssize_t)) +
+                vertex_num * (2 * sizeof(DTYPE_t) + 8 * sizeof(Py_ssize_t)))
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef inline Py_ssize_t _head(self, Py_ssize_t l):
+        if l < self.trans_num:
+            return self.t_head[l]
+        l -= self.trans_num
+        if l < self.arc_num:
+            return self.arc_num + 1 + self.end_node[l]
+        return l - self.arc_num
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef inline Py_ssize_t _tail(self, Py_ssize_t l):
+        if l < self.trans_num:
+            return self.t_tail[l]
+        l -= self.trans_num
+        if l < self.arc_num:
+            return l
+        return self.root
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef inline DTYPE_t _link_delay(self, Py_ssize_t l):
+        if l < self.trans_num:
+            return self.t_delay[l]
+        return 0
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef inline DTYPE_t _vertex_time(self, Py_ssize_t v):
+        if v < self.arc_num:
+            return self.time[v]
+        return 0
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef inline void _out_links(self, Py_ssize_t v, Py_ssize_t *lo,
+                                Py_ssize_t *hi, Py_ssize_t *extra):
+        """Out links of `v` are ``lo:hi`` and `extra` if not -1."""
+        if v == self.root:
+            lo[0] = self.trans_num + self.arc_num + self.o_start
+            hi[0] = self.trans_num + self.arc_num + self.o_end
+            extra[0] = -1
+        elif v < self.arc_num:
+            lo[0] = self.t_off[v]
+            hi[0] = self.t_off[v + 1]
+            extra[0] = self.trans_num + v
+        else:
+            lo[0] = hi[0] = 0
+            extra[0] = -1
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef inline void _update_cost(self, Py_ssize_t a):
+        """Update time and derivative of arc `a` by the BPR function."""
+        cdef DTYPE_t ratio = self.arcs_flow[a] + self.preload[a]
+        if ratio < 0:
+            ratio = 0
+        ratio /= self.capacity[a]
+        self.time[a] = self.time0[a] * (1 + self.alpha[a] *
+                                        pow(ratio, self.beta[a]))
+        self.der[a] = (self.time0[a] * self.alpha[a] * self.beta[a] *
+                       pow(ratio, self.beta[a] - 1) / self.capacity[a])
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef inline void _add(self, Py_ssize_t l):
+        self.in_bush[l] = 1
+        self.flow[l] = 0
+        self.links[self.n_links] = l
+        self.n_links += 1
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef bint _topo(self):
+        """Topological order of the bush vertices, by Kahn's algorithm.
+
+        Return False if the bush has a cycle."""
+        cdef Py_ssize_t k, l, v, h, q = 0, n = 1, lo, hi, extra, m = 1
+        self.generation += 1
+        for k in range(self.n_links):
+            h = self._head(self.links[k])
+            if self.stamp[h] != self.generation:
+                self.stamp[h] = self.generation
+                self.indeg[h] = 0
+                m += 1
+            self.indeg[h] += 1
+        self.stamp[self.root] = self.generation
+        self.order[0] = self.root
+        while q < n:
+            v = self.order[q]
+            self.pos[v] = q
+            q += 1
+            self._out_links(v, &lo, &hi, &extra)
+            for k in range(lo, hi + (extra >= 0)):
+                l = k if k < hi else extra
+                if not self.in_bush[l]:
+                    continue
+                h = self._head(l)
+                self.indeg[h] -= 1
+                if self.indeg[h] == 0:
+                    self.order[n] = h
+                    n += 1
+        self.n_order = n
+        return n == m
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _labels(self, bint used_only):
+        """Shortest and longest distance from the origin to each vertex.
+
+        The shortest distance is over all bush links, the longest distance
+        is over the links with flow if `used_only`, else over all links.
+        """
+        cdef Py_ssize_t k, l, v, h, q, lo, hi, extra
+        cdef DTYPE_t c
+        for q in range(self.n_order):
+            v = self.order[q]
+            self.lab_min[v] = INF
+            self.lab_max[v] = -INF
+            self.pred_min[v] = -1
+            self.pred_max[v] = -1
+        self.lab_min[self.root] = 0
+        self.lab_max[self.root] = 0
+        for q in range(self.n_order):
+            v = self.order[q]
+            self._out_links(v, &lo, &hi, &extra)
+            for k in range(lo, hi + (extra >= 0)):
+                l = k if k < hi else extra
+                if not self.in_bush[l]:
+                    continue
+                h = self._head(l)
+                c = self._link_delay(l) + self._vertex_time(h)
+                if self.lab_min[v] + c < self.lab_min[h]:
+                    self.lab_min[h] = self.lab_min[v] + c
+                    self.pred_min[h] = l
+                if used_only and self.flow[l] <= 0:
+                    continue
+                if self.lab_max[v] + c > self.lab_max[h]:
+                    self.lab_max[h] = self.lab_max[v] + c
+                    self.pred_max[h] = l
+        if used_only:
+            # Vertices without used path take the shortest distance.
+            for q in range(self.n_order):
+                v = self.order[q]
+                if self.pred_max[v] < 0:
+                    self.lab_max[v] = self.lab_min[v]
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _add_links(self, bint strict):
+        """Add the links which shorten the distance of their head.
+
+        A link from `v` to `h` is added if the longest distance of `v` plus
+        its cost is less than that of `h`. The longest distances are over
+        the used links unless `strict`, so that the bush may get a cycle.
+        If `strict`, the labels should be over all links, then the links
+        shortening the shortest distance of `h` are added too if the longest
+        distance of `v` is less than that of `h`. As the longest distance
+        strictly increases along every bush link, the bush stays acyclic.
+        """
+        cdef Py_ssize_t l, v, q
+        for q in range(self.n_order):
+            v = self.order[q]
+            if v == self.root:
+                for l in range(self.trans_num + self.arc_num + self.o_start,
+                               self.trans_num + self.arc_num + self.o_end):
+                    if not self.in_bush[l] and self._better(l, strict):
+                        self._add(l)
+            elif v < self.arc_num:
+                for l in range(self.t_off[v], self.t_off[v + 1]):
+                    if not self.in_bush[l] and self._better(l, strict):
+                        self._add(l)
+                l = self.trans_num + v
+                if not self.in_bush[l] and self._better(l, strict):
+                    self._add(l)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef inline bint _better(self, Py_ssize_t l, bint strict):
+        """Whether link `l` should be added to the bush."""
+        cdef Py_ssize_t v = self._tail(l), h = self._head(l)
+        cdef DTYPE_t c = self._link_delay(l) + self._vertex_time(h)
+        if self.stamp[h] != self.generation:
+            # `h` is not in the bush yet.
+            return c < INF
+        if self.lab_max[v] + c < self.lab_max[h]:
+            return True
+        return (strict and self.lab_max[v] < self.lab_max[h] and
+                self.lab_min[v] + c < self.lab_min[h])
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _expand(self):
+        """Add links to the bush, see `_add_links`."""
+        cdef Py_ssize_t k, n = self.n_links
+        self._topo()
+        self._labels(True)
+        self._add_links(False)
+        if self._topo():
+            return
+        # Got a cycle, add links in the strict way instead.
+        for k in range(n, self.n_links):
+            self.in_bush[self.links[k]] = 0
+        self.n_links = n
+        self._topo()
+        self._labels(False)
+        self._add_links(True)
+        self._topo()
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef DTYPE_t _shift(self):
+        """Shift flow from the longest to the shortest used path of each
+        vertex, in reverse topological order. Return the total shifted."""
+        cdef Py_ssize_t k, l, v, h, q, a, b, n_min, n_max
+        cdef DTYPE_t c_min, c_max, d_min, d_max, f_max, dx, shifted = 0
+        for q in range(self.n_order - 1, 0, -1):
+            v = self.order[q]
+            if self.pred_max[v] < 0 or self.pred_max[v] == self.pred_min[v]:
+                continue
+            if self.lab_max[v] <= self.lab_min[v]:
+                continue
+
+            # Trace both paths back to where they diverge.
+            self.seg_min[0] = self.pred_min[v]
+            self.seg_max[0] = self.pred_max[v]
+            n_min = n_max = 1
+            a = self._tail(self.seg_min[0])
+            b = self._tail(self.seg_max[0])
+            while a != b:
+                if self.pos[a] > self.pos[b]:
+                    l = self.pred_min[a]
+                    if l < 0:
+                        break
+                    self.seg_min[n_min] = l
+                    n_min += 1
+                    a = self._tail(l)
+                else:
+                    # No used link into `b` if its flow was rounded off.
+                    l = self.pred_max[b]
+                    if l < 0:
+                        break
+                    self.seg_max[n_max] = l
+                    n_max += 1
+                    b = self._tail(l)
+            if a != b:
+                continue
+
+            # Cost and derivative of both segments, `v` itself excluded.
+            c_min = d_min = 0
+            for k in range(n_min):
+                l = self.seg_min[k]
+                c_min += self._link_delay(l)
+                if k > 0:
+                    h = self._head(l)
+                    c_min += self.time[h]
+                    d_min += self.der[h]
+            c_max = d_max = 0
+            f_max = INF
+            for k in range(n_max):
+                l = self.seg_max[k]
+                c_max += self._link_delay(l)
+                if self.flow[l] < f_max:
+                    f_max = self.flow[l]
+                if k > 0:
+                    h = self._head(l)
+                    c_max += self.time[h]
+                    d_max += self.der[h]
+            if c_max <= c_min or f_max <= 0:
+                continue
+
+            # Newton step, no more than the flow on the longest path.
+            if d_min + d_max > 0:
+                dx = (c_max - c_min) / (d_min + d_max)
+                if dx > f_max:
+                    dx = f_max
+            else:
+                dx = f_max
+            for k in range(n_max):
+                l = self.seg_max[k]
+                self.flow[l] -= dx
+                if self.flow[l] < 0:
+                    self.flow[l] = 0
+                if k > 0:
+                    h = self._head(l)
+                    self.arcs_flow[h] -= dx
+                    self._update_cost(h)
+            for k in range(n_min):
+                l = self.seg_min[k]
+                self.flow[l] += dx
+                if k > 0:
+                    h = self._head(l)
+                    self.arcs_flow[h] += dx
+                    self._update_cost(h)
+            shifted += dx
+        return shifted
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _remove_unused(self):
+        """Remove links without flow, except those on the shortest paths."""
+        cdef Py_ssize_t k, l, n = 0
+        for k in range(self.n_links):
+            l = self.links[k]
+            if self.flow[l] <= 0 and self.pred_min[self._head(l)] != l:
+                self.in_bush[l] = 0
+            else:
+                self.links[n] = l
+                n += 1
+        self.n_links = n
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef _gather(self):
+        """Return the bush in compact arrays and clean the work arrays."""
+        cdef Py_ssize_t k, l
+        cdef DTYPE_t turn_cost = 0
+        links = np.empty(self.n_links, np.intp)
+        flows = np.empty(self.n_links, np.float64)
+        cdef Py_ssize_t[::1] links_v = links
+        cdef DTYPE_t[::1] flows_v = flows
+        for k in range(self.n_links):
+            l = self.links[k]
+            links_v[k] = l
+            flows_v[k] = self.flow[l]
+            if l < self.trans_num and self.flow[l] > 0:
+                turn_cost += self.flow[l] * self.t_delay[l]
+            self.in_bush[l] = 0
+            self.flow[l] = 0
+        self.n_links = 0
+        return links, flows, turn_cost
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def init_origin(self, Py_ssize_t origin, Py_ssize_t[::1] settled,
+                    Py_ssize_t[::1] arc_pred, Py_ssize_t[::1] node_pred,
+                    Py_ssize_t[::1] targets, DTYPE_t[:] demand):
+        """Build the initial bush of `origin` from its shortest path tree.
+
+        Parameters
+        ----------
+        origin : int
+            The origin node's ID.
+        settled : ndarray
+            Arcs settled by the shortest path search, in order.
+        arc_pred, node_pred : ndarray
+            Results of the search, -1 as NONE.
+        targets : ndarray
+            Destination nodes' ID.
+        demand : ndarray
+            Demand from `origin` to each of `targets`.
+
+        Returns
+        -------
+        links, flows : ndarray
+            The bush's links and their flow.
+        turn_cost : float
+            Total turning delay of the bush's flow.
+        """
+        cdef Py_ssize_t k, a, p, l, d
+        cdef DTYPE_t f
+        cdef DTYPE_t[::1] load = self.lab_max
+        cdef Py_ssize_t[::1] link_in = self.pred_min
+        for k in range(settled.shape[0]):
+            a = settled[k]
+            p = arc_pred[a]
+            if p < 0:
+                l = self.trans_num + self.arc_num + a
+            else:
+                l = self.t_off[p] + a - self.node_start[self.end_node[p]]
+            self._add(l)
+            link_in[a] = l
+            load[a] = 0
+
+        for k in range(targets.shape[0]):
+            d = targets[k]
+            if d == origin or not demand[k] > 0:
+                continue
+            a = node_pred[d]
+            if a < 0:
+                continue
+            l = self.trans_num + a
+            if not self.in_bush[l]:
+                self._add(l)
+            self.flow[l] += demand[k]
+            load[a] += demand[k]
+
+        # Load the tree in reverse settle order.
+        for k in range(settled.shape[0] - 1, -1, -1):
+            a = settled[k]
+            f = load[a]
+            if f == 0:
+                continue
+            self.flow[link_in[a]] += f
+            self.arcs_flow[a] += f
+            p = arc_pred[a]
+            if p >= 0:
+                load[p] += f
+        return self._gather()
+
+    def equilibrate(self, Py_ssize_t origin, Py_ssize_t[::1] links,
+                    DTYPE_t[::1] flows, int passes):
+        """Update and equilibrate the bush of `origin`.
+
+        Links shortening the bush are added first, then `passes` rounds of
+        flow shifting are made, finally links without flow are removed.
+
+        Parameters
+        ----------
+        origin : int
+            The origin node's ID.
+        links, flows : ndarray
+            The bush's links and their flow.
+        passes : int
+            Rounds of flow shifting.
+
+        Returns
+        -------
+        links, flows : ndarray
+            The updated bush.
+        turn_cost : float
+            Total turning delay of the bush's flow.
+        """
+        cdef Py_ssize_t k, p
+        self.o_start = self.node_start[origin]
+        self.o_end = self.node_start[origin + 1]
+        for k in range(links.shape[0]):
+            self._add(links[k])
+            self.flow[links[k]] = flows[k]
+
+        self._expand()
+        for p in range(passes):
+            self._labels(True)
+            if self._shift() == 0:
+                break
+        self._remove_unused()
+        return self._gather()
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def transition_delay(Py_ssize_t[::1] node_start,
+                     Py_ssize_t[::1] ID,
+                     Py_ssize_t[::1] end_node,
+                     UTYPE8_t[:] flag,
+                     Py_ssize_t[::1] turn_idx,
+                     Py_ssize_t[::1] from_link,
+                     Py_ssize_t[::1] to_link,
+                     DTYPE_t[:] delay,
+                     Py_ssize_t[::1] t_off,
+                     DTYPE_t[::1] t_delay):
+    """Fill the turning delay of each transition into `t_delay`.
+
+    The turn table is scanned the same way as ``core.turn_dijikstra`` does,
+    see there for the meaning of the parameters.
+    """
+    cdef Py_ssize_t i, l, line, c_node
+    cdef Py_ssize_t max_turn_line = from_link.shape[0] - 1
+    cdef UTYPE8_t c_flag
+    for i in range(end_node.shape[0]):
+        c_flag = flag[i]
+        c_node = end_node[i]
+        if not c_flag:
+            for l in range(t_off[i], t_off[i + 1]):
+                t_delay[l] = 0
+            continue
+        line = turn_idx[c_node] - c_flag
+        for l in range(node_start[c_node], node_start[c_node + 1]):
+            if from_link[line] != ID[i] or to_link[line] != ID[l]:
+                t_delay[t_off[i] + l - node_start[c_node]] = 0
+            else:
+                t_delay[t_off[i] + l - node_start[c_node]] = delay[line]
+                if line < max_turn_line:
+                    line += 1
@@ -1,17 +1,30 @@
 # -*- python -*-
 """Fast network analyze algorithm written in Cython.
 
-Main interface includes ``turn_dijikstra``, ``c_all_or_nothing`` and 
-``c_single_all_or_nothing``
+Main interface includes ``turn_dijikstra``, ``c_all_or_nothing``,
+``c_sparse_all_or_nothing`` and ``c_single_all_or_nothing``, all of them
+search with the work arrays of a ``ShortestPathWorkspace``, which are
+allocated once per net and reused.
+
+All ID and index arrays passed to one call (``idx``, ``ID``, ``end_node``,
+the turn table arrays, ``a``, ``b``, sources, targets and the workspace)
+must share the same type, either uint16 or uint32 (``Net.id_type``).
+The maximum of that type is used as NONE.
+
+The kernels run without the GIL, so ``c_all_or_nothing`` can spread the
+origins over OpenMP threads when the module is built with OpenMP.
+
+``bpr_update`` and ``bpr_line_search`` evaluate the BPR function and the
+line search of Frank-Wolfe, each step in one pass over the arc arrays.
 
 Author: Zhanhong Cheng 2016
 """
-from transpy.compute.heap import FastUpdateBinaryHeap
 import numpy as np
 
 cimport numpy as np
 cimport cython
-from transpy.compute.heap cimport FastUpdateBinaryHeap
+from cython.parallel cimport prange, threadid
+from libc.math cimport isfinite, fabs, pow
 
 DTYPE = np.float64
 ctypedef np.float64_t DTYPE_t
@@ -19,36 +32,140 @@ ctypedef np.float64_t DTYPE_t
 ITYPE = np.int32
 ctypedef np.int32_t ITYPE_t
 
-# currently ID is uint16
+# ID and index width is chosen when a Net is built, uint16 or uint32.
 UTYPE16 = np.uint16
 ctypedef np.uint16_t UTYPE16_t
 
+UTYPE32 = np.uint32
+ctypedef np.uint32_t UTYPE32_t
+
+ctypedef fused UTYPE_t:
+    UTYPE16_t
+    UTYPE32_t
+
 UTYPE8 = np.uint8
 ctypedef np.uint8_t UTYPE8_t
 
-cdef UTYPE16_t NONE = 65535
 cdef DTYPE_t INF = np.inf
 
+
+# An indexed binary min-heap working on plain arrays, so that each thread
+# can own one and use it without the GIL. `h_pos` maps an arc's row number
+# to its position in the heap, NONE if the arc is not in the heap.
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef void _turn_dijikstra(np.ndarray[UTYPE16_t, ndim=1] idx, 
-                     np.ndarray[UTYPE16_t, ndim=1] ID, 
-                     np.ndarray[UTYPE16_t, ndim=1] end_node, 
-                     np.ndarray[DTYPE_t, ndim=1] weight, 
-                     np.ndarray[UTYPE8_t, ndim=1] flag, 
-                     UTYPE16_t source, 
-                     UTYPE16_t target,
-                     float max_dist,
-                     UTYPE16_t max_node,
-                     np.ndarray[UTYPE16_t, ndim=1] turn_idx,
-                     np.ndarray[UTYPE16_t, ndim=1] from_link,
-                     np.ndarray[UTYPE16_t, ndim=1] to_link,
-                     np.ndarray[DTYPE_t, ndim=1] delay, 
-                     np.ndarray[DTYPE_t, ndim=1] dist, 
-                     np.ndarray[UTYPE16_t, ndim=1] node_pred, 
-                     np.ndarray[UTYPE16_t, ndim=1] arc_pred):
+cdef inline void _heap_sift_up(DTYPE_t[:, ::1] h_val, UTYPE_t[:, ::1] h_ref,
+                               UTYPE_t[:, ::1] h_pos, Py_ssize_t t,
+                               Py_ssize_t i) nogil:
+    cdef DTYPE_t value = h_val[t, i]
+    cdef UTYPE_t ref = h_ref[t, i]
+    cdef Py_ssize_t parent
+    while i > 0:
+        parent = (i - 1) >> 1
+        if h_val[t, parent] <= value:
+            break
+        h_val[t, i] = h_val[t, parent]
+        h_ref[t, i] = h_ref[t, parent]
+        h_pos[t, h_ref[t, i]] = i
+        i = parent
+    h_val[t, i] = value
+    h_ref[t, i] = ref
+    h_pos[t, ref] = i
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void _heap_push_if_lower(DTYPE_t[:, ::1] h_val,
+                                     UTYPE_t[:, ::1] h_ref,
+                                     UTYPE_t[:, ::1] h_pos, Py_ssize_t t,
+                                     Py_ssize_t *count, DTYPE_t value,
+                                     UTYPE_t ref) nogil:
+    cdef UTYPE_t NONE = <UTYPE_t> -1
+    cdef Py_ssize_t i = h_pos[t, ref]
+    if h_pos[t, ref] == NONE:
+        i = count[0]
+        count[0] += 1
+    elif value >= h_val[t, i]:
+        return
+    h_val[t, i] = value
+    h_ref[t, i] = ref
+    _heap_sift_up(h_val, h_ref, h_pos, t, i)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline UTYPE_t _heap_pop(DTYPE_t[:, ::1] h_val, UTYPE_t[:, ::1] h_ref,
+                              UTYPE_t[:, ::1] h_pos, Py_ssize_t t,
+                              Py_ssize_t *count, DTYPE_t *value) nogil:
+    cdef UTYPE_t NONE = <UTYPE_t> -1
+    cdef UTYPE_t ref = h_ref[t, 0], last_ref
+    cdef DTYPE_t last_val
+    cdef Py_ssize_t i = 0, child, n
+    value[0] = h_val[t, 0]
+    h_pos[t, ref] = NONE
+    count[0] -= 1
+    n = count[0]
+    if n == 0:
+        return ref
+    last_val = h_val[t, n]
+    last_ref = h_ref[t, n]
+    child = 1
+    while child < n:
+        if child + 1 < n and h_val[t, child + 1] < h_val[t, child]:
+            child += 1
+        if last_val <= h_val[t, child]:
+            break
+        h_val[t, i] = h_val[t, child]
+        h_ref[t, i] = h_ref[t, child]
+        h_pos[t, h_ref[t, i]] = i
+        i = child
+        child = 2 * i + 1
+    h_val[t, i] = last_val
+    h_ref[t, i] = last_ref
+    h_pos[t, last_ref] = i
+    return ref
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _turn_dijikstra(UTYPE_t[:] idx,
+                          UTYPE_t[:] ID,
+                          UTYPE_t[:] end_node,
+                          DTYPE_t[:] weight,
+                          UTYPE8_t[:] flag,
+                          UTYPE_t source,
+                          UTYPE_t target,
+                          DTYPE_t max_dist,
+                          Py_ssize_t max_node,
+                          UTYPE_t[:] turn_idx,
+                          UTYPE_t[:] from_link,
+                          UTYPE_t[:] to_link,
+                          DTYPE_t[:] delay,
+                          Py_ssize_t t,
+                          DTYPE_t[:, ::1] dist,
+                          UTYPE_t[:, ::1] node_pred,
+                          UTYPE_t[:, ::1] arc_pred,
+                          UTYPE8_t[:, ::1] marker,
+                          DTYPE_t[:, ::1] h_val,
+                          UTYPE_t[:, ::1] h_ref,
+                          UTYPE_t[:, ::1] h_pos,
+                          UTYPE_t[:, ::1] touched_arc,
+                          UTYPE_t[:, ::1] touched_node,
+                          UTYPE_t[:, ::1] settled,
+                          Py_ssize_t[:, ::1] counts,
+                          UTYPE8_t[:, ::1] is_dest,
+                          Py_ssize_t dest_num) nogil:
     """The inner c-method for Dijkstra algorithm with turning delay.
 
+    Row `t` of the 2d work arrays (see `ShortestPathWorkspace`) belongs to
+    the calling thread. Entries written by the previous search of this row
+    are reset first, the arcs and nodes labeled by this search are recorded
+    in `touched_arc` and `touched_node`, and the arcs popped from the heap
+    are recorded in `settled` in order. `h_pos` is cleaned up before return.
+
+    If `dest_num` is positive, the search stops once `dest_num` nodes with
+    non-zero ``is_dest[t]`` are settled, `is_dest` is not changed.
+
     Parameters see `turn_dijikstra`
 
     See Also
@@ -56,45 +173,52 @@ cdef void _turn_dijikstra(np.ndarray[UTYPE16_t, ndim=1] idx,
     turn_dijikstra
     """
     cdef DTYPE_t n_dist, c_dist = 0
-    cdef UTYPE16_t c_node, n_node, l, start_l, end_l, c_link, n_link, c_line, count
-    cdef UTYPE16_t line, max_turn_line = from_link.shape[0] - 1
+    cdef UTYPE_t c_node, n_node, l, start_l, end_l, c_link, n_link, c_line
+    cdef UTYPE_t line, max_turn_line = from_link.shape[0] - 1
+    cdef UTYPE_t NONE = <UTYPE_t> -1
     cdef UTYPE8_t c_flag
-    cdef FastUpdateBinaryHeap costs_heap = FastUpdateBinaryHeap(
-                            initial_capacity=128, max_reference=dist.shape[0])
-    cdef np.ndarray[UTYPE8_t, ndim=1] marker = np.zeros(node_pred.shape[0], np.uint8)
-    
+    cdef Py_ssize_t count, heap_count = 0
+
+    _reset_search(t, dist, node_pred, arc_pred, marker, touched_arc,
+                  touched_node, counts)
 
-    if max_node == 0:
-        max_node = set(end_node).__len__()
     # If change algorithm to no-marker version, count = 0;
     count = 1
     start_l = idx[source - 1]
     end_l = idx[source]
-    marker[source] = 1
+    marker[t, source] = 1
+    _touch(touched_node, counts, t, 1, source)
     for l in range(start_l, end_l):
         n_dist = weight[l]
-        if np.isfinite(n_dist):  # To prevent nan or inf push into heap
-            dist[l] = n_dist
-            costs_heap.push_fast(n_dist, l)
+        if isfinite(n_dist):  # To prevent nan or inf push into heap
+            _touch(touched_arc, counts, t, 0, l)
+            dist[t, l] = n_dist
+            _heap_push_if_lower(h_val, h_ref, h_pos, t, &heap_count,
+                                n_dist, l)
+
+    while heap_count != 0:
 
-    while costs_heap.count != 0:
-        
         if count >= max_node:
-            return
-        
-        c_dist = costs_heap.pop_fast()
-        c_line = costs_heap._popped_ref
+            break
+
+        c_line = _heap_pop(h_val, h_ref, h_pos, t, &heap_count, &c_dist)
         if c_dist >= max_dist:
-            return
+            break
+        _touch(settled, counts, t, 2, c_line)
 
         c_node = end_node[c_line]
         # second time reach this node will not be counted
-        if node_pred[c_node] == NONE:
-            node_pred[c_node] = c_line
+        if node_pred[t, c_node] == NONE:
+            node_pred[t, c_node] = c_line
+            _touch(touched_node, counts, t, 1, c_node)
             count += 1
+            if dest_num and is_dest[t, c_node]:
+                dest_num -= 1
+                if dest_num == 0:
+                    break
 
         if c_node == target:
-            return
+            break
 
         start_l = idx[c_node - 1]
         end_l = idx[c_node]
@@ -118,162 +242,474 @@ cdef void _turn_dijikstra(np.ndarray[UTYPE16_t, ndim=1] idx,
                         line += 1
 
                 n_node = end_node[l]
-                if marker[n_node]:
+                if marker[t, n_node]:
                     continue
-                if n_dist < dist[l]:
-                    arc_pred[l] = c_line
-                    dist[l] = n_dist
-                    costs_heap.push_if_lower_fast(n_dist, l)
+                if n_dist < dist[t, l]:
+                    if dist[t, l] == INF:
+                        _touch(touched_arc, counts, t, 0, l)
+                    arc_pred[t, l] = c_line
+                    dist[t, l] = n_dist
+                    _heap_push_if_lower(h_val, h_ref, h_pos, t, &heap_count,
+                                        n_dist, l)
 
         else:
             # When a incoming arc has no turning delay to any outgoing arcs
             # of it's node, this node will not be re-reached, so mark it to
             # avoid re-reach for speed-up.
-            marker[c_node] = 1
+            marker[t, c_node] = 1
             for l in range(start_l, end_l):
                 n_node = end_node[l]
-                if marker[n_node]:
+                if marker[t, n_node]:
                     continue
                 n_dist = c_dist + weight[l]
 
-                if n_dist < dist[l]:
-                    arc_pred[l] = c_line
-                    dist[l] = n_dist
-                    costs_heap.push_if_lower_fast(n_dist, l)
+                if n_dist < dist[t, l]:
+                    if dist[t, l] == INF:
+                        _touch(touched_arc, counts, t, 0, l)
+                    arc_pred[t, l] = c_line
+                    dist[t, l] = n_dist
+                    _heap_push_if_lower(h_val, h_ref, h_pos, t, &heap_count,
+                                        n_dist, l)
+
+    # Leave the heap clean for the next search.
+    while heap_count != 0:
+        heap_count -= 1
+        h_pos[t, h_ref[t, heap_count]] = NONE
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void _touch(UTYPE_t[:, ::1] touched, Py_ssize_t[:, ::1] counts,
+                        Py_ssize_t t, Py_ssize_t k, UTYPE_t ref) nogil:
+    touched[t, counts[t, k]] = ref
+    counts[t, k] += 1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _reset_search(Py_ssize_t t,
+                        DTYPE_t[:, ::1] dist,
+                        UTYPE_t[:, ::1] node_pred,
+                        UTYPE_t[:, ::1] arc_pred,
+                        UTYPE8_t[:, ::1] marker,
+                        UTYPE_t[:, ::1] touched_arc,
+                        UTYPE_t[:, ::1] touched_node,
+                        Py_ssize_t[:, ::1] counts) nogil:
+    """Reset the entries of row `t` written by the previous search."""
+    cdef UTYPE_t NONE = <UTYPE_t> -1
+    cdef UTYPE_t ref
+    cdef Py_ssize_t k
+    for k in range(counts[t, 0]):
+        ref = touched_arc[t, k]
+        dist[t, ref] = INF
+        arc_pred[t, ref] = NONE
+    for k in range(counts[t, 1]):
+        ref = touched_node[t, k]
+        node_pred[t, ref] = NONE
+        marker[t, ref] = 0
+    counts[t, 0] = 0
+    counts[t, 1] = 0
+    counts[t, 2] = 0
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _load_origin(UTYPE_t source,
+                       UTYPE_t[:] targets,
+                       DTYPE_t[:] matrix,
+                       Py_ssize_t t,
+                       UTYPE_t[:, ::1] node_pred,
+                       UTYPE_t[:, ::1] arc_pred,
+                       DTYPE_t[:, ::1] arcs_flow,
+                       UTYPE_t[:] a,
+                       UTYPE_t[:] b,
+                       DTYPE_t[:, ::1] turns_flow) nogil:
+    """Load one row of an OD matrix onto the searched shortest path tree."""
+    cdef Py_ssize_t j
+    cdef UTYPE_t target, out_arc
+    cdef UTYPE_t NONE = <UTYPE_t> -1
+    # If need to count turning flow.
+    cdef bint count_turn = a.shape[0] != 1
+    for j in range(targets.shape[0]):
+        target = targets[j]
+        if source == target:
+            continue
+        out_arc = node_pred[t, target]
+        if out_arc == NONE:
+            # No path from source to target.
+            continue
+        if count_turn:
+            update_arcs_turns_flow(matrix[j], t, arc_pred, out_arc,
+                                   arcs_flow, a, b, turns_flow)
+        else:
+            update_arcs_flow(matrix[j], t, arc_pred, out_arc, arcs_flow)
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef void _c_all_or_nothing(np.ndarray[UTYPE16_t, ndim=1] sources, 
-                     np.ndarray[UTYPE16_t, ndim=1] targets,
-                     np.ndarray[DTYPE_t, ndim=2] matrix, 
-                     np.ndarray[UTYPE16_t, ndim=1] idx, 
-                     np.ndarray[UTYPE16_t, ndim=1] ID, 
-                     np.ndarray[UTYPE16_t, ndim=1] end_node, 
-                     np.ndarray[DTYPE_t, ndim=1] weight, 
-                     np.ndarray[UTYPE8_t, ndim=1] flag,
-                     np.ndarray[UTYPE16_t, ndim=1] turn_idx, 
-                     np.ndarray[UTYPE16_t, ndim=1] from_link, 
-                     np.ndarray[UTYPE16_t, ndim=1] to_link, 
-                     np.ndarray[DTYPE_t, ndim=1] delay, 
-                     np.ndarray[DTYPE_t, ndim=1] dist, 
-                     np.ndarray[UTYPE16_t, ndim=1] node_pred,
-                     np.ndarray[UTYPE16_t, ndim=1] arc_pred, 
-                     np.ndarray[DTYPE_t, ndim=1] arcs_flow, 
-                     np.ndarray[UTYPE16_t, ndim=1] a, 
-                     np.ndarray[UTYPE16_t, ndim=1] b, 
-                     np.ndarray[DTYPE_t, ndim=1] turns_flow):
+cdef void _load_tree(UTYPE_t source,
+                     UTYPE_t[:] targets,
+                     DTYPE_t[:] matrix,
+                     Py_ssize_t t,
+                     UTYPE_t[:, ::1] node_pred,
+                     UTYPE_t[:, ::1] arc_pred,
+                     UTYPE_t[:, ::1] settled,
+                     Py_ssize_t[:, ::1] counts,
+                     DTYPE_t[:, ::1] load,
+                     DTYPE_t[:, ::1] arcs_flow,
+                     UTYPE_t[:] a,
+                     UTYPE_t[:] b,
+                     DTYPE_t[:, ::1] turns_flow) nogil:
+    """Load one row of an OD matrix in one sweep over the searched tree.
+
+    The demand of each target is put on its `node_pred` arc, then the arcs
+    are visited in reverse settle order, so an arc is always visited before
+    its `arc_pred`, and its accumulated flow is passed on to the `arc_pred`.
+    `load` should be all zeros before and is left all zeros.
+    """
+    cdef Py_ssize_t j, k
+    cdef UTYPE_t target, out_arc, in_arc, a_line
+    cdef UTYPE_t NONE = <UTYPE_t> -1
+    cdef DTYPE_t flow
+    # If need to count turning flow.
+    cdef bint count_turn = a.shape[0] != 1
+    for j in range(targets.shape[0]):
+        target = targets[j]
+        if source == target:
+            continue
+        out_arc = node_pred[t, target]
+        if out_arc == NONE:
+            # No path from source to target.
+            continue
+        load[t, out_arc] += matrix[j]
+
+    for k in range(counts[t, 2] - 1, -1, -1):
+        out_arc = settled[t, k]
+        flow = load[t, out_arc]
+        if flow == 0:
+            continue
+        load[t, out_arc] = 0
+        arcs_flow[t, out_arc] += flow
+        in_arc = arc_pred[t, out_arc]
+        if in_arc == NONE:
+            continue
+        load[t, in_arc] += flow
+        if count_turn:
+            a_line = a[in_arc]
+            if a_line != NONE:
+                turns_flow[t, a_line + b[out_arc]] += flow
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef Py_ssize_t _mark_targets(UTYPE_t source,
+                              UTYPE_t[:] targets,
+                              DTYPE_t[:] matrix,
+                              Py_ssize_t t,
+                              UTYPE8_t[:, ::1] is_dest,
+                              UTYPE8_t value) nogil:
+    """Set `is_dest` of the targets with demand from `source` to `value`,
+    return the number of distinct targets changed."""
+    cdef Py_ssize_t j, n = 0
+    cdef UTYPE_t target
+    for j in range(targets.shape[0]):
+        target = targets[j]
+        if target == source or matrix[j] == 0:
+            continue
+        if is_dest[t, target] != value:
+            is_dest[t, target] = value
+            n += 1
+    return n
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _select_origin(UTYPE_t source,
+                         UTYPE_t[:] targets,
+                         DTYPE_t[:] matrix,
+                         Py_ssize_t t,
+                         UTYPE_t[:, ::1] node_pred,
+                         UTYPE_t[:, ::1] arc_pred,
+                         Py_ssize_t[:] sel_arc,
+                         DTYPE_t[:, :] sel_flow,
+                         Py_ssize_t zone,
+                         DTYPE_t[:, ::1] zone_flow) nogil:
+    """Select-link and select-zone analysis of one row of an OD matrix.
+
+    The path of each target is walked back, the flow of target `j` is added
+    to ``sel_flow[k, j]`` if the path uses an arc with ``sel_arc[arc] ==
+    k``, and to ``zone_flow[zone]`` along the whole path if `zone` is not
+    negative. A `sel_arc` of length 1 selects no arc.
+    """
+    cdef Py_ssize_t j, k
+    cdef UTYPE_t target, arc
+    cdef UTYPE_t NONE = <UTYPE_t> -1
+    cdef DTYPE_t flow
+    cdef bint select_link = sel_arc.shape[0] != 1
+    for j in range(targets.shape[0]):
+        target = targets[j]
+        flow = matrix[j]
+        if source == target or flow == 0:
+            continue
+        arc = node_pred[t, target]
+        while arc != NONE:
+            if select_link:
+                k = sel_arc[arc]
+                if k >= 0:
+                    sel_flow[k, j] += flow
+            if zone >= 0:
+                zone_flow[zone, arc] += flow
+            arc = arc_pred[t, arc]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef Py_ssize_t _aon_origin(UTYPE_t source,
+                            UTYPE_t[:] targets,
+                            DTYPE_t[:] matrix,
+                            UTYPE_t[:] idx,
+                            UTYPE_t[:] ID,
+                            UTYPE_t[:] end_node,
+                            DTYPE_t[:] weight,
+                            UTYPE8_t[:] flag,
+                            UTYPE_t[:] turn_idx,
+                            UTYPE_t[:] from_link,
+                            UTYPE_t[:] to_link,
+                            DTYPE_t[:] delay,
+                            Py_ssize_t max_node,
+                            Py_ssize_t t,
+                            DTYPE_t[:, ::1] dist,
+                            UTYPE_t[:, ::1] node_pred,
+                            UTYPE_t[:, ::1] arc_pred,
+                            UTYPE8_t[:, ::1] marker,
+                            DTYPE_t[:, ::1] h_val,
+                            UTYPE_t[:, ::1] h_ref,
+                            UTYPE_t[:, ::1] h_pos,
+                            UTYPE_t[:, ::1] touched_arc,
+                            UTYPE_t[:, ::1] touched_node,
+                            UTYPE_t[:, ::1] settled,
+                            Py_ssize_t[:, ::1] counts,
+                            UTYPE8_t[:, ::1] is_dest,
+                            DTYPE_t[:, ::1] load,
+                            DTYPE_t[:, ::1] arcs_flow,
+                            UTYPE_t[:] a,
+                            UTYPE_t[:] b,
+                            DTYPE_t[:, ::1] turns_flow,
+                            bint tree,
+                            Py_ssize_t[:] sel_arc,
+                            DTYPE_t[:, :] sel_flow,
+                            Py_ssize_t zone,
+                            DTYPE_t[:, ::1] zone_flow) nogil:
+    """Search from `source` and load one row of an OD matrix.
+
+    The search stops as soon as every target with demand is settled, an
+    origin without demand is not searched at all. Return the number of
+    nodes settled by the search. See `_select_origin` for `sel_arc`,
+    `sel_flow`, `zone` and `zone_flow`.
+    """
+    cdef Py_ssize_t dest_num = _mark_targets(source, targets, matrix, t,
+                                             is_dest, 1)
+    if dest_num == 0:
+        return 0
+    _turn_dijikstra(idx, ID, end_node, weight, flag, source, 0, INF,
+                    max_node, turn_idx, from_link, to_link, delay, t, dist,
+                    node_pred, arc_pred, marker, h_val, h_ref, h_pos,
+                    touched_arc, touched_node, settled, counts, is_dest,
+                    dest_num)
+    _mark_targets(source, targets, matrix, t, is_dest, 0)
+    if tree:
+        _load_tree(source, targets, matrix, t, node_pred, arc_pred, settled,
+                   counts, load, arcs_flow, a, b, turns_flow)
+    else:
+        _load_origin(source, targets, matrix, t, node_pred, arc_pred,
+                     arcs_flow, a, b, turns_flow)
+    if sel_arc.shape[0] != 1 or zone >= 0:
+        _select_origin(source, targets, matrix, t, node_pred, arc_pred,
+                       sel_arc, sel_flow, zone, zone_flow)
+    return counts[t, 1]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _c_all_or_nothing(UTYPE_t[:] sources,
+                            UTYPE_t[:] targets,
+                            DTYPE_t[:, :] matrix,
+                            UTYPE_t[:] idx,
+                            UTYPE_t[:] ID,
+                            UTYPE_t[:] end_node,
+                            DTYPE_t[:] weight,
+                            UTYPE8_t[:] flag,
+                            UTYPE_t[:] turn_idx,
+                            UTYPE_t[:] from_link,
+                            UTYPE_t[:] to_link,
+                            DTYPE_t[:] delay,
+                            Py_ssize_t max_node,
+                            DTYPE_t[:, ::1] dist,
+                            UTYPE_t[:, ::1] node_pred,
+                            UTYPE_t[:, ::1] arc_pred,
+                            UTYPE8_t[:, ::1] marker,
+                            DTYPE_t[:, ::1] h_val,
+                            UTYPE_t[:, ::1] h_ref,
+                            UTYPE_t[:, ::1] h_pos,
+                            UTYPE_t[:, ::1] touched_arc,
+                            UTYPE_t[:, ::1] touched_node,
+                            UTYPE_t[:, ::1] settled,
+                            Py_ssize_t[:, ::1] counts,
+                            UTYPE8_t[:, ::1] is_dest,
+                            DTYPE_t[:, ::1] load,
+                            DTYPE_t[:, ::1] arcs_flow,
+                            UTYPE_t[:] a,
+                            UTYPE_t[:] b,
+                            DTYPE_t[:, ::1] turns_flow,
+                            Py_ssize_t[::1] settled_count,
+                            int threads,
+                            bint tree,
+                            Py_ssize_t[:] sel_arc,
+                            DTYPE_t[:, :] sel_flow,
+                            DTYPE_t[:, ::1] zone_flow) nogil:
     """The inner c-method for All_or_Nothing assignment.
 
+    Origins are handed out to `threads` threads in a fixed round-robin
+    order, each thread loads its flow into its own row of `arcs_flow` and
+    `turns_flow`, so the result only depends on the number of threads.
+    If `tree`, flow is loaded by `_load_tree`, else by `_load_origin`.
+    `sel_arc`, `sel_flow` and `zone_flow` only fill the arguments of
+    `_aon_origin`, nothing is selected.
+
     Parameters see `c_all_or_nothing`
 
     See Also
     --------
     c_all_or_nothing
     """
-    cdef UTYPE16_t i, j, source, target, out_arc, max_node
-    cdef DTYPE_t flow
-    if a.shape[0] == 1:  # If no need to count turning flow.
-        update_flow = update_arcs_flow
-    else:  # If need to count turning flow.
-        update_flow = update_arcs_turns_flow
-    max_node = set(end_node).__len__()
-
-    for i in range(sources.shape[0]):
-        dist[:] = INF
-        source = sources[i]
-        node_pred[:] = NONE
-        arc_pred[:] = NONE
-        _turn_dijikstra(idx, ID, end_node, weight, flag, source, 0, INF, 
-                        max_node, turn_idx, from_link, to_link, delay, dist, 
-                        node_pred, arc_pred)
-        for j in range(targets.shape[0]):
-            target = targets[j]
-            if source == target:
-                continue
-            out_arc = node_pred[target]
-            if out_arc == NONE:
-                Warning('No path from {} to {}'.format(source, target))
-                continue
-            flow = matrix[i, j]
-            update_flow(flow, arc_pred, out_arc, arcs_flow, a, b, turns_flow)
+    cdef Py_ssize_t i, t
+
+    if threads == 1:
+        for i in range(sources.shape[0]):
+            settled_count[i] = _aon_origin(
+                sources[i], targets, matrix[i], idx, ID, end_node, weight,
+                flag, turn_idx, from_link, to_link, delay, max_node, 0, dist,
+                node_pred, arc_pred, marker, h_val, h_ref, h_pos,
+                touched_arc, touched_node, settled, counts, is_dest, load,
+                arcs_flow, a, b, turns_flow, tree, sel_arc, sel_flow, -1,
+                zone_flow)
+        return
+
+    for i in prange(sources.shape[0], num_threads=threads,
+                    schedule='static', chunksize=1):
+        t = threadid()
+        settled_count[i] = _aon_origin(
+            sources[i], targets, matrix[i], idx, ID, end_node, weight, flag,
+            turn_idx, from_link, to_link, delay, max_node, t, dist,
+            node_pred, arc_pred, marker, h_val, h_ref, h_pos, touched_arc,
+            touched_node, settled, counts, is_dest, load, arcs_flow, a, b,
+            turns_flow, tree, sel_arc, sel_flow, -1, zone_flow)
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef void _c_single_all_or_nothing(UTYPE16_t source, 
-                            np.ndarray[UTYPE16_t, ndim=1] targets, 
-                            np.ndarray[DTYPE_t, ndim=1] matrix, 
-                            np.ndarray[UTYPE16_t, ndim=1] idx, 
-                            np.ndarray[UTYPE16_t, ndim=1] ID, 
-                            np.ndarray[UTYPE16_t, ndim=1] end_node,
-                            np.ndarray[DTYPE_t, ndim=1] weight, 
-                            np.ndarray[UTYPE8_t, ndim=1] flag, 
-                            np.ndarray[UTYPE16_t, ndim=1] turn_idx, 
-                            np.ndarray[UTYPE16_t, ndim=1] from_link, 
-                            np.ndarray[UTYPE16_t, ndim=1] to_link,
-                            np.ndarray[DTYPE_t, ndim=1] delay, 
-                            np.ndarray[DTYPE_t, ndim=1] dist, 
-                            np.ndarray[UTYPE16_t, ndim=1] node_pred, 
-                            np.ndarray[UTYPE16_t, ndim=1] arc_pred, 
-                            np.ndarray[DTYPE_t, ndim=1] arcs_flow,
-                            np.ndarray[UTYPE16_t, ndim=1] a, 
-                            np.ndarray[UTYPE16_t, ndim=1] b, 
-                            np.ndarray[DTYPE_t, ndim=1] turns_flow):
-    """The inner c-method for All_or_Nothing assignment from 
-    single source node to other nodes.
-
-    Parameters see `c_single_all_or_nothing`
+cdef void _c_sparse_all_or_nothing(Py_ssize_t[:] rows,
+                                   UTYPE_t[:] sources,
+                                   Py_ssize_t[:] indptr,
+                                   UTYPE_t[:] nz_targets,
+                                   DTYPE_t[:] values,
+                                   UTYPE_t[:] idx,
+                                   UTYPE_t[:] ID,
+                                   UTYPE_t[:] end_node,
+                                   DTYPE_t[:] weight,
+                                   UTYPE8_t[:] flag,
+                                   UTYPE_t[:] turn_idx,
+                                   UTYPE_t[:] from_link,
+                                   UTYPE_t[:] to_link,
+                                   DTYPE_t[:] delay,
+                                   Py_ssize_t max_node,
+                                   DTYPE_t[:, ::1] dist,
+                                   UTYPE_t[:, ::1] node_pred,
+                                   UTYPE_t[:, ::1] arc_pred,
+                                   UTYPE8_t[:, ::1] marker,
+                                   DTYPE_t[:, ::1] h_val,
+                                   UTYPE_t[:, ::1] h_ref,
+                                   UTYPE_t[:, ::1] h_pos,
+                                   UTYPE_t[:, ::1] touched_arc,
+                                   UTYPE_t[:, ::1] touched_node,
+                                   UTYPE_t[:, ::1] settled,
+                                   Py_ssize_t[:, ::1] counts,
+                                   UTYPE8_t[:, ::1] is_dest,
+                                   DTYPE_t[:, ::1] load,
+                                   DTYPE_t[:, ::1] arcs_flow,
+                                   UTYPE_t[:] a,
+                                   UTYPE_t[:] b,
+                                   DTYPE_t[:, ::1] turns_flow,
+                                   Py_ssize_t[::1] settled_count,
+                                   int threads,
+                                   bint tree,
+                                   Py_ssize_t[:] sel_arc,
+                                   DTYPE_t[:, :] sel_flow,
+                                   Py_ssize_t[:] zone_row,
+                                   DTYPE_t[:, ::1] zone_flow) nogil:
+    """The inner c-method for All_or_Nothing assignment of a CSR matrix.
 
-    See Also
-    --------
-    c_single_all_or_nothing
+    Only the origins in `rows` are searched, and the flow of origin
+    ``rows[k]`` is loaded to the targets
+    ``nz_targets[indptr[i]:indptr[i + 1]]`` only, with ``i = rows[k]``.
+    Threads are used the same way as `_c_all_or_nothing`.
+
+    Parameters see `c_sparse_all_or_nothing`
     """
-    cdef UTYPE16_t i, target, out_arc
-    cdef DTYPE_t flow
-    if a.shape[0] == 1:  # If no need to count turning flow.
-        update_flow = update_arcs_flow
-    else:  # If need to count turning flow.
-        update_flow = update_arcs_turns_flow
-
-    _turn_dijikstra(idx, ID, end_node, weight, flag, source, 0, INF, 0,
-                    turn_idx, from_link, to_link, delay, dist, node_pred,
-                    arc_pred)
-    for i in range(targets.shape[0]):
-        target = targets[i]
-        if source == target:
-            continue
-        out_arc = node_pred[target]
-        if out_arc == NONE:
-            Warning('No path from {} to {}'.format(source, target))
-            continue
-        flow = matrix[i]
-        update_flow(flow, arc_pred, out_arc, arcs_flow, a, b, turns_flow)
+    cdef Py_ssize_t k, i, t
+
+    if threads == 1:
+        for k in range(rows.shape[0]):
+            i = rows[k]
+            settled_count[i] = _aon_origin(
+                sources[i], nz_targets[indptr[i]:indptr[i + 1]],
+                values[indptr[i]:indptr[i + 1]], idx, ID, end_node, weight,
+                flag, turn_idx, from_link, to_link, delay, max_node, 0, dist,
+                node_pred, arc_pred, marker, h_val, h_ref, h_pos,
+                touched_arc, touched_node, settled, counts, is_dest, load,
+                arcs_flow, a, b, turns_flow, tree, sel_arc,
+                sel_flow[:, indptr[i]:indptr[i + 1]],
+                zone_row[i], zone_flow)
+        return
+
+    for k in prange(rows.shape[0], num_threads=threads,
+                    schedule='static', chunksize=1):
+        i = rows[k]
+        t = threadid()
+        settled_count[i] = _aon_origin(
+            sources[i], nz_targets[indptr[i]:indptr[i + 1]],
+            values[indptr[i]:indptr[i + 1]], idx, ID, end_node, weight, flag,
+            turn_idx, from_link, to_link, delay, max_node, t, dist,
+            node_pred, arc_pred, marker, h_val, h_ref, h_pos, touched_arc,
+            touched_node, settled, counts, is_dest, load, arcs_flow, a, b,
+            turns_flow, tree, sel_arc,
+            sel_flow[:, indptr[i]:indptr[i + 1]],
+            zone_row[i], zone_flow)
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef void update_arcs_flow(DTYPE_t flow,
-                      np.ndarray[UTYPE16_t, ndim=1] arc_pred,
-                      UTYPE16_t out_arc, 
-                      np.ndarray[DTYPE_t, ndim=1] arcs_flow, 
-                      np.ndarray[UTYPE16_t, ndim=1] a, 
-                      np.ndarray[UTYPE16_t, ndim=1] b, 
-                      np.ndarray[DTYPE_t, ndim=1] turns_flow):
+cdef inline void update_arcs_flow(DTYPE_t flow,
+                                  Py_ssize_t t,
+                                  UTYPE_t[:, ::1] arc_pred,
+                                  UTYPE_t out_arc,
+                                  DTYPE_t[:, ::1] arcs_flow) nogil:
+    cdef UTYPE_t NONE = <UTYPE_t> -1
     while out_arc != NONE:
-        arcs_flow[out_arc] += flow
-        out_arc = arc_pred[out_arc]
+        arcs_flow[t, out_arc] += flow
+        out_arc = arc_pred[t, out_arc]
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef void update_arcs_turns_flow(DTYPE_t flow,
-                                np.ndarray[UTYPE16_t, ndim=1] arc_pred,
-                                UTYPE16_t out_arc, 
-                                np.ndarray[DTYPE_t, ndim=1] arcs_flow, 
-                                np.ndarray[UTYPE16_t, ndim=1] a, 
-                                np.ndarray[UTYPE16_t, ndim=1] b, 
-                                np.ndarray[DTYPE_t, ndim=1] turns_flow):
+cdef inline void update_arcs_turns_flow(DTYPE_t flow,
+                                        Py_ssize_t t,
+                                        UTYPE_t[:, ::1] arc_pred,
+                                        UTYPE_t out_arc,
+                                        DTYPE_t[:, ::1] arcs_flow,
+                                        UTYPE_t[:] a,
+                                        UTYPE_t[:] b,
+                                        DTYPE_t[:, ::1] turns_flow) nogil:
     """Update arcs and turns flow during the assignment.
 
     Parameters
@@ -281,34 +717,157 @@ cdef void update_arcs_turns_flow(DTYPE_t flow,
     flow : float
         The traffic flow of a certain OD pair in OD matrix.
     """
-    cdef UTYPE16_t in_arc, a_line, b_line
-    arcs_flow[out_arc] += flow
-    in_arc = arc_pred[out_arc]
+    cdef UTYPE_t in_arc, a_line, b_line
+    cdef UTYPE_t NONE = <UTYPE_t> -1
+    arcs_flow[t, out_arc] += flow
+    in_arc = arc_pred[t, out_arc]
     while in_arc != NONE:
-        arcs_flow[in_arc] += flow
+        arcs_flow[t, in_arc] += flow
         a_line = a[in_arc]
         if a_line != NONE:
             b_line = b[out_arc]
-            turns_flow[a_line + b_line] += flow
+            turns_flow[t, a_line + b_line] += flow
         out_arc = in_arc
-        in_arc = arc_pred[out_arc]
-
-def turn_dijikstra(np.ndarray[UTYPE16_t, ndim=1] idx, 
-                     np.ndarray[UTYPE16_t, ndim=1] ID, 
-                     np.ndarray[UTYPE16_t, ndim=1] end_node, 
-                     np.ndarray[DTYPE_t, ndim=1] weight, 
-                     np.ndarray[UTYPE8_t, ndim=1] flag, 
-                     UTYPE16_t source, 
-                     UTYPE16_t target,
-                     float max_dist,
-                     UTYPE16_t max_node,
-                     np.ndarray[UTYPE16_t, ndim=1] turn_idx,
-                     np.ndarray[UTYPE16_t, ndim=1] from_link,
-                     np.ndarray[UTYPE16_t, ndim=1] to_link,
-                     np.ndarray[DTYPE_t, ndim=1] delay, 
-                     np.ndarray[DTYPE_t, ndim=1] dist, 
-                     np.ndarray[UTYPE16_t, ndim=1] node_pred, 
-                     np.ndarray[UTYPE16_t, ndim=1] arc_pred):
+        in_arc = arc_pred[t, out_arc]
+
+
+class ShortestPathWorkspace(object):
+    """Work arrays of the shortest path kernels, bound to one net.
+
+    The arrays are allocated once and reused by every search, each search
+    only resets the entries written by the previous search of the same
+    row, so a search that reaches few nodes costs little no matter how big
+    the net is. Row `t` of every 2d array belongs to thread `t`.
+
+    Parameters
+    ----------
+    net : Net
+        The net to search on. The arrays are sized by ``net._data`` and
+        ``net.r_idx`` and typed by ``net.id_type``.
+    threads : int, optional
+        Number of threads the workspace is used by. Default: 1.
+
+    Attributes
+    ----------
+    threads : int
+    id_type : dtype
+    node_count : int
+        Number of distinct nodes can be reached, the default `max_node`.
+    dist, node_pred, arc_pred : ndarray
+        The results of the last search of each row, see `turn_dijikstra`.
+    marker, h_val, h_ref, h_pos : ndarray
+        The node marker and the binary heap used while searching.
+    touched_arc, touched_node : ndarray
+        Arcs and nodes labeled by the last search of each row.
+    settled : ndarray
+        Arcs popped from the heap by the last search of each row, in order.
+    counts : ndarray
+        Numbers of touched arcs, touched nodes and settled arcs of each row.
+    is_dest : ndarray
+        Marks the targets with flow of the origin being assigned, all zeros
+        between searches.
+    load : ndarray
+        Flow accumulated on each arc while loading a tree, all zeros
+        between searches.
+
+    Notes
+    -----
+    One workspace can only be used by one call at a time.
+    """
+
+    def __init__(self, net, threads=1):
+        self._allocate(net._data['END_NODE'], net.r_idx.shape[0],
+                       net.id_type, threads)
+
+    @classmethod
+    def from_arrays(cls, end_node, node_num, threads=1):
+        """Build a workspace from the ``END_NODE`` field and the length of
+        ``r_idx`` of a net, when the `Net` itself is not at hand."""
+        self = cls.__new__(cls)
+        self._allocate(end_node, node_num, np.asarray(end_node).dtype,
+                       threads)
+        return self
+
+    def _allocate(self, end_node, node_num, id_type, threads):
+        if threads < 1:
+            raise ValueError('threads should be a positive integer.')
+        id_type = np.dtype(id_type)
+        none = np.iinfo(id_type).max
+        arc_num = end_node.shape[0]
+        self.threads = threads
+        self.id_type = id_type
+        self.node_count = np.unique(end_node).shape[0]
+        self.dist = np.full((threads, arc_num), np.inf, np.float64)
+        self.node_pred = np.full((threads, node_num), none, id_type)
+        self.arc_pred = np.full((threads, arc_num), none, id_type)
+        self.marker = np.zeros((threads, node_num), np.uint8)
+        self.h_val = np.empty((threads, arc_num), np.float64)
+        self.h_ref = np.empty((threads, arc_num), id_type)
+        self.h_pos = np.full((threads, arc_num), none, id_type)
+        self.touched_arc = np.empty((threads, arc_num), id_type)
+        # The source node may be recorded twice.
+        self.touched_node = np.empty((threads, node_num + 1), id_type)
+        self.settled = np.empty((threads, arc_num), id_type)
+        self.counts = np.zeros((threads, 3), np.intp)
+        self.is_dest = np.zeros((threads, node_num), np.uint8)
+        self.load = np.zeros((threads, arc_num), np.float64)
+        self._flows = None
+
+    @property
+    def nbytes(self):
+        """Total bytes of the work arrays."""
+        arrays = [self.dist, self.node_pred, self.arc_pred, self.marker,
+                  self.h_val, self.h_ref, self.h_pos, self.touched_arc,
+                  self.touched_node, self.settled, self.counts,
+                  self.is_dest, self.load]
+        if self._flows is not None:
+            arrays.extend(self._flows)
+        return sum(arr.nbytes for arr in arrays)
+
+    def result(self, t=0):
+        """Views of `dist`, `node_pred` and `arc_pred` of row `t`, which are
+        overwritten by the next search."""
+        return self.dist[t], self.node_pred[t], self.arc_pred[t]
+
+    def flow_buffers(self, turn_num):
+        """Zeroed per-thread arc and turn flow arrays, reused between calls."""
+        arc_num = self.dist.shape[1]
+        if self._flows is None or self._flows[1].shape[1] != turn_num:
+            self._flows = (np.zeros((self.threads, arc_num), np.float64),
+                           np.zeros((self.threads, turn_num), np.float64))
+        else:
+            self._flows[0].fill(0)
+            self._flows[1].fill(0)
+        return self._flows
+
+
+def _no_select(rows, sel_shape):
+    """The `select` argument of the AON kernels selecting nothing."""
+    return (np.full(1, -1, np.intp), np.zeros(sel_shape, np.float64),
+            np.full(rows, -1, np.intp), np.zeros((1, 1), np.float64))
+
+
+def _as_row(arr):
+    """A (1, n) view of a contiguous 1d array, written through by kernels."""
+    row = np.asarray(arr).view()
+    row.shape = (1, row.shape[0])
+    return row
+
+
+def turn_dijikstra(UTYPE_t[:] idx,
+                   UTYPE_t[:] ID,
+                   UTYPE_t[:] end_node,
+                   DTYPE_t[:] weight,
+                   UTYPE8_t[:] flag,
+                   UTYPE_t source,
+                   UTYPE_t target,
+                   DTYPE_t max_dist,
+                   Py_ssize_t max_node,
+                   UTYPE_t[:] turn_idx,
+                   UTYPE_t[:] from_link,
+                   UTYPE_t[:] to_link,
+                   DTYPE_t[:] delay,
+                   workspace):
     """Dijkstra algorithm for the shortest path problem with turning delay.
 
     When take turning delay into consideration, nodes can not be used to
@@ -320,8 +879,7 @@ def turn_dijikstra(np.ndarray[UTYPE16_t, ndim=1] idx,
     same `ID`. So we use the row number(row position of an arc in Net._data)
     to identify and label each arc.
 
-    Besides a binary heap written by Almar Klein is used to improve the
-    performance.
+    Besides a binary heap is used to improve the performance.
 
     Parameters
     ----------
@@ -353,19 +911,13 @@ def turn_dijikstra(np.ndarray[UTYPE16_t, ndim=1] idx,
         A field of turn_table, ``turn_table['TO']``.
     delay : ndarray
         A field of turn_table, ``turn_table['DELAY']`` or you can specify.
-    dist : ndarray
-        A ndarray used to store the shortest distance from source node to
-        each arc. It uses arc's row number to index, so the length of it
-        should be same as ``Net._data``. And the initial value should be
-        all INFs.
-    node_pred : ndarray
-        A ndarray used to store the node's preceding arc's row number. It
-        uses node's ID to index, the length of it should be big enough to
-        contain the biggest node ID. And initial value should be all NONEs.
-    arc_pred : ndarray
-        A ndarray used to store the arc's preceding arc's row number. It
-        uses arc's row number to index, so the length of it should be same
-        as ``Net._data``. And the initial value should be all NONEs.
+    workspace : ShortestPathWorkspace
+        The workspace of the net, row 0 is used. After searching,
+        ``workspace.result()`` gives `dist`, the shortest distance from
+        source node to each arc indexed by arc's row number, `node_pred`,
+        the node's preceding arc's row number indexed by node's ID, and
+        `arc_pred`, the arc's preceding arc's row number indexed by arc's
+        row number.
 
     Note
     ----
@@ -373,30 +925,47 @@ def turn_dijikstra(np.ndarray[UTYPE16_t, ndim=1] idx,
     no warning or error raised when negative value occur.
 
     Not a Number (`nan`) in weight or turning-delay has the same effect of
-    positive infinity, Just like no such arc or turns."""
-    _turn_dijikstra (idx, ID, end_node, weight, flag, source, target,
-                     max_dist, max_node, turn_idx, from_link, to_link,
-                     delay, dist, node_pred, arc_pred)
-
-def c_all_or_nothing(np.ndarray[UTYPE16_t, ndim=1] sources, 
-                     np.ndarray[UTYPE16_t, ndim=1] targets,
-                     np.ndarray[DTYPE_t, ndim=2] matrix, 
-                     np.ndarray[UTYPE16_t, ndim=1] idx, 
-                     np.ndarray[UTYPE16_t, ndim=1] ID, 
-                     np.ndarray[UTYPE16_t, ndim=1] end_node, 
-                     np.ndarray[DTYPE_t, ndim=1] weight, 
-                     np.ndarray[UTYPE8_t, ndim=1] flag,
-                     np.ndarray[UTYPE16_t, ndim=1] turn_idx, 
-                     np.ndarray[UTYPE16_t, ndim=1] from_link, 
-                     np.ndarray[UTYPE16_t, ndim=1] to_link, 
-                     np.ndarray[DTYPE_t, ndim=1] delay, 
-                     np.ndarray[DTYPE_t, ndim=1] dist, 
-                     np.ndarray[UTYPE16_t, ndim=1] node_pred,
-                     np.ndarray[UTYPE16_t, ndim=1] arc_pred, 
-                     np.ndarray[DTYPE_t, ndim=1] arcs_flow, 
-                     np.ndarray[UTYPE16_t, ndim=1] a, 
-                     np.ndarray[UTYPE16_t, ndim=1] b, 
-                     np.ndarray[DTYPE_t, ndim=1] turns_flow):
+    positive infinity, Just like no such arc or turns.
+    """
+    cdef DTYPE_t[:, ::1] dist = workspace.dist, h_val = workspace.h_val
+    cdef UTYPE_t[:, ::1] node_pred = workspace.node_pred
+    cdef UTYPE_t[:, ::1] arc_pred = workspace.arc_pred
+    cdef UTYPE_t[:, ::1] h_ref = workspace.h_ref, h_pos = workspace.h_pos
+    cdef UTYPE_t[:, ::1] touched_arc = workspace.touched_arc
+    cdef UTYPE_t[:, ::1] touched_node = workspace.touched_node
+    cdef UTYPE_t[:, ::1] settled = workspace.settled
+    cdef UTYPE8_t[:, ::1] marker = workspace.marker
+    cdef Py_ssize_t[:, ::1] counts = workspace.counts
+    cdef UTYPE8_t[:, ::1] is_dest = workspace.is_dest
+    if max_node == 0:
+        max_node = workspace.node_count
+    with nogil:
+        _turn_dijikstra(idx, ID, end_node, weight, flag, source, target,
+                        max_dist, max_node, turn_idx, from_link, to_link,
+                        delay, 0, dist, node_pred, arc_pred, marker,
+                        h_val, h_ref, h_pos, touched_arc, touched_node,
+                        settled, counts, is_dest, 0)
+
+
+def c_all_or_nothing(UTYPE_t[:] sources,
+                     UTYPE_t[:] targets,
+                     DTYPE_t[:, :] matrix,
+                     UTYPE_t[:] idx,
+                     UTYPE_t[:] ID,
+                     UTYPE_t[:] end_node,
+                     DTYPE_t[:] weight,
+                     UTYPE8_t[:] flag,
+                     UTYPE_t[:] turn_idx,
+                     UTYPE_t[:] from_link,
+                     UTYPE_t[:] to_link,
+                     DTYPE_t[:] delay,
+                     DTYPE_t[::1] arcs_flow,
+                     UTYPE_t[:] a,
+                     UTYPE_t[:] b,
+                     DTYPE_t[::1] turns_flow,
+                     workspace,
+                     bint tree=False,
+                     settled_count=None):
     """All_or_Nothing assignment.
 
     Parameters
@@ -426,19 +995,6 @@ def c_all_or_nothing(np.ndarray[UTYPE16_t, ndim=1] sources,
         A field of turn_table, ``turn_table['TO']``.
     delay : ndarray
         A field of turn_table, ``turn_table['DELAY']`` or you can specify.
-    dist : ndarray
-        A ndarray used to store the shortest distance from source node to
-        each arc. It uses arc's row number to index, so the length of it
-        should be same as ``Net._data``. And the initial value should be
-        all INFs.
-    node_pred : ndarray
-        A ndarray used to store the node's preceding arc's row number. It
-        uses node's ID to index, the length of it should be big enough to
-        contain the biggest node ID. And initial value should be all NONEs.
-    arc_pred : ndarray
-        A ndarray used to store the arc's preceding arc's row number. It
-        uses arc's row number to index, so the length of it should be same
-        as ``Net._data``. And the initial value should be all NONEs.
     arcs_flow : ndarray
         The ndarray to be filled with the acrs's flow.
     a, b : ndarray
@@ -446,34 +1002,208 @@ def c_all_or_nothing(np.ndarray[UTYPE16_t, ndim=1] sources,
         input value should be all NONEs.
     turns_flow : ndarray
         The ndarray to be fill with the acrs's flow.
+    workspace : ShortestPathWorkspace
+        The workspace of the net. The origins are searched and loaded with
+        ``workspace.threads`` threads, the GIL is released while searching.
+        When bigger than 1, each thread loads into its own flow arrays,
+        which are summed in thread order at the end, so results are
+        deterministic for a fixed number of threads.
+    tree : bool, optional
+        How to load the flow of an origin. If `False`, walk `arc_pred` back
+        from each target, which costs the total length of the paths. If
+        `True`, sweep once over the shortest path tree in reverse settle
+        order, which costs the number of settled arcs. Default: `False`.
+    settled_count : ndarray, optional
+        A 1d ndarray of ``np.intp`` as long as `sources`, filled with the
+        number of nodes settled by the search of each source. The search
+        of a source stops as soon as all targets with non-zero flow are
+        settled, and a source without flow is not searched, its count is 0.
 
     See Also
     --------
     c_single_all_or_nothing
     """
-    _c_all_or_nothing(sources, targets, matrix, idx, ID, end_node, weight, 
-                      flag, turn_idx, from_link, to_link, delay, dist, 
-                      node_pred, arc_pred, arcs_flow, a, b, turns_flow)
-
-def c_single_all_or_nothing(UTYPE16_t source, 
-                            np.ndarray[UTYPE16_t, ndim=1] targets, 
-                            np.ndarray[DTYPE_t, ndim=1] matrix, 
-                            np.ndarray[UTYPE16_t, ndim=1] idx, 
-                            np.ndarray[UTYPE16_t, ndim=1] ID, 
-                            np.ndarray[UTYPE16_t, ndim=1] end_node,
-                            np.ndarray[DTYPE_t, ndim=1] weight, 
-                            np.ndarray[UTYPE8_t, ndim=1] flag, 
-                            np.ndarray[UTYPE16_t, ndim=1] turn_idx, 
-                            np.ndarray[UTYPE16_t, ndim=1] from_link, 
-                            np.ndarray[UTYPE16_t, ndim=1] to_link,
-                            np.ndarray[DTYPE_t, ndim=1] delay, 
-                            np.ndarray[DTYPE_t, ndim=1] dist, 
-                            np.ndarray[UTYPE16_t, ndim=1] node_pred, 
-                            np.ndarray[UTYPE16_t, ndim=1] arc_pred, 
-                            np.ndarray[DTYPE_t, ndim=1] arcs_flow,
-                            np.ndarray[UTYPE16_t, ndim=1] a, 
-                            np.ndarray[UTYPE16_t, ndim=1] b, 
-                            np.ndarray[DTYPE_t, ndim=1] turns_flow):
+    cdef int threads = workspace.threads
+    cdef Py_ssize_t max_node = workspace.node_count
+    cdef DTYPE_t[:, ::1] dist = workspace.dist, h_val = workspace.h_val
+    cdef UTYPE_t[:, ::1] node_pred = workspace.node_pred
+    cdef UTYPE_t[:, ::1] arc_pred = workspace.arc_pred
+    cdef UTYPE_t[:, ::1] h_ref = workspace.h_ref, h_pos = workspace.h_pos
+    cdef UTYPE_t[:, ::1] touched_arc = workspace.touched_arc
+    cdef UTYPE_t[:, ::1] touched_node = workspace.touched_node
+    cdef UTYPE_t[:, ::1] settled = workspace.settled
+    cdef UTYPE8_t[:, ::1] marker = workspace.marker
+    cdef Py_ssize_t[:, ::1] counts = workspace.counts
+    cdef UTYPE8_t[:, ::1] is_dest = workspace.is_dest
+    cdef DTYPE_t[:, ::1] load = workspace.load
+    cdef DTYPE_t[:, ::1] arcs_flow_v, turns_flow_v
+
+    if threads == 1:
+        arcs_flow_v = _as_row(arcs_flow)
+        turns_flow_v = _as_row(turns_flow)
+    else:
+        arcs_flow_v, turns_flow_v = workspace.flow_buffers(
+            turns_flow.shape[0])
+
+    if settled_count is None:
+        settled_count = np.empty(sources.shape[0], np.intp)
+    cdef Py_ssize_t[::1] settled_count_v = settled_count
+
+    select = _no_select(1, (1, 1))
+    cdef Py_ssize_t[:] sel_arc = select[0]
+    cdef DTYPE_t[:, :] sel_flow = select[1]
+    cdef DTYPE_t[:, ::1] zone_flow = select[3]
+
+    with nogil:
+        _c_all_or_nothing(sources, targets, matrix, idx, ID, end_node, weight,
+                          flag, turn_idx, from_link, to_link, delay, max_node,
+                          dist, node_pred, arc_pred, marker, h_val, h_ref,
+                          h_pos, touched_arc, touched_node, settled, counts,
+                          is_dest, load, arcs_flow_v, a, b, turns_flow_v,
+                          settled_count_v, threads, tree, sel_arc, sel_flow,
+                          zone_flow)
+
+    if threads > 1:
+        # Reduce in thread order to keep the sums deterministic.
+        flows = np.asarray(arcs_flow)
+        t_flows = np.asarray(turns_flow)
+        for t in range(threads):
+            flows += arcs_flow_v[t]
+            t_flows += turns_flow_v[t]
+
+
+def c_sparse_all_or_nothing(UTYPE_t[:] sources,
+                            UTYPE_t[:] targets,
+                            Py_ssize_t[:] indptr,
+                            Py_ssize_t[:] indices,
+                            DTYPE_t[:] values,
+                            UTYPE_t[:] idx,
+                            UTYPE_t[:] ID,
+                            UTYPE_t[:] end_node,
+                            DTYPE_t[:] weight,
+                            UTYPE8_t[:] flag,
+                            UTYPE_t[:] turn_idx,
+                            UTYPE_t[:] from_link,
+                            UTYPE_t[:] to_link,
+                            DTYPE_t[:] delay,
+                            DTYPE_t[::1] arcs_flow,
+                            UTYPE_t[:] a,
+                            UTYPE_t[:] b,
+                            DTYPE_t[::1] turns_flow,
+                            workspace,
+                            bint tree=False,
+                            settled_count=None,
+                            select=None):
+    """All_or_Nothing assignment of an OD matrix in CSR form.
+
+    Same as `c_all_or_nothing`, but only the non-zero cells are loaded,
+    and origins without any non-zero cell are not searched at all.
+
+    Parameters
+    ----------
+    sources : ndarray
+        A 1d ndarray of sources's ID.
+    targets : ndarray
+        A 1d ndarray of targets's ID.
+    indptr, indices, values : ndarray
+        The OD matrix in CSR form, the non-zero cells of row `i` are at the
+        columns ``indices[indptr[i]:indptr[i + 1]]`` with the flows
+        ``values[indptr[i]:indptr[i + 1]]``, see ``SparseMatrix``.
+        ``indptr`` may be a slice of a longer one, its values are positions
+        in `indices` and `values`.
+    settled_count : ndarray, optional
+        See `c_all_or_nothing`.
+    select : tuple, optional
+        ``(sel_arc, sel_flow, zone_row, zone_flow)`` for the select-link
+        and select-zone analysis. ``sel_arc[arc]`` is the index of the
+        selected link the arc belongs to, -1 if not selected, the flow of
+        the cell ``values[n]`` on a path using selected link `k` is added
+        to ``sel_flow[k, n]``. ``zone_row[i]`` is the index of source `i`
+        among the selected zones, -1 if not selected, the arcs flow from
+        source `i` is added to ``zone_flow[zone_row[i]]``. `sel_arc` and
+        `zone_row` are of type ``np.intp``. Default: `None`.
+    others :
+        See `c_all_or_nothing`.
+
+    See Also
+    --------
+    c_all_or_nothing
+    """
+    cdef int threads = workspace.threads
+    cdef Py_ssize_t max_node = workspace.node_count
+    cdef DTYPE_t[:, ::1] dist = workspace.dist, h_val = workspace.h_val
+    cdef UTYPE_t[:, ::1] node_pred = workspace.node_pred
+    cdef UTYPE_t[:, ::1] arc_pred = workspace.arc_pred
+    cdef UTYPE_t[:, ::1] h_ref = workspace.h_ref, h_pos = workspace.h_pos
+    cdef UTYPE_t[:, ::1] touched_arc = workspace.touched_arc
+    cdef UTYPE_t[:, ::1] touched_node = workspace.touched_node
+    cdef UTYPE_t[:, ::1] settled = workspace.settled
+    cdef UTYPE8_t[:, ::1] marker = workspace.marker
+    cdef Py_ssize_t[:, ::1] counts = workspace.counts
+    cdef UTYPE8_t[:, ::1] is_dest = workspace.is_dest
+    cdef DTYPE_t[:, ::1] load = workspace.load
+    cdef DTYPE_t[:, ::1] arcs_flow_v, turns_flow_v
+    # Origins with at least one non-zero cell.
+    cdef Py_ssize_t[:] rows = np.flatnonzero(np.diff(indptr))
+    # Target's ID of each non-zero cell.
+    cdef UTYPE_t[:] nz_targets = np.asarray(targets)[np.asarray(indices)]
+
+    if threads == 1:
+        arcs_flow_v = _as_row(arcs_flow)
+        turns_flow_v = _as_row(turns_flow)
+    else:
+        arcs_flow_v, turns_flow_v = workspace.flow_buffers(
+            turns_flow.shape[0])
+
+    if settled_count is None:
+        settled_count = np.empty(sources.shape[0], np.intp)
+    settled_count[:] = 0
+    cdef Py_ssize_t[::1] settled_count_v = settled_count
+
+    if select is None:
+        select = _no_select(sources.shape[0], (1, values.shape[0]))
+    cdef Py_ssize_t[:] sel_arc = select[0], zone_row = select[2]
+    cdef DTYPE_t[:, :] sel_flow = select[1]
+    cdef DTYPE_t[:, ::1] zone_flow = select[3]
+
+    with nogil:
+        _c_sparse_all_or_nothing(rows, sources, indptr, nz_targets, values,
+                                 idx, ID, end_node, weight, flag, turn_idx,
+                                 from_link, to_link, delay, max_node, dist,
+                                 node_pred, arc_pred, marker, h_val, h_ref,
+                                 h_pos, touched_arc, touched_node, settled,
+                                 counts, is_dest, load, arcs_flow_v, a, b,
+                                 turns_flow_v, settled_count_v, threads,
+                                 tree, sel_arc, sel_flow, zone_row,
+                                 zone_flow)
+
+    if threads > 1:
+        # Reduce in thread order to keep the sums deterministic.
+        flows = np.asarray(arcs_flow)
+        t_flows = np.asarray(turns_flow)
+        for t in range(threads):
+            flows += arcs_flow_v[t]
+            t_flows += turns_flow_v[t]
+
+
+def c_single_all_or_nothing(UTYPE_t source,
+                            UTYPE_t[:] targets,
+                            DTYPE_t[:] matrix,
+                            UTYPE_t[:] idx,
+                            UTYPE_t[:] ID,
+                            UTYPE_t[:] end_node,
+                            DTYPE_t[:] weight,
+                            UTYPE8_t[:] flag,
+                            UTYPE_t[:] turn_idx,
+                            UTYPE_t[:] from_link,
+                            UTYPE_t[:] to_link,
+                            DTYPE_t[:] delay,
+                            DTYPE_t[::1] arcs_flow,
+                            UTYPE_t[:] a,
+                            UTYPE_t[:] b,
+                            DTYPE_t[::1] turns_flow,
+                            workspace,
+                            bint tree=False):
     """All_or_Nothing assignment from single source node to other nodes.
 
     Parameters
@@ -503,19 +1233,6 @@ def c_single_all_or_nothing(UTYPE16_t source,
         A field of turn_table, ``turn_table['TO']``.
     delay : ndarray
         A field of turn_table, ``turn_table['DELAY']`` or you can specify.
-    dist : ndarray
-        A ndarray used to store the shortest distance from source node to
-        each arc. It uses arc's row number to index, so the length of it
-        should be same as ``Net._data``. And the initial value should be
-        all INFs.
-    node_pred : ndarray
-        A ndarray used to store the node's preceding arc's row number. It
-        uses node's ID to index, the length of it should be big enough to
-        contain the biggest node ID. And initial value should be all NONEs.
-    arc_pred : ndarray
-        A ndarray used to store the arc's preceding arc's row number. It
-        uses arc's row number to index, so the length of it should be same
-        as ``Net._data``. And the initial value should be all NONEs.
     arcs_flow : ndarray
         The ndarray to be filled with the acrs's flow.
     a, b : ndarray
@@ -523,11 +1240,219 @@ def c_single_all_or_nothing(UTYPE16_t source,
         input value should be all NONEs.
     turns_flow : ndarray
         The ndarray to be fill with the acrs's flow.
+    workspace : ShortestPathWorkspace
+        The workspace of the net, row 0 is used.
+    tree : bool, optional
+        Load the flow by one sweep over the shortest path tree, see
+        `c_all_or_nothing`. Default: `False`.
+
+    Returns
+    -------
+    int
+        Number of nodes settled by the search, see `c_all_or_nothing`.
 
     See Also
     --------
     c_all_or_nothing
     """
-    _c_single_all_or_nothing(source, targets, matrix, idx, ID, end_node, weight, 
-                             flag, turn_idx, from_link, to_link, delay, dist, 
-                             node_pred, arc_pred, arcs_flow, a, b, turns_flow)
\ No newline at end of file
+    cdef DTYPE_t[:, ::1] dist = workspace.dist, h_val = workspace.h_val
+    cdef UTYPE_t[:, ::1] node_pred = workspace.node_pred
+    cdef UTYPE_t[:, ::1] arc_pred = workspace.arc_pred
+    cdef UTYPE_t[:, ::1] h_ref = workspace.h_ref, h_pos = workspace.h_pos
+    cdef UTYPE_t[:, ::1] touched_arc = workspace.touched_arc
+    cdef UTYPE_t[:, ::1] touched_node = workspace.touched_node
+    cdef UTYPE_t[:, ::1] settled = workspace.settled
+    cdef UTYPE8_t[:, ::1] marker = workspace.marker
+    cdef Py_ssize_t[:, ::1] counts = workspace.counts
+    cdef DTYPE_t[:, ::1] arcs_flow_v = _as_row(arcs_flow)
+    cdef DTYPE_t[:, ::1] turns_flow_v = _as_row(turns_flow)
+    cdef DTYPE_t[:, ::1] load = workspace.load
+    cdef UTYPE8_t[:, ::1] is_dest = workspace.is_dest
+    cdef Py_ssize_t max_node = workspace.node_count
+    cdef Py_ssize_t count
+    select = _no_select(1, (1, 1))
+    cdef Py_ssize_t[:] sel_arc = select[0]
+    cdef DTYPE_t[:, :] sel_flow = select[1]
+    cdef DTYPE_t[:, ::1] zone_flow = select[3]
+    with nogil:
+        count = _aon_origin(source, targets, matrix, idx, ID, end_node,
+                            weight, flag, turn_idx, from_link, to_link,
+                            delay, max_node, 0, dist, node_pred, arc_pred,
+                            marker, h_val, h_ref, h_pos, touched_arc,
+                            touched_node, settled, counts, is_dest, load,
+                            arcs_flow_v, a, b, turns_flow_v, tree, sel_arc,
+                            sel_flow, -1, zone_flow)
+    return count
+
+
+# BPR link performance function and the line search of Frank-Wolfe. All
+# arrays hold one value per arc, the parameters are broadcast by the caller.
+cdef inline DTYPE_t _power(DTYPE_t x, DTYPE_t e) nogil:
+    """``x ** e``, by multiplication when `e` is a small whole number."""
+    cdef int n = <int> e
+    cdef DTYPE_t y = 1
+    if n != e or n < 0 or n > 16:
+        return pow(x, e)
+    while n:
+        if n & 1:
+            y *= x
+        x *= x
+        n >>= 1
+    return y
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _bpr_line_derivative(DTYPE_t step,
+                               DTYPE_t[::1] arcs_flow,
+                               DTYPE_t[::1] diff,
+                               DTYPE_t[::1] time0,
+                               DTYPE_t[::1] alpha,
+                               DTYPE_t[::1] beta,
+                               DTYPE_t[::1] capacity,
+                               DTYPE_t[::1] preload,
+                               DTYPE_t *g,
+                               DTYPE_t *h) nogil:
+    cdef Py_ssize_t i
+    cdef DTYPE_t d, ratio, p, g_sum = 0, h_sum = 0
+    for i in range(diff.shape[0]):
+        d = diff[i]
+        if d == 0:
+            continue
+        ratio = (arcs_flow[i] + step * d + preload[i]) / capacity[i]
+        if ratio > 0:
+            p = time0[i] * alpha[i] * _power(ratio, beta[i] - 1)
+        else:
+            p = 0
+        g_sum += d * (time0[i] + p * ratio)
+        h_sum += d * d * p * beta[i] / capacity[i]
+    g[0] = g_sum
+    h[0] = h_sum
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def bpr_line_derivative(DTYPE_t step,
+                        DTYPE_t[::1] arcs_flow,
+                        DTYPE_t[::1] diff,
+                        DTYPE_t[::1] time0,
+                        DTYPE_t[::1] alpha,
+                        DTYPE_t[::1] beta,
+                        DTYPE_t[::1] capacity,
+                        DTYPE_t[::1] preload):
+    """First and second derivative of the Beckmann objective along `diff`.
+
+    With ``x = arcs_flow + step * diff + preload``, they are
+    ``sum(diff * t(x))`` and ``sum(diff ** 2 * t'(x))``, `t` is the BPR
+    function. Both are evaluated in one pass without allocation.
+
+    Returns
+    -------
+    g, h : float
+    """
+    cdef DTYPE_t g, h
+    with nogil:
+        _bpr_line_derivative(step, arcs_flow, diff, time0, alpha, beta,
+                             capacity, preload, &g, &h)
+    return g, h
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def bpr_line_search(DTYPE_t[::1] arcs_flow,
+                    DTYPE_t[::1] diff,
+                    DTYPE_t[::1] time0,
+                    DTYPE_t[::1] alpha,
+                    DTYPE_t[::1] beta,
+                    DTYPE_t[::1] capacity,
+                    DTYPE_t[::1] preload,
+                    DTYPE_t tolerance=1e-4,
+                    int max_iter=50):
+    """Best step in [0, 1] along `diff` by safeguarded Newton steps.
+
+    The derivative `g` of the objective increases with the step. Newton
+    steps are taken inside a bracket of the root, a secant step between the
+    bracket ends is taken instead when the Newton step leaves it.
+
+    Parameters
+    ----------
+    arcs_flow, diff : ndarray
+        Current arcs flow and the search direction.
+    time0, alpha, beta, capacity, preload : ndarray
+        Parameters of the BPR function for each arc.
+    tolerance : float, optional
+        Stop when ``abs(g) <= tolerance * abs(g(0))``. Default: 1e-4.
+    max_iter : int, optional
+        Maximum number of evaluations after the two ends. Default: 50.
+
+    Returns
+    -------
+    step : float
+    evaluations : int
+        Number of evaluations of the derivatives.
+    """
+    cdef DTYPE_t lo = 0, hi = 1, g_lo, g_hi, g, h, x, x_new, target
+    cdef int n = 1
+    with nogil:
+        _bpr_line_derivative(0, arcs_flow, diff, time0, alpha, beta,
+                             capacity, preload, &g_lo, &h)
+        x = 0
+        if g_lo < 0:
+            target = -tolerance * g_lo
+            _bpr_line_derivative(1, arcs_flow, diff, time0, alpha, beta,
+                                 capacity, preload, &g_hi, &h)
+            n += 1
+            x = 1
+            if g_hi > 0:
+                # Start from the secant point of the two ends.
+                x = lo - g_lo * (hi - lo) / (g_hi - g_lo)
+            while g_hi > 0 and n < max_iter + 2:
+                _bpr_line_derivative(x, arcs_flow, diff, time0, alpha, beta,
+                                     capacity, preload, &g, &h)
+                n += 1
+                if fabs(g) <= target:
+                    break
+                if g < 0:
+                    lo = x
+                    g_lo = g
+                else:
+                    hi = x
+                    g_hi = g
+                if hi - lo <= 1e-12:
+                    break
+                x_new = x - g / h if h > 0 else lo
+                if not lo < x_new < hi:
+                    x_new = lo - g_lo * (hi - lo) / (g_hi - g_lo)
+                x = x_new
+    return x, n
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def bpr_update(DTYPE_t[::1] time0,
+               DTYPE_t[::1] alpha,
+               DTYPE_t[::1] beta,
+               DTYPE_t[::1] capacity,
+               DTYPE_t[::1] preload,
+               DTYPE_t[::1] arcs_flow,
+               DTYPE_t[::1] time,
+               DTYPE_t[::1] der=None):
+    """Arcs time, and its derivative if `der` is given, in one pass.
+
+    The same as `bpr_fun` and `bpr_derivative` in ``assignment``,
+    `preload` may be None.
+    """
+    cdef Py_ssize_t i
+    cdef DTYPE_t ratio
+    cdef bint with_der = der is not None
+    cdef bint with_preload = preload is not None
+    with nogil:
+        for i in range(time.shape[0]):
+            ratio = arcs_flow[i]
+            if with_preload:
+                ratio += preload[i]
+            ratio /= capacity[i]
+            time[i] = (_power(ratio, beta[i]) * alpha[i] + 1) * time0[i]
+            if with_der:
+                der[i] = (_power(ratio, beta[i] - 1) * alpha[i] * beta[i] *
+                          time0[i] / capacity[i])
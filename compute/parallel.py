@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Zhanhong Cheng
+"""
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+import transpy as tp
+from transpy.compute.core import c_all_or_nothing, \
+    c_sparse_all_or_nothing, ShortestPathWorkspace
+
+__all__ = ['SharedArrays', 'ProcessAON']
+
+# Arrays attached by each worker process, see `_init_worker`.
+_worker = {}
+
+
+class SharedArrays(object):
+    """把一组 ndarray 放入共享内存, 供其他进程按名称挂载.
+
+    Parameters
+    ----------
+    arrays : dict
+        键为名称, 值为 ndarray. 结构数组也可以放入共享内存.
+
+    Attributes
+    ----------
+    arrays : dict
+        位于共享内存中的 ndarray, 与输入的 `arrays` 内容相同.
+    spec : dict
+        可被 pickle 的描述信息, 其他进程用 `attach` 据此挂载这些数组.
+    """
+
+    def __init__(self, arrays):
+        self._shm = []
+        self.arrays = {}
+        self.spec = {}
+        for name, arr in arrays.items():
+            arr = np.ascontiguousarray(arr)
+            # Zero-size blocks are not allowed.
+            shm = shared_memory.SharedMemory(create=True,
+                                             size=max(arr.nbytes, 1))
+            self._shm.append(shm)
+            shared = np.ndarray(arr.shape, arr.dtype, buffer=shm.buf)
+            shared[...] = arr
+            self.arrays[name] = shared
+            self.spec[name] = (shm.name, arr.shape, arr.dtype)
+
+    @staticmethod
+    def attach(spec):
+        """根据 `spec` 挂载共享内存中的数组.
+
+        Returns
+        -------
+        arrays : dict
+        handles : list
+            共享内存句柄, 需在数组使用期间保持引用.
+        """
+        arrays = {}
+        handles = []
+        for name, (shm_name, shape, dtype) in spec.items():
+            shm = shared_memory.SharedMemory(name=shm_name)
+            handles.append(shm)
+            arrays[name] = np.ndarray(shape, dtype, buffer=shm.buf)
+        return arrays, handles
+
+    def close(self):
+        """释放并删除所有共享内存."""
+        self.arrays.clear()
+        for shm in self._shm:
+            shm.close()
+            shm.unlink()
+        self._shm = []
+
+
+def _memmap_spec(arr):
+    """可被 pickle 的描述信息, 其他进程用 `_map_file` 据此重新映射
+    `np.memmap` 视图 `arr`, 不经过复制."""
+    root = arr
+    while isinstance(root.base, np.ndarray):
+        root = root.base
+    # The root is mapped from `root.offset` of the file.
+    start = (arr.__array_interface__['data'][0] -
+             root.__array_interface__['data'][0] + root.offset)
+    return arr.filename, start, arr.shape, arr.dtype, arr.strides
+
+
+def _map_file(spec):
+    filename, start, shape, dtype, strides = spec
+    # Copy-on-write, the kernels take writable buffers but never write.
+    return np.ndarray(shape, dtype, np.memmap(filename, np.uint8, 'c'),
+                      start, strides)
+
+
+def _init_worker(spec, threads, tree, mapped=None, block_rows=0):
+    arrays, handles = SharedArrays.attach(spec)
+    if mapped is not None:
+        arrays['matrix'] = _map_file(mapped)
+    _worker['arrays'] = arrays
+    _worker['handles'] = handles
+    _worker['tree'] = tree
+    _worker['block_rows'] = block_rows
+    _worker['workspace'] = ShortestPathWorkspace.from_arrays(
+        arrays['net']['END_NODE'], arrays['r_idx'].shape[0], threads)
+
+
+def _aon_batch(start, stop):
+    """在工作进程中对 OD 矩阵的第 `start` 至 `stop` 行进行全有全无分配."""
+    arr = _worker['arrays']
+    data = arr['net']
+    arcs_flow = np.zeros(data.shape, np.float64)
+    turns_flow = np.zeros(arr['turns_flow'].shape, np.float64)
+    settled_count = np.zeros(stop - start, np.intp)
+    if 'indptr' in arr:
+        # Positions in indptr are kept, no need to shift them.
+        c_sparse_all_or_nothing(arr['sources'][start:stop], arr['targets'],
+                                arr['indptr'][start:stop + 1],
+                                arr['indices'], arr['values'], arr['idx'],
+                                data['ID'], data['END_NODE'], arr['time'],
+                                arr['flag'], arr['turn_idx'],
+                                arr['from_link'], arr['to_link'],
+                                arr['delay'], arcs_flow, arr['a'], arr['b'],
+                                turns_flow, _worker['workspace'],
+                                _worker['tree'], settled_count)
+        return arcs_flow, turns_flow, settled_count
+    step = _worker['block_rows'] or stop - start
+    for first in range(start, stop, step):
+        last = min(first + step, stop)
+        block = np.asarray(arr['matrix'][first:last], np.float64)
+        c_all_or_nothing(arr['sources'][first:last], arr['targets'], block,
+                         arr['idx'], data['ID'], data['END_NODE'],
+                         arr['time'], arr['flag'], arr['turn_idx'],
+                         arr['from_link'], arr['to_link'], arr['delay'],
+                         arcs_flow, arr['a'], arr['b'], turns_flow,
+                         _worker['workspace'], _worker['tree'],
+                         settled_count[first - start:last - start])
+    return arcs_flow, turns_flow, settled_count
+
+
+class ProcessAON(object):
+    """用进程池进行全有全无分配.
+
+    `Net` 的数据, 转向表, OD 矩阵等在创建时一次性放入共享内存, 每次分配时
+    只需更新共享内存中的路段时间, 各进程返回各自负责的起点的弧流量与转向流量.
+    适用于无法使用 OpenMP 的情形.
+
+    Parameters
+    ----------
+    net : Net
+    sources, targets : ndarray
+        OD 矩阵的行列索引, 类型为 ``net.id_type``.
+    matrix : ndarray or SparseMatrix
+        二维的 OD 矩阵, 或稀疏的 OD 矩阵. 为 `np.memmap` (如
+        `load_bin_matrix` 得到的矩阵) 时不放入共享内存, 各进程按文件名
+        重新映射.
+    flag, turn_idx, from_link, to_link, delay : ndarray
+        由 `get_sp_param` 得到的转向参数.
+    a, b, turns_flow : ndarray
+        由 `prepare_focus_nodes` 得到的转向流量索引.
+    processes : int
+        进程数.
+    threads : int, optional
+        每个进程内的线程数. Default: 1.
+    tree : bool, optional
+        是否扫描最短路树加载流量, 见 `c_all_or_nothing`. Default: `False`.
+    block_rows : int, optional
+        各进程每次读入的 OD 矩阵行数, 见 `get_row_blocks`. 为 0 时一次读入
+        整批. Default: 0.
+
+    Notes
+    -----
+    起点被均分为若干批, 结果按批的顺序相加, 故进程数固定时结果是确定的.
+    使用完后需调用 `close`, 或使用 ``with`` 语句.
+    """
+
+    def __init__(self, net, sources, targets, matrix, flag, turn_idx,
+                 from_link, to_link, delay, a, b, turns_flow, processes,
+                 threads=1, tree=False, block_rows=0):
+        arrays = {
+            'net': net._data, 'idx': net.idx, 'r_idx': net.r_idx,
+            'trace': net.trace, 'flag': flag, 'turn_idx': turn_idx,
+            'from_link': from_link, 'to_link': to_link, 'delay': delay,
+            'sources': sources, 'targets': targets, 'a': a, 'b': b,
+            'turns_flow': turns_flow,
+            'time': np.zeros(net._data.shape, np.float64)}
+        mapped = None
+        if isinstance(matrix, tp.SparseMatrix):
+            arrays['indptr'] = matrix.indptr
+            arrays['indices'] = matrix.indices
+            arrays['values'] = np.asarray(matrix.values, np.float64)
+        elif isinstance(matrix, np.memmap) and matrix.filename is not None:
+            mapped = _memmap_spec(matrix)
+        else:
+            arrays['matrix'] = np.asarray(matrix, np.float64)
+        self.shared = SharedArrays(arrays)
+        self.time = self.shared.arrays['time']
+        rows = len(sources)
+        bounds = np.linspace(0, rows, min(rows, processes * 4) + 1)
+        bounds = np.unique(bounds.astype(np.int64))
+        self.batches = list(zip(bounds[:-1], bounds[1:]))
+        self.pool = mp.Pool(processes, _init_worker,
+                            (self.shared.spec, threads, tree, mapped,
+                             block_rows))
+
+    def all_or_nothing(self, time, arcs_flow, turns_flow,
+                       settled_count=None, select=None):
+        """以 `time` 为权重分配, 结果累加到 `arcs_flow` 与 `turns_flow`.
+        给出 `settled_count` 时记录每个起点搜索确定的节点数. 与进程内的
+        AON 参数相同, 但不支持 `select`, 须为 None."""
+        if select is not None:
+            raise ValueError('Select-link and select-zone analysis are not '
+                             'supported with processes > 1.')
+        self.time[:] = time
+        results = self.pool.starmap(_aon_batch, self.batches)
+        for (start, stop), (flow, t_flow, count) in zip(self.batches,
+                                                        results):
+            arcs_flow += flow
+            turns_flow += t_flow
+            if settled_count is not None:
+                settled_count[start:stop] = count
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.shared.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Zhanhong Cheng
+"""
+import numpy as np
+import transpy as tp
+from transpy.compute.assignment import AssignSummary, Counter, \
+    log_iteration, get_assign_param, prepare_focus_nodes, get_od_idx, \
+    bpr_fun, bpr_derivative, net_to_link_flow, full_param, WarmStart, \
+    _get_turn_data_from_runtime, _cold_iterations
+from transpy.compute.shortest_way import get_sp_param
+from transpy.classes.convert import csr_offsets
+from transpy.compute.core import turn_dijikstra, ShortestPathWorkspace
+from transpy.compute.vdf import VDFGroups
+from transpy.compute.bush import get_transitions, _as_intp
+from transpy.compute.path_core import PathStore, project
+
+INF = np.inf
+
+
+class Routes:
+    """由路径分配得到的路径及其流量.
+
+    Attributes
+    ----------
+    data : structured array
+        每条路径一行, 包括 `O`, `D`, `FLOW`, `COST` 这几个域, `COST` 包括
+        转向延误.
+    store : PathStore
+        保存路径的弧序列.
+    path : ndarray
+        每一行对应的路径在 `store` 中的编号.
+    """
+    __slots__ = ('data', 'store', 'path', '_link_id')
+
+    def __init__(self, data, store, path, link_id):
+        self.data = data
+        self.store = store
+        self.path = path
+        self._link_id = link_id
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def links(self, k):
+        """第 `k` 条路径所经过的路段 `ID`, 与 `pred_to_link` 相同."""
+        return list(self._link_id[self.store.path(self.path[k])])
+
+
+def path_equilibrium(net, matrix, link_table, cfg, passes=3,
+                     warm_start=None):
+    """基于路径的用户均衡分配 (梯度投影法).
+
+    每个 OD 对保留一组路径, 每次迭代先用当前路阻搜索最短路并加入路径组,
+    再把各路径的流量按牛顿步长转移到最短路径上. 路径以弧序列的形式去重
+    保存在 `PathStore` 中, 分配结束后可以直接输出路径流量.
+
+    Parameters
+    ----------
+    net : Net
+    matrix : Matrix
+        稠密的 OD 矩阵, 不支持 `SparseMatrix`.
+    link_table : IDTable
+    cfg : AssignConfig
+        使用其中的 `time_field`, `capacity_field`, `alpha_field`,
+        `beta_field`, `preload_field`, `turn_delay_type`, `focus_nodes`,
+        `convergence`, `max_iteration` 与 `print_frequency`. 路阻函数只能
+        是 BPR, 即 `cfg.vdf` 与 `cfg.arc_type_dict` 中的 'vdf' 均为 'bpr'.
+    passes : int, optional
+        每次迭代中转移流量的最多轮数. Default: 3.
+    warm_start : WarmStart, optional
+        由 `path_equilibrium` 得到的结果. 每个 OD 对的原有路径按原来的比
+        例分配新的需求, 没有原有路径的 OD 对使用最短路. Default: `None`.
+
+    Returns
+    -------
+    flow_data : structured array
+        一个记录着分配结果的结构数组，它包括 `ID`, `AB_FLOW`, `BA_FLOW` 这几个域.
+    turn_data : structured array
+        一个记录着交叉口转向流量的结构数组，它包括 `ID`, `FROM`, `TO`, `FLOW` 这
+        几个域. 只有在 `cfg.focus_node` 中指明的交叉口才记录转向.
+    summary : AssignSummary
+        记录着分配迭代过程的结构, 没有步长, `step` 中记为 NAN.
+        `path_store_nbytes` 为保存路径所用的内存, `routes` 为有流量的路径,
+        `warm_start` 中也保存了 `routes`.
+
+    See Also
+    --------
+    user_equilibrium, bush_equilibrium
+    """
+    # Basic setup
+    if not isinstance(matrix, tp.Matrix):
+        raise TypeError('path_equilibrium needs a dense Matrix.')
+    summary = AssignSummary()
+    data = net._data
+    shape = data.shape
+    type_field = cfg.arc_type_field
+    type_dict = cfg.arc_type_dict
+    counter = Counter(cfg.print_frequency)
+
+    # Setup about BPR function parameters, the kernel needs full arrays.
+    def full(value):
+        return full_param(value, shape)
+
+    time0 = full(get_assign_param(data, cfg.time_field, type_field,
+                                  type_dict))
+    capacity = full(get_assign_param(data, cfg.capacity_field, type_field,
+                                     type_dict))
+    # The kernel moves flow by the times and derivatives of BPR.
+    if not VDFGroups(data, cfg, time0, capacity).single_bpr:
+        raise ValueError('path_equilibrium supports only the BPR function.')
+    alpha = full(get_assign_param(data, cfg.alpha_field, type_field,
+                                  type_dict, cfg.global_alpha))
+    beta = full(get_assign_param(data, cfg.beta_field, type_field,
+                                 type_dict, cfg.global_beta))
+    if cfg.preload_field:
+        preload_flow = full(get_assign_param(data, cfg.preload_field,
+                                             type_field, type_dict))
+    else:
+        preload_flow = np.zeros(shape, np.float64)
+
+    arcs_flow = np.zeros(shape, np.float64)
+    time = np.empty(shape, np.float64)
+    der = np.empty(shape, np.float64)
+    mark = np.full(shape, -1, np.intp)
+    bpr_fun(time0, alpha, beta, capacity, time, arcs_flow, preload_flow)
+
+    # Setup about shortest path and OD pairs
+    flag, turn_idx, from_link, to_link, delay = \
+        get_sp_param(net, cfg.turn_delay_type)
+    sources, targets = get_od_idx(net, matrix)
+    workspace = ShortestPathWorkspace(net)
+    trans = get_transitions(net, flag, turn_idx, from_link, to_link, delay)
+    targets_p = np.asarray(targets, np.intp)
+    demand = np.asarray(matrix._data, np.float64)
+    none = net.none
+    if warm_start is None:
+        store = PathStore()
+    elif warm_start.routes is None:
+        raise ValueError('The warm start has no routes.')
+    else:
+        store = warm_start.routes.store
+
+    # OD pairs with demand, the paths of pair k are
+    # od_path[od_off[k]:od_off[k + 1]].
+    od_o, od_d = np.nonzero((demand > 0) &
+                            (sources[:, None] != targets[None, :]))
+    od_num = od_o.shape[0]
+    od_off = np.zeros(od_num + 1, np.intp)
+    od_path = np.empty(0, np.intp)
+    path_flow = np.zeros(0, np.float64)
+
+    def generate_columns():
+        """Search with current time, return SPTT and the shortest paths."""
+        sptt = 0
+        path_id = np.full(od_num, -1, np.intp)
+        for i in np.unique(od_o):
+            source = sources[i]
+            turn_dijikstra(net.idx, data['ID'], data['END_NODE'], time, flag,
+                           source, 0, INF, np.iinfo(np.intp).max, turn_idx,
+                           from_link, to_link, delay, workspace)
+            dist, node_pred, arc_pred = workspace.result()
+            pairs = np.nonzero(od_o == i)[0]
+            dests = targets_p[od_d[pairs]]
+            ids = np.empty(pairs.shape[0], np.intp)
+            new = np.empty(pairs.shape[0], np.uint8)
+            store.generate(_as_intp(arc_pred, none),
+                           _as_intp(node_pred, none), dests,
+                           trans['node_start'], trans['end_node'],
+                           trans['t_off'], trans['t_delay'], ids, new)
+            path_id[pairs] = ids
+            reached = ids >= 0
+            pred = node_pred[dests[reached]]
+            sptt += np.sum(demand[i, od_d[pairs[reached]]] * dist[pred])
+        return sptt, path_id
+
+    def add_columns(path_id):
+        """Append the new paths to the path set of their OD pair."""
+        # A path belongs to one OD pair only, but the store may hold paths
+        # of a warm start which are in no path set.
+        in_set = np.zeros(store.path_num, bool)
+        in_set[od_path] = True
+        is_new = path_id >= 0
+        is_new[is_new] = ~in_set[path_id[is_new]]
+        add = is_new.astype(np.intp)
+        old_num = np.diff(od_off)
+        new_off = np.zeros(od_num + 1, np.intp)
+        np.cumsum(old_num + add, out=new_off[1:])
+        new_path = np.empty(new_off[-1], np.intp)
+        shift = np.repeat(new_off[:-1] - od_off[:-1], old_num)
+        new_path[np.arange(od_path.shape[0]) + shift] = od_path
+        new_path[new_off[1:][is_new] - 1] = path_id[is_new]
+        flow = np.zeros(store.path_num, np.float64)
+        flow[:path_flow.shape[0]] = path_flow
+        return new_off, new_path, flow
+
+    # Initial paths are the shortest paths at free flow. With a warm start
+    # the old paths of an OD pair share its demand in their old proportion.
+    old_flow = np.zeros(od_num, np.float64)
+    if warm_start is not None:
+        od_off, od_path, path_flow, old_flow = _warm_paths(
+            warm_start.routes, sources, targets, od_o, od_d, demand,
+            store.path_num)
+    _, path_id = generate_columns()
+    od_off, od_path, path_flow = add_columns(path_id)
+    reached = (path_id >= 0) & (old_flow == 0)
+    np.add.at(path_flow, path_id[reached], demand[od_o, od_d][reached])
+    np.add.at(arcs_flow, store.arcs,
+              np.repeat(path_flow, np.diff(store.start)))
+    bpr_fun(time0, alpha, beta, capacity, time, arcs_flow, preload_flow)
+    bpr_derivative(time0, alpha, beta, capacity, der, arcs_flow,
+                   preload_flow)
+
+    # Main loop
+    for i in range(1, cfg.max_iteration):
+        last_flow = arcs_flow.copy()
+        for _ in range(passes):
+            if project(store, od_off, od_path, path_flow, time0, alpha, beta,
+                       capacity, preload_flow, time, der, arcs_flow,
+                       mark) == 0:
+                break
+        summary.step.append(np.nan)
+
+        # Max Flow Change
+        max_flow_change = np.abs(arcs_flow - last_flow).max()
+        summary.max_flow_change.append(max_flow_change)
+
+        # Relative Gap, the new shortest paths join the path sets.
+        tstt = (np.sum(time * arcs_flow) +
+                np.sum(path_flow * store.delay))
+        sptt, path_id = generate_columns()
+        relative_gap = 1 - sptt / tstt
+        summary.relative_gap.append(relative_gap)
+        od_off, od_path, path_flow = add_columns(path_id)
+
+        # whether to log
+        if counter.add():
+            log_iteration(i, relative_gap, max_flow_change)
+
+        # Check convergence
+        if relative_gap <= cfg.convergence:
+            summary.equilibrium_reached = True
+            break
+    summary.path_store_nbytes = store.nbytes
+
+    # Turns flow at focus nodes
+    a, b, turns_flow = prepare_focus_nodes(net, cfg.focus_nodes)
+    arcs = store.arcs
+    arc_flow = np.repeat(path_flow, np.diff(store.start))
+    if a.shape[0] != 1:
+        # Consecutive arcs of the same path.
+        same = np.ones(arcs.shape[0] - 1, bool)
+        same[store.start[1:-1] - 1] = False
+        tail = arcs[:-1][same]
+        head = arcs[1:][same]
+        focus = a[tail] != none
+        np.add.at(turns_flow,
+                  a[tail[focus]].astype(np.intp) + b[head[focus]],
+                  arc_flow[:-1][same][focus])
+
+    flow_data = net_to_link_flow(link_table, net, arcs_flow)
+    turn_data = _get_turn_data_from_runtime(net, a, b, turns_flow)
+
+    # Routes with flow
+    used = np.nonzero(path_flow[od_path] > 0)[0]
+    pairs = np.repeat(np.arange(od_num), np.diff(od_off))[used]
+    paths = od_path[used]
+    cost = np.add.reduceat(time[arcs], store.start[:-1]) + store.delay
+    route_data = np.empty(used.shape[0], [('O', net.id_type),
+                                          ('D', net.id_type),
+                                          ('FLOW', np.float64),
+                                          ('COST', np.float64)])
+    route_data['O'] = sources[od_o[pairs]]
+    route_data['D'] = targets[od_d[pairs]]
+    route_data['FLOW'] = path_flow[paths]
+    route_data['COST'] = cost[paths]
+    routes = Routes(route_data, store, paths, data['ID'])
+    summary.routes = routes
+    summary.warm_start = WarmStart([matrix], [arcs_flow], [turns_flow],
+                                   _cold_iterations(summary, warm_start),
+                                   routes=routes)
+
+    return flow_data, turn_data, summary
+
+
+def _warm_paths(routes, sources, targets, od_o, od_d, demand, path_num):
+    """把 `routes` 的路径按 OD 对排列, 并按原流量的比例分配新的需求.
+
+    Returns
+    -------
+    od_off, od_path, path_flow : ndarray
+        同 `path_equilibrium` 中的路径组.
+    old_flow : ndarray
+        每个 OD 对原有路径的总流量.
+    """
+    od_num = od_o.shape[0]
+    pair_of = np.full(demand.shape, -1, np.intp)
+    pair_of[od_o, od_d] = np.arange(od_num)
+    rows = _find_idx(sources, routes.data['O'])
+    cols = _find_idx(targets, routes.data['D'])
+    pair = np.full(rows.shape[0], -1, np.intp)
+    found = (rows >= 0) & (cols >= 0)
+    pair[found] = pair_of[rows[found], cols[found]]
+    used = np.nonzero(pair >= 0)[0]
+    used = used[np.argsort(pair[used], kind='stable')]
+    pair = pair[used]
+
+    od_off = csr_offsets(pair, od_num)
+    od_path = np.asarray(routes.path, np.intp)[used]
+    flow = routes.data['FLOW'][used]
+    old_flow = np.bincount(pair, flow, od_num)
+    path_flow = np.zeros(path_num, np.float64)
+    path_flow[od_path] = flow * demand[od_o, od_d][pair] / old_flow[pair]
+    return od_off, od_path, path_flow, old_flow
+
+
+def _find_idx(idx, ids):
+    """`ids` 在 `idx` 中的位置, 不在其中的为 -1."""
+    idx = np.asarray(idx)
+    order = np.argsort(idx, kind='stable')
+    pos = np.searchsorted(idx[order], ids)
+    pos[pos == idx.shape[0]] = 0
+    return np.where(idx[order][pos] == ids, order[pos], -1)
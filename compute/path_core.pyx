@@ -0,0 +1,266 @@
+# -*- python -*-
+"""Path-based user equilibrium kernels written in Cython.
+
+Paths are sequences of arcs (row numbers of ``Net._data``). A
+``PathStore`` keeps them once each in flat arrays: the arcs of path `p`
+are ``arcs[start[p]:start[p + 1]]``, ``delay[p]`` is the turning delay
+along it. A path is found by its arc sequence through a hash table, so the
+same path is never stored twice.
+
+All index arrays are of type ``np.intp``, -1 is used as NONE.
+
+Author: Zhanhong Cheng
+"""
+import sys
+import numpy as np
+
+cimport numpy as np
+cimport cython
+from libc.math cimport pow
+from cpython.bytes cimport PyBytes_FromStringAndSize
+
+ctypedef np.float64_t DTYPE_t
+ctypedef np.uint8_t UTYPE8_t
+
+cdef DTYPE_t INF = np.inf
+
+
+cdef class PathStore:
+    """Deduplicated paths in flat arrays.
+
+    Parameters
+    ----------
+    capacity : int, optional
+        Initial number of arcs the store can hold, the arrays grow double
+        when full. Default: 1024.
+
+    Attributes
+    ----------
+    path_num : int
+        Number of paths stored.
+    arcs, start, delay : ndarray
+        Views of the stored paths, see the module's doc.
+    """
+    cdef readonly Py_ssize_t path_num
+    cdef Py_ssize_t arc_num
+    cdef object _arcs, _start, _delay
+    cdef dict _index
+
+    def __init__(self, capacity=1024):
+        self._arcs = np.empty(max(capacity, 1), np.intp)
+        self._start = np.zeros(max(capacity // 8, 2), np.intp)
+        self._delay = np.empty(max(capacity // 8, 2), np.float64)
+        self._index = {}
+        self.path_num = 0
+        self.arc_num = 0
+
+    def __len__(self):
+        return self.path_num
+
+    @property
+    def arcs(self):
+        return self._arcs[:self.arc_num]
+
+    @property
+    def start(self):
+        return self._start[:self.path_num + 1]
+
+    @property
+    def delay(self):
+        return self._delay[:self.path_num]
+
+    @property
+    def nbytes(self):
+        """Bytes taken by the arrays and the hash table."""
+        total = (self._arcs.nbytes + self._start.nbytes +
+                 self._delay.nbytes + sys.getsizeof(self._index))
+        for key in self._index:
+            total += sys.getsizeof(key)
+        return total
+
+    def path(self, Py_ssize_t p):
+        """Arcs of path `p`."""
+        return self._arcs[self._start[p]:self._start[p + 1]]
+
+    cdef Py_ssize_t _intern(self, Py_ssize_t[::1] seq, Py_ssize_t n,
+                            DTYPE_t delay, UTYPE8_t *is_new) except -1:
+        """Return the id of path ``seq[:n]``, store it first if new."""
+        key = PyBytes_FromStringAndSize(<char *> &seq[0],
+                                        n * sizeof(Py_ssize_t))
+        p = self._index.get(key)
+        if p is not None:
+            is_new[0] = 0
+            return p
+        p = self.path_num
+        if self.arc_num + n > self._arcs.shape[0]:
+            self._arcs = np.resize(self._arcs,
+                                   max(2 * self._arcs.shape[0],
+                                       self.arc_num + n))
+        if p + 2 > self._start.shape[0]:
+            self._start = np.resize(self._start, 2 * self._start.shape[0])
+            self._delay = np.resize(self._delay, 2 * self._delay.shape[0])
+        self._arcs[self.arc_num:self.arc_num + n] = seq[:n]
+        self.arc_num += n
+        self._start[p + 1] = self.arc_num
+        self._delay[p] = delay
+        self.path_num += 1
+        self._index[key] = p
+        is_new[0] = 1
+        return p
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def generate(self, Py_ssize_t[::1] arc_pred, Py_ssize_t[::1] node_pred,
+                 Py_ssize_t[::1] targets, Py_ssize_t[::1] node_start,
+                 Py_ssize_t[::1] end_node, Py_ssize_t[::1] t_off,
+                 DTYPE_t[::1] t_delay, Py_ssize_t[::1] path_id,
+                 UTYPE8_t[::1] is_new):
+        """Store the shortest paths to `targets` found by a search.
+
+        Parameters
+        ----------
+        arc_pred, node_pred : ndarray
+            Results of ``core.turn_dijikstra``, -1 as NONE.
+        targets : ndarray
+            Destination nodes' ID.
+        node_start, end_node, t_off, t_delay : ndarray
+            The transitions between arcs, see ``bush.get_transitions``.
+        path_id : ndarray
+            Output, the path's id of each target, -1 if not reached.
+        is_new : ndarray
+            Output, 1 if the path was not in the store before.
+        """
+        cdef Py_ssize_t k, a, p, n, i
+        cdef DTYPE_t delay
+        cdef Py_ssize_t[::1] buf = np.empty(arc_pred.shape[0], np.intp)
+        for k in range(targets.shape[0]):
+            a = node_pred[targets[k]]
+            is_new[k] = 0
+            if a < 0:
+                path_id[k] = -1
+                continue
+            # Trace back, then reverse to the forward order.
+            n = 0
+            delay = 0
+            while a >= 0:
+                buf[n] = a
+                n += 1
+                p = arc_pred[a]
+                if p >= 0:
+                    delay += t_delay[t_off[p] + a - node_start[end_node[p]]]
+                a = p
+            for i in range(n // 2):
+                buf[i], buf[n - 1 - i] = buf[n - 1 - i], buf[i]
+            path_id[k] = self._intern(buf, n, delay, &is_new[k])
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void _update_cost(Py_ssize_t a, DTYPE_t[::1] time0,
+                              DTYPE_t[::1] alpha, DTYPE_t[::1] beta,
+                              DTYPE_t[::1] capacity, DTYPE_t[::1] preload,
+                              DTYPE_t[::1] time, DTYPE_t[::1] der,
+                              DTYPE_t[::1] arcs_flow):
+    """Update time and derivative of arc `a` by the BPR function."""
+    cdef DTYPE_t ratio = arcs_flow[a] + preload[a]
+    if ratio < 0:
+        ratio = 0
+    ratio /= capacity[a]
+    time[a] = time0[a] * (1 + alpha[a] * pow(ratio, beta[a]))
+    der[a] = (time0[a] * alpha[a] * beta[a] * pow(ratio, beta[a] - 1) /
+              capacity[a])
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def project(PathStore store, Py_ssize_t[::1] od_off,
+            Py_ssize_t[::1] od_path, DTYPE_t[::1] path_flow,
+            DTYPE_t[::1] time0, DTYPE_t[::1] alpha, DTYPE_t[::1] beta,
+            DTYPE_t[::1] capacity, DTYPE_t[::1] preload, DTYPE_t[::1] time,
+            DTYPE_t[::1] der, DTYPE_t[::1] arcs_flow, Py_ssize_t[::1] mark):
+    """Move flow of every OD pair to its shortest path by a Newton step.
+
+    The paths of OD pair `k` are ``od_path[od_off[k]:od_off[k + 1]]``.
+    Flow moved from path `p` is ``(c_p - c_s) / d``, `c` is the path cost
+    and `d` the sum of time derivative over the arcs not shared with the
+    shortest path `s`, but no more than the flow of `p`. Arcs time and
+    derivative are updated in place after each OD pair.
+
+    Parameters
+    ----------
+    store : PathStore
+    od_off, od_path : ndarray
+        Paths of each OD pair.
+    path_flow : ndarray
+        Flow of each path, updated in place.
+    time0, alpha, beta, capacity, preload : ndarray
+        Parameters of the BPR function, see `bpr_fun`.
+    time, der, arcs_flow : ndarray
+        Arcs time, derivative of time and total arcs flow.
+    mark : ndarray
+        A work array as long as `time`, filled with -1.
+
+    Returns
+    -------
+    float
+        Total flow moved.
+    """
+    cdef Py_ssize_t k, e, p, s, i, a
+    cdef Py_ssize_t[::1] arcs = store._arcs, start = store._start
+    cdef DTYPE_t[::1] delay = store._delay
+    cdef DTYPE_t c, c_s, d_s, d, d_common, dx, moved = 0
+    for k in range(od_off.shape[0] - 1):
+        if od_off[k + 1] - od_off[k] < 2:
+            continue
+        # Shortest path of the OD pair.
+        s = -1
+        c_s = INF
+        for e in range(od_off[k], od_off[k + 1]):
+            p = od_path[e]
+            c = delay[p]
+            for i in range(start[p], start[p + 1]):
+                c += time[arcs[i]]
+            if c < c_s:
+                c_s = c
+                s = p
+        d_s = 0
+        for i in range(start[s], start[s + 1]):
+            mark[arcs[i]] = k
+            d_s += der[arcs[i]]
+
+        for e in range(od_off[k], od_off[k + 1]):
+            p = od_path[e]
+            if p == s or path_flow[p] <= 0:
+                continue
+            c = delay[p]
+            d = d_common = 0
+            for i in range(start[p], start[p + 1]):
+                a = arcs[i]
+                c += time[a]
+                d += der[a]
+                if mark[a] == k:
+                    d_common += der[a]
+            if c <= c_s:
+                continue
+            d += d_s - 2 * d_common
+            dx = path_flow[p]
+            if d > 0 and (c - c_s) / d < dx:
+                dx = (c - c_s) / d
+            path_flow[p] -= dx
+            path_flow[s] += dx
+            moved += dx
+            for i in range(start[p], start[p + 1]):
+                a = arcs[i]
+                arcs_flow[a] -= dx
+                if mark[a] != k:
+                    _update_cost(a, time0, alpha, beta, capacity, preload,
+                                 time, der, arcs_flow)
+            for i in range(start[s], start[s + 1]):
+                arcs_flow[arcs[i]] += dx
+        # Arcs of the shortest path are updated at last.
+        for i in range(start[s], start[s + 1]):
+            a = arcs[i]
+            mark[a] = -1
+            _update_cost(a, time0, alpha, beta, capacity, preload, time, der,
+                         arcs_flow)
+    return moved
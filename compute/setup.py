@@ -1,8 +1,19 @@
 # -*- coding: utf-8 -*-
+import os
 import os.path
 
 base_path = os.path.abspath(os.path.dirname(__file__))
 
+# core.pyx spreads origins over OpenMP threads, set TRANSPY_NO_OPENMP=1 to
+# build without it (the kernels then run in a single thread).
+if os.environ.get('TRANSPY_NO_OPENMP'):
+    openmp_args = openmp_link_args = []
+elif os.name == 'nt':
+    openmp_args = ['/openmp']
+    openmp_link_args = []
+else:
+    openmp_args = openmp_link_args = ['-fopenmp']
+
 
 def configuration(parent_package='', top_path=None):
     from numpy.distutils.misc_util import Configuration, get_numpy_include_dirs
@@ -18,10 +29,21 @@ def configuration(parent_package='', top_path=None):
     # cython(['heap.pyx'], working_path=base_path)
     cythonize('heap.pyx')
     cythonize('core.pyx')
+    cythonize('bush_core.pyx')
+    cythonize('path_core.pyx')
+    cythonize('sue_core.pyx')
 
     config.add_extension('heap', sources=['heap.c'],
                          include_dirs=[get_numpy_include_dirs()])
     config.add_extension('core', sources=['core.c'],
+                         include_dirs=[get_numpy_include_dirs()],
+                         extra_compile_args=openmp_args,
+                         extra_link_args=openmp_link_args)
+    config.add_extension('bush_core', sources=['bush_core.c'],
+                         include_dirs=[get_numpy_include_dirs()])
+    config.add_extension('path_core', sources=['path_core.c'],
+                         include_dirs=[get_numpy_include_dirs()])
+    config.add_extension('sue_core', sources=['sue_core.c'],
                          include_dirs=[get_numpy_include_dirs()])
     return config
 
@@ -5,7 +5,7 @@
 import numpy as np
 import transpy as tp
 from transpy import Net
-from transpy.compute.core import turn_dijikstra
+from transpy.compute.core import turn_dijikstra, ShortestPathWorkspace
 
 NONE = tp.NONE
 INF = np.inf
@@ -14,7 +14,8 @@ ID_TYPE = tp.ID_TYPE
 
 def single_source_shortest_way(net, weight, source, target=None,
                                turn_delay_type='all', max_dist=INF,
-                               max_node=0, return_type='link'):
+                               max_node=0, return_type='link',
+                               workspace=None):
     """
     Parameters
     ----------
@@ -41,10 +42,16 @@ def single_source_shortest_way(net, weight, source, target=None,
         返回值的类型, 为 'DIR' 时返回最距离字典与最短路径字典, 为 'pred' 时
         返回最距离字典与前向节点数组(predecessors), 为 'both' 时返回最距离字
         典,最短路径字典与前向节点数组. Default: 'DIR'.
+    workspace : ShortestPathWorkspace, optional
+        由 `net` 建立的最短路工作区, 多次调用时传入同一个工作区可避免重复
+        分配内存. 为 'pred' 时返回的数组是工作区的视图, 会被下一次搜索覆盖.
+        Default: 新建一个工作区.
     """
     # First prepare basic data
-    flag, turn_idx, from_link, to_link, delay, dist, node_pred, arc_pred = \
+    flag, turn_idx, from_link, to_link, delay = \
         get_sp_param(net, turn_delay_type)
+    if workspace is None:
+        workspace = ShortestPathWorkspace(net)
 
     if target is None:
         target = 0
@@ -55,37 +62,38 @@ def single_source_shortest_way(net, weight, source, target=None,
     # Call inner function find shortest DIR
     turn_dijikstra(net.idx, link_id, data['END_NODE'], weight,
                     flag, source, target, max_dist, max_node,
-                    turn_idx, from_link, to_link, delay, dist,
-                    node_pred, arc_pred)
+                    turn_idx, from_link, to_link, delay, workspace)
+    dist, node_pred, arc_pred = workspace.result()
 
     # According return_type, return corresponding value
     if return_type == 'pred':
         return dist, node_pred, arc_pred
 
+    none = net.none
     r_dist = {}
     path = {}
     if return_type == 'link':
         if target != 0:
-            if node_pred[target] != NONE:
+            if node_pred[target] != none:
                 r_dist[target] = dist[node_pred[target]]
                 path[target] = pred_to_link(arc_pred, node_pred, link_id,
                                             target)
         else:
             for i in range(node_pred.shape[0]):
-                if node_pred[i] != NONE:
+                if node_pred[i] != none:
                     r_dist[i] = dist[node_pred[i]]
                     path[i] = pred_to_link(arc_pred, node_pred, link_id, i)
 
     elif return_type == 'node':
         start_node = data['START_NODE']
         if target != 0:
-            if node_pred[target] != NONE:
+            if node_pred[target] != none:
                 r_dist[target] = dist[node_pred[target]]
                 path[target] = pred_to_node(arc_pred, node_pred, start_node,
                                             target)
         else:
             for i in range(node_pred.shape[0]):
-                if node_pred[i] != NONE:
+                if node_pred[i] != none:
                     r_dist[i] = dist[node_pred[i]]
                     path[i] = pred_to_node(arc_pred, node_pred, start_node, i)
 
@@ -121,11 +129,12 @@ def pred_to_node(arc_pred, node_pred, start_node, target):
     --------
     pred_to_link
     """
+    none = np.iinfo(arc_pred.dtype).max
     pred_line = node_pred[target]
-    if pred_line == NONE:
+    if pred_line == none:
         return []
     path = [target]
-    while pred_line != NONE:
+    while pred_line != none:
         path.append((start_node[pred_line]))
         pred_line = arc_pred[pred_line]
     path.reverse()
@@ -158,9 +167,10 @@ def pred_to_link(arc_pred, node_pred, link_id, target):
     --------
     pred_to_node
     """
+    none = np.iinfo(arc_pred.dtype).max
     path = []
     pred_line = node_pred[target]
-    while pred_line != NONE:
+    while pred_line != none:
         path.append(link_id[pred_line])
         pred_line = arc_pred[pred_line]
     path.reverse()
@@ -168,13 +178,15 @@ def pred_to_link(arc_pred, node_pred, link_id, target):
 
 
 def get_sp_param(net, turn_delay_type):
+    id_type = net.id_type
     if net.turn_table is None:
-        turn_idx = from_link = to_link = np.zeros((1,), np.uint16)
+        turn_idx = from_link = to_link = np.zeros((1,), id_type)
         delay = np.zeros((1,), np.float64)
     else:
-        turn_idx = net.turn_table.idx
-        from_link = net.turn_table['FROM']
-        to_link = net.turn_table['TO']
+        # The kernels need all index arrays in the same width as the net.
+        turn_idx = np.asarray(net.turn_table.idx, id_type)
+        from_link = np.asarray(net.turn_table['FROM'], id_type)
+        to_link = np.asarray(net.turn_table['TO'], id_type)
         delay = net.turn_table['DELAY']
 
     data = net._data
@@ -190,11 +202,4 @@ def get_sp_param(net, turn_delay_type):
         raise ValueError("Wrong turn_delay_type, use 'no','only_ban'"
                          " or 'all'")
 
-    link_num = data.shape[0]
-    node_num = net.r_idx.shape[0]
-    dist = np.full((link_num,), np.inf, np.float64)
-    node_pred = np.full((node_num,), NONE, ID_TYPE)
-    arc_pred = np.full((link_num,), NONE, ID_TYPE)
-
-    return (flag, turn_idx, from_link, to_link, delay,
-            dist, node_pred, arc_pred)
+    return flag, turn_idx, from_link, to_link, delay
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Zhanhong Cheng
+"""
+import numpy as np
+import transpy as tp
+from transpy.compute.assignment import AssignSummary, AssignCache, \
+    Counter, PhaseTimer, IterationInfo, run_hooks, log_iteration, \
+    get_od_idx, _get_turn_data_from_runtime
+from transpy.compute.bush import get_transitions
+from transpy.compute.sue_core import StochKernel
+
+
+def stochastic_user_equilibrium(net, matrix, link_table, cfg, cache=None,
+                                initial_time=None):
+    """随机用户均衡分配 (Logit 模型, 相继平均法).
+
+    每次迭代以当前路阻按 Dial 的 STOCH 算法进行一次随机加载, 再以步长
+    ``1 / k`` 把第 `k` 次迭代的加载结果平均到流量上 (MSA). 加载在弧与弧
+    之间的转向上进行, 考虑转向延误与禁止转向, 每个起点只需一次搜索与前后
+    两次扫描, 不枚举路径.
+
+    Parameters
+    ----------
+    net : Net
+    matrix : Matrix or SparseMatrix
+    link_table : IDTable
+    cfg : AssignConfig
+        使用其中的 `sue_theta` 与 `user_equilibrium` 所用的路阻函数,
+        转向及迭代参数.
+    cache : AssignCache, optional
+        同一网络上多次分配时共用的准备数据. Default: `None`.
+    initial_time : ndarray, optional
+        第一次随机加载使用的路阻, 如由上一时段的流量得到的路阻, 默认为零
+        流量(含预加载)时的路阻. Default: `None`.
+
+    Returns
+    -------
+    flow_data : structured array
+        一个记录着分配结果的结构数组，它包括 `ID`, `AB_FLOW`, `BA_FLOW` 这几个域.
+    turn_data : structured array
+        一个记录着交叉口转向流量的结构数组，它包括 `ID`, `FROM`, `TO`, `FLOW` 这
+        几个域. 只有在 `cfg.focus_node` 中指明的交叉口才记录转向.
+    summary : AssignSummary
+        记录着分配迭代过程的结构. 随机均衡没有相对间隙, `relative_gap` 中
+        记录的是加载流量与当前流量之差的模与当前流量的模之比.
+
+    See Also
+    --------
+    user_equilibrium
+    """
+    # Basic setup
+    summary = AssignSummary()
+    shape = net._data.shape
+    counter = Counter(cfg.print_frequency)
+    theta = float(cfg.sue_theta)
+    if not theta > 0:
+        raise ValueError('sue_theta should be positive.')
+
+    if cache is None:
+        cache = AssignCache(net, link_table)
+
+    # Setup about volume-delay functions
+    vdf = cache.vdf(cfg)
+
+    # Setup about the transitions and the loading kernel
+    flag, turn_idx, from_link, to_link, delay = \
+        cache.sp_param(cfg.turn_delay_type)
+    trans = get_transitions(net, flag, turn_idx, from_link, to_link, delay)
+    kernel = StochKernel(trans['node_start'], trans['end_node'],
+                         trans['t_off'], trans['t_head'], trans['t_delay'])
+    sources, targets = get_od_idx(net, matrix)
+    sources = np.asarray(sources, np.intp)
+    targets = np.asarray(targets, np.intp)
+    sparse = isinstance(matrix, tp.SparseMatrix)
+
+    a, b, turns_flow = cache.focus_nodes(cfg.focus_nodes)
+    count_turn = a.shape[0] != 1
+    trans_num = trans['t_head'].shape[0]
+
+    summary.workspace_nbytes = kernel.nbytes
+
+    def load(time, arcs_flow, trans_flow):
+        with timer.phase('loading'):
+            for i, source in enumerate(sources):
+                if sparse:
+                    cols, demand = matrix.row(i)
+                    settled = kernel.load_origin(
+                        source, time, theta, targets[cols],
+                        np.asarray(demand, np.float64), arcs_flow, trans_flow)
+                else:
+                    settled = kernel.load_origin(
+                        source, time, theta, targets,
+                        np.asarray(matrix._data[i], np.float64), arcs_flow,
+                        trans_flow)
+                if settled:
+                    summary.searches += 1
+
+    arcs_flow = np.zeros(shape, np.float64)
+    aux_flow = np.zeros(shape, np.float64)
+    trans_flow = np.zeros(trans_num, np.float64) if count_turn else None
+    aux_trans = np.zeros(trans_num, np.float64) if count_turn else None
+    time = np.empty(shape, np.float64)
+    timer = PhaseTimer(summary)
+    hooks = cfg.hooks
+    if hooks:
+        info = IterationInfo(arcs_flow, time, summary)
+    with timer.phase('vdf'):
+        vdf.update(arcs_flow, time)
+    load(time if initial_time is None else
+         np.asarray(initial_time, np.float64), arcs_flow, trans_flow)
+
+    # Main loop
+    for i in range(1, cfg.max_iteration):
+        timer.next_iteration()
+        with timer.phase('vdf'):
+            vdf.update(arcs_flow, time)
+        aux_flow.fill(0)
+        if count_turn:
+            aux_trans.fill(0)
+        load(time, aux_flow, aux_trans)
+
+        # Method of successive averages
+        with timer.phase('line_search'):
+            step = 1 / (i + 1)
+            summary.step.append(step)
+            diff = aux_flow - arcs_flow
+            norm = arcs_flow.dot(arcs_flow)
+            relative_gap = np.sqrt(diff.dot(diff) / norm) if norm > 0 else 0
+            diff *= step
+            arcs_flow += diff
+            if count_turn:
+                trans_flow += step * (aux_trans - trans_flow)
+
+        with timer.phase('convergence'):
+            summary.relative_gap.append(relative_gap)
+            # Max Flow Change
+            max_flow_change = np.abs(diff).max()
+            summary.max_flow_change.append(max_flow_change)
+
+            # whether to log
+            if counter.add():
+                log_iteration(i, relative_gap, max_flow_change, step)
+
+        if hooks and run_hooks(hooks, info, i, step, relative_gap,
+                               max_flow_change):
+            break
+        # Check convergence
+        if relative_gap <= cfg.convergence:
+            summary.equilibrium_reached = True
+            break
+
+    # Turns flow at focus nodes
+    if count_turn:
+        tail, head = trans['t_tail'], trans['t_head']
+        focus = (a[tail] != net.none) & (trans_flow > 0)
+        np.add.at(turns_flow,
+                  a[tail[focus]].astype(np.intp) + b[head[focus]],
+                  trans_flow[focus])
+
+    flow_data = cache.link_flow(arcs_flow)
+    turn_data = _get_turn_data_from_runtime(net, a, b, turns_flow)
+    if cfg.trace_file:
+        summary.write_trace(cfg.trace_file)
+
+    return flow_data, turn_data, summary
@@ -0,0 +1,286 @@
+# -*- python -*-
+"""Stochastic (logit) loading kernel written in Cython.
+
+Dial's STOCH algorithm is run over the arcs of a net, the same turn-aware
+arc graph ``core.turn_dijikstra`` labels: the vertices are the arcs (row
+numbers of ``Net._data``) and the links are the transitions between
+consecutive arcs, see ``bush.get_transitions``. A transition is efficient
+if its head arc is settled after its tail arc by the search from the
+origin, so every efficient path moves away from the origin and no path is
+enumerated.
+
+All index arrays are of type ``np.intp``.
+
+Author: Zhanhong Cheng
+"""
+import numpy as np
+
+cimport numpy as np
+cimport cython
+from libc.math cimport exp
+
+ctypedef np.float64_t DTYPE_t
+
+cdef DTYPE_t INF = np.inf
+
+
+cdef class StochKernel:
+    """Load the demand of one origin at a time by Dial's STOCH algorithm.
+
+    Each call is one search over the arcs, then one forward sweep in settle
+    order for the link weights and one backward sweep for the flows, so it
+    costs a small constant times an All-or-Nothing assignment of the
+    origin.
+
+    Parameters
+    ----------
+    node_start : ndarray
+        Arcs of node `n` are ``node_start[n]:node_start[n + 1]``.
+    end_node : ndarray
+        A field of Net, ``Net['END_NODE']``.
+    t_off : ndarray
+        Transitions from arc `a` are ``t_off[a]:t_off[a + 1]``.
+    t_head : ndarray
+        The arc after each transition.
+    t_delay : ndarray
+        Turning delay of each transition, INF or NAN if banned.
+    """
+    cdef Py_ssize_t arc_num, n_order, generation
+    cdef Py_ssize_t[::1] node_start, end_node, t_off, t_head
+    cdef DTYPE_t[::1] t_delay
+    # Work arrays, valid for the origin in hand only.
+    cdef DTYPE_t[::1] dist, weight, load, h_val, node_dist, node_weight
+    cdef DTYPE_t[::1] node_demand
+    cdef Py_ssize_t[::1] order, pos, h_ref, h_pos, stamp
+
+    def __init__(self, node_start, end_node, t_off, t_head, t_delay):
+        self.node_start = node_start
+        self.end_node = end_node
+        self.t_off = t_off
+        self.t_head = t_head
+        self.t_delay = t_delay
+
+        self.arc_num = end_node.shape[0]
+        node_num = node_start.shape[0]
+        self.dist = np.full(self.arc_num, INF, np.float64)
+        self.weight = np.zeros(self.arc_num, np.float64)
+        self.load = np.zeros(self.arc_num, np.float64)
+        self.h_val = np.empty(self.arc_num, np.float64)
+        self.order = np.empty(self.arc_num, np.intp)
+        self.pos = np.full(self.arc_num, -1, np.intp)
+        self.h_ref = np.empty(self.arc_num, np.intp)
+        self.h_pos = np.full(self.arc_num, -1, np.intp)
+        self.node_dist = np.empty(node_num, np.float64)
+        self.node_weight = np.empty(node_num, np.float64)
+        self.node_demand = np.zeros(node_num, np.float64)
+        self.stamp = np.zeros(node_num, np.intp)
+        self.n_order = 0
+        self.generation = 0
+
+    @property
+    def nbytes(self):
+        """Total bytes of the work arrays."""
+        cdef Py_ssize_t node_num = self.stamp.shape[0]
+        # dist, weight, load, h_val; order, pos, h_ref, h_pos; node_dist,
+        # node_weight, node_demand and stamp.
+        return (self.arc_num * (4 * sizeof(DTYPE_t) + 4 * sizeof(Py_ssize_t))
+                + node_num * (3 * sizeof(DTYPE_t) + sizeof(Py_ssize_t)))
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef inline void _sift_up(self, Py_ssize_t i, DTYPE_t value,
+                              Py_ssize_t ref):
+        cdef Py_ssize_t parent
+        while i > 0:
+            parent = (i - 1) >> 1
+            if self.h_val[parent] <= value:
+                break
+            self.h_val[i] = self.h_val[parent]
+            self.h_ref[i] = self.h_ref[parent]
+            self.h_pos[self.h_ref[i]] = i
+            i = parent
+        self.h_val[i] = value
+        self.h_ref[i] = ref
+        self.h_pos[ref] = i
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef inline void _push(self, Py_ssize_t *count, DTYPE_t value,
+                           Py_ssize_t ref):
+        """Push `ref` or lower its value if already in the heap."""
+        cdef Py_ssize_t i = self.h_pos[ref]
+        if i < 0:
+            i = count[0]
+            count[0] += 1
+        self._sift_up(i, value, ref)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef inline Py_ssize_t _pop(self, Py_ssize_t *count):
+        cdef Py_ssize_t ref = self.h_ref[0], i = 0, child
+        cdef Py_ssize_t last_ref
+        cdef DTYPE_t last_val
+        count[0] -= 1
+        self.h_pos[ref] = -1
+        if count[0] == 0:
+            return ref
+        last_val = self.h_val[count[0]]
+        last_ref = self.h_ref[count[0]]
+        while True:
+            child = 2 * i + 1
+            if child >= count[0]:
+                break
+            if (child + 1 < count[0] and
+                    self.h_val[child + 1] < self.h_val[child]):
+                child += 1
+            if self.h_val[child] >= last_val:
+                break
+            self.h_val[i] = self.h_val[child]
+            self.h_ref[i] = self.h_ref[child]
+            self.h_pos[self.h_ref[i]] = i
+            i = child
+        self.h_val[i] = last_val
+        self.h_ref[i] = last_ref
+        self.h_pos[last_ref] = i
+        return ref
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _search(self, Py_ssize_t origin, DTYPE_t[::1] time):
+        """Label every arc reachable from `origin`, record the settle order.
+
+        Unlike ``core.turn_dijikstra`` no node is closed once reached, all
+        the arcs into a node are labeled as they are the alternatives the
+        loading chooses among.
+        """
+        cdef Py_ssize_t k, a, h, l, count = 0
+        cdef DTYPE_t d, c_dist
+        for k in range(self.n_order):
+            a = self.order[k]
+            self.dist[a] = INF
+            self.pos[a] = -1
+            self.weight[a] = 0
+            self.load[a] = 0
+        self.n_order = 0
+
+        for a in range(self.node_start[origin], self.node_start[origin + 1]):
+            d = time[a]
+            if d < self.dist[a]:
+                self.dist[a] = d
+                self._push(&count, d, a)
+
+        while count != 0:
+            a = self._pop(&count)
+            self.pos[a] = self.n_order
+            self.order[self.n_order] = a
+            self.n_order += 1
+            c_dist = self.dist[a]
+            for l in range(self.t_off[a], self.t_off[a + 1]):
+                d = self.t_delay[l]
+                # Banned turns, INF or NAN.
+                if not d < INF:
+                    continue
+                h = self.t_head[l]
+                d += c_dist + time[h]
+                if d < self.dist[h]:
+                    self.dist[h] = d
+                    self._push(&count, d, h)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def load_origin(self, Py_ssize_t origin, DTYPE_t[::1] time,
+                    DTYPE_t theta, Py_ssize_t[::1] targets,
+                    DTYPE_t[::1] demand, DTYPE_t[::1] arcs_flow,
+                    DTYPE_t[::1] trans_flow=None):
+        """Load the demand of `origin` by logit route choice.
+
+        Parameters
+        ----------
+        origin : int
+            The origin node's ID.
+        time : ndarray
+            Arcs time.
+        theta : float
+            The dispersion parameter of the logit model, the bigger the
+            closer to an All-or-Nothing assignment.
+        targets : ndarray
+            Destination nodes' ID.
+        demand : ndarray
+            Demand from `origin` to each of `targets`.
+        arcs_flow : ndarray
+            Arcs flow, the loaded flow is added to it.
+        trans_flow : ndarray, optional
+            Flow of each transition, the loaded flow is added to it.
+
+        Returns
+        -------
+        int
+            Number of arcs settled by the search.
+        """
+        cdef Py_ssize_t k, a, h, l, n
+        cdef DTYPE_t w, x, share
+        cdef Py_ssize_t node_num = self.stamp.shape[0]
+        cdef bint count_turn = trans_flow is not None
+        if origin + 1 >= self.node_start.shape[0]:
+            # No arc starts from the origin.
+            return 0
+        self._search(origin, time)
+        self.generation += 1
+
+        # Forward sweep, the weight of an arc sums over its efficient
+        # predecessors, each scaled by the likelihood of its transition.
+        for a in range(self.node_start[origin], self.node_start[origin + 1]):
+            if self.pos[a] >= 0:
+                self.weight[a] = exp(theta * (self.dist[a] - time[a]))
+        for k in range(self.n_order):
+            a = self.order[k]
+            w = self.weight[a]
+            # Exit weight at the node the arc ends at.
+            n = self.end_node[a]
+            if self.stamp[n] != self.generation:
+                self.stamp[n] = self.generation
+                self.node_dist[n] = self.dist[a]
+                self.node_weight[n] = 0
+            self.node_weight[n] += w * exp(theta * (self.node_dist[n] -
+                                                    self.dist[a]))
+            for l in range(self.t_off[a], self.t_off[a + 1]):
+                h = self.t_head[l]
+                if self.pos[h] <= k or not self.t_delay[l] < INF:
+                    continue
+                self.weight[h] += w * exp(theta * (
+                    self.dist[h] - self.dist[a] - time[h] - self.t_delay[l]))
+
+        for k in range(targets.shape[0]):
+            n = targets[k]
+            if n != origin and n < node_num and demand[k] > 0 and \
+                    self.stamp[n] == self.generation:
+                self.node_demand[n] += demand[k]
+
+        # Backward sweep, the flow of an arc is its share of the demand
+        # ending at its node plus its share of its successors' flow.
+        for k in range(self.n_order - 1, -1, -1):
+            a = self.order[k]
+            w = self.weight[a]
+            n = self.end_node[a]
+            x = 0
+            if self.node_demand[n] > 0:
+                x = (self.node_demand[n] * w *
+                     exp(theta * (self.node_dist[n] - self.dist[a])) /
+                     self.node_weight[n])
+            for l in range(self.t_off[a], self.t_off[a + 1]):
+                h = self.t_head[l]
+                if self.pos[h] <= k or not self.t_delay[l] < INF or \
+                        self.load[h] == 0:
+                    continue
+                share = self.load[h] * w / self.weight[h] * exp(theta * (
+                    self.dist[h] - self.dist[a] - time[h] - self.t_delay[l]))
+                x += share
+                if count_turn:
+                    trans_flow[l] += share
+            self.load[a] = x
+            arcs_flow[a] += x
+
+        for k in range(targets.shape[0]):
+            if targets[k] < node_num:
+                self.node_demand[targets[k]] = 0
+        return self.n_order
@@ -3,15 +3,31 @@
 @author: Zhanhong Cheng
 """
 from transpy.test.load_data import load_test_data, load_assignment_result
-from transpy.compute._core import all_or_nothing, user_equilibrium, assignment_config
+from transpy.compute.assignment import all_or_nothing, user_equilibrium, \
+    AssignConfig, AssignClass, PHASES, get_aon, get_assign_param, \
+    prepare_focus_nodes, multi_period_equilibrium, net_to_link_flow
+from transpy.compute.bush import bush_equilibrium
+from transpy.compute.path import path_equilibrium
+from transpy.compute.bush import get_transitions
+from transpy.compute.sue_core import StochKernel
+from transpy.compute.shortest_way import get_sp_param
+from transpy.compute.assignment import derivative
+from transpy.compute.core import bpr_line_search, bpr_line_derivative
+from transpy.classes.matrix import Matrix, SparseMatrix
+from transpy.readwrite.rw_txt import load_bin_matrix
 import numpy as np
+import transpy as tp
 import nose.tools as nt
+import json
+import logging
+import os
+import tempfile
 
 NULL = 65535
 
 _, link_table, _, net, matrix = load_test_data()
 
-cfg = assignment_config()
+cfg = AssignConfig()
 cfg.method = 'UE'
 cfg.time_field = 'times'
 cfg.capacity_field = 'capacity'
@@ -20,6 +36,15 @@ cfg.convergence = 0.001
 cfg.focus_nodes = 'all'
 
 
+def scaled(factor):
+    """`matrix` with its demand multiplied by `factor`, a number or an
+    array of the same shape."""
+    od = Matrix(matrix.data * factor)
+    od.row_idx = matrix.row_idx
+    od.col_idx = matrix.col_idx
+    return od
+
+
 def test_all_or_nothing():
     result_arc, result_turn = load_assignment_result('AON')
     arcs_flow, turns_flow = all_or_nothing(net, matrix, link_table, cfg)
@@ -44,9 +69,599 @@ def test_all_or_nothing():
     print("Total {} turns_flow, {} right".format(turn_shape,j))
 
 
+def test_threads():
+    """Multi-threaded AON should be repeatable and agree with one thread."""
+    arcs_flow1, turns_flow1 = all_or_nothing(net, matrix, link_table, cfg)
+    cfg.threads = 4
+    try:
+        arcs_flow4, turns_flow4 = all_or_nothing(net, matrix, link_table,
+                                                 cfg)
+        arcs_flow4_again, _ = all_or_nothing(net, matrix, link_table, cfg)
+    finally:
+        cfg.threads = 1
+    np.testing.assert_array_equal(arcs_flow4['AB_FLOW'],
+                                  arcs_flow4_again['AB_FLOW'])
+    np.testing.assert_allclose(arcs_flow1['AB_FLOW'], arcs_flow4['AB_FLOW'])
+    np.testing.assert_allclose(arcs_flow1['BA_FLOW'], arcs_flow4['BA_FLOW'])
+    np.testing.assert_allclose(turns_flow1['FLOW'], turns_flow4['FLOW'])
+
+
+def test_processes():
+    """AON by a process pool should agree with the in-process one."""
+    arcs_flow1, turns_flow1 = all_or_nothing(net, matrix, link_table, cfg)
+    ue_flow1, _, _ = user_equilibrium(net, matrix, link_table, cfg)
+    cfg.processes = 2
+    try:
+        arcs_flow2, turns_flow2 = all_or_nothing(net, matrix, link_table,
+                                                 cfg)
+        ue_flow2, _, _ = user_equilibrium(net, matrix, link_table, cfg)
+    finally:
+        cfg.processes = 1
+    np.testing.assert_allclose(arcs_flow1['AB_FLOW'], arcs_flow2['AB_FLOW'])
+    np.testing.assert_allclose(turns_flow1['FLOW'], turns_flow2['FLOW'])
+    np.testing.assert_allclose(ue_flow1['AB_FLOW'], ue_flow2['AB_FLOW'])
+
+
+def test_sparse_matrix():
+    """AON of a SparseMatrix should agree with the dense one."""
+    factor = np.ones(matrix.shape)
+    factor[::2] = 0
+    factor[:, 1] = 0
+    dense = scaled(factor)
+    sparse = SparseMatrix.from_matrix(dense)
+    try:
+        for loading, threads, processes in (('path', 1, 1), ('tree', 1, 1),
+                                            ('path', 4, 1), ('path', 1, 2)):
+            cfg.loading = loading
+            cfg.threads = threads
+            cfg.processes = processes
+            arcs_flow1, turns_flow1 = all_or_nothing(net, dense, link_table,
+                                                     cfg)
+            arcs_flow2, turns_flow2 = all_or_nothing(net, sparse, link_table,
+                                                     cfg)
+            np.testing.assert_allclose(arcs_flow1['AB_FLOW'],
+                                       arcs_flow2['AB_FLOW'])
+            np.testing.assert_allclose(arcs_flow1['BA_FLOW'],
+                                       arcs_flow2['BA_FLOW'])
+            np.testing.assert_allclose(turns_flow1['FLOW'],
+                                       turns_flow2['FLOW'])
+    finally:
+        cfg.loading, cfg.threads, cfg.processes = 'path', 1, 1
+
+
+def test_memmap_matrix():
+    """AON of a memory-mapped matrix read in row blocks."""
+    rows, cols = matrix.shape
+    table = np.empty(rows * cols, [('O', 'i2'), ('D', 'i2'), ('pre', 'f8')])
+    table['O'] = np.repeat(matrix.row_idx, cols)
+    table['D'] = np.tile(matrix.col_idx, rows)
+    table['pre'] = matrix.data.ravel()
+    with tempfile.TemporaryDirectory() as folder:
+        file = os.path.join(folder, 'matrix.bin')
+        table.tofile(file)
+        with open(os.path.join(folder, 'matrix.dcb'), 'w') as f:
+            f.write('\n12\n"O",I,1,2,0,10,0,,,"",,Blank,\n'
+                    '"D",I,3,2,0,10,0,,,"",,Blank,\n'
+                    '"pre",R,5,8,0,10,2,,,"",,Blank,\n')
+        mapped = load_bin_matrix(file, 'pre')
+        nt.assert_true(isinstance(mapped.data, np.memmap))
+        np.testing.assert_array_equal(mapped.row_idx, matrix.row_idx)
+        np.testing.assert_array_equal(mapped.data, matrix.data)
+
+        arcs_flow1, turns_flow1 = all_or_nothing(net, matrix, link_table, cfg)
+        # Worker processes map the file again instead of copying it.
+        try:
+            for block_rows, processes in ((0, 1), (4, 1), (0, 2), (4, 2)):
+                cfg.block_rows = block_rows
+                cfg.processes = processes
+                arcs_flow2, turns_flow2 = all_or_nothing(net, mapped,
+                                                         link_table, cfg)
+                np.testing.assert_allclose(arcs_flow1['AB_FLOW'],
+                                           arcs_flow2['AB_FLOW'])
+                np.testing.assert_allclose(turns_flow1['FLOW'],
+                                           turns_flow2['FLOW'])
+        finally:
+            cfg.block_rows = 0
+            cfg.processes = 1
+        del mapped
+
+        # Records shifted across rows, or rows of one origin, are rejected.
+        np.roll(table, -1).tofile(file)
+        nt.assert_raises(ValueError, load_bin_matrix, file, 'pre', cols=cols)
+        table.tofile(file)
+        nt.assert_raises(ValueError, load_bin_matrix, file, 'pre', cols=1)
+
+
+def test_early_termination():
+    """Searches stop once the targets with flow are settled, flows are the
+    same as assigning the OD pairs one by one."""
+    arcs_flow, turns_flow = all_or_nothing(net, matrix, link_table, cfg)
+    ab_flow = np.zeros(arcs_flow.shape)
+    ba_flow = np.zeros(arcs_flow.shape)
+    t_flow = np.zeros(turns_flow.shape)
+
+    time = get_assign_param(net._data, cfg.time_field, None, None)
+    a, b, turns = prepare_focus_nodes(net, None)
+    aon, _ = get_aon(net, matrix, cfg, a, b, turns)
+    row_count = np.zeros(matrix.shape[0], np.intp)
+    aon(time, np.zeros(net._data.shape), turns, row_count)
+    count = np.zeros(1, np.intp)
+    fewer = 0
+    for i, o in enumerate(matrix.row_idx):
+        for j, d in enumerate(matrix.col_idx):
+            if o == d or matrix[i, j] == 0:
+                continue
+            single = SparseMatrix.from_triplets([o], [d], [matrix[i, j]])
+            flow1, flow2 = all_or_nothing(net, single, link_table, cfg)
+            ab_flow += flow1['AB_FLOW']
+            ba_flow += flow1['BA_FLOW']
+            t_flow += flow2['FLOW']
+
+            aon, _ = get_aon(net, single, cfg, a, b, turns)
+            aon(time, np.zeros(net._data.shape), turns, count)
+            nt.assert_true(0 < count[0] <= row_count[i])
+            fewer += count[0] < row_count[i]
+    nt.assert_true(fewer > 0)
+    np.testing.assert_allclose(arcs_flow['AB_FLOW'], ab_flow)
+    np.testing.assert_allclose(arcs_flow['BA_FLOW'], ba_flow)
+    np.testing.assert_allclose(turns_flow['FLOW'], t_flow)
+
+
+def test_multi_class():
+    """Classes share the congestion, the total is in passenger car units."""
+    half = scaled(0.5)
+    cfg.max_iteration = 50
+    try:
+        flow, turn, _ = user_equilibrium(net, matrix, link_table, cfg)
+        flow2, turn2, summary = user_equilibrium(
+            net, [(half, 1), AssignClass(SparseMatrix.from_matrix(half),
+                                         name='HGV')], link_table, cfg)
+        nt.assert_true(summary.relative_gap[-1] <= cfg.convergence)
+        np.testing.assert_allclose(flow['AB_FLOW'], flow2['AB_FLOW'],
+                                   rtol=1e-6)
+        np.testing.assert_allclose(
+            flow2['AB_FLOW_1'] + flow2['AB_FLOW_HGV'], flow2['AB_FLOW'],
+            rtol=1e-9)
+        np.testing.assert_allclose(turn2['FLOW_1'] + turn2['FLOW_HGV'],
+                                   turn2['FLOW'], rtol=1e-9, atol=1e-9)
+        np.testing.assert_allclose(turn['FLOW'], turn2['FLOW'], rtol=1e-6,
+                                   atol=1e-6)
+
+        # Half the vehicles with pce 2 load the net the same.
+        flow3, _, _ = user_equilibrium(net, [(half, 2)], link_table, cfg)
+        np.testing.assert_allclose(flow['AB_FLOW'], flow3['AB_FLOW'],
+                                   rtol=1e-6)
+        np.testing.assert_allclose(flow3['AB_FLOW_1'] * 2, flow3['AB_FLOW'],
+                                   rtol=1e-9)
+
+        # A class paying more on long arcs moves away from them.
+        flow4, _, summary = user_equilibrium(
+            net, [(half, 1), (half, 1, 'LENGTH')], link_table, cfg)
+        nt.assert_true(summary.relative_gap[-1] <= cfg.convergence)
+        np.testing.assert_allclose(flow4['AB_FLOW_1'] + flow4['AB_FLOW_2'],
+                                   flow4['AB_FLOW'], rtol=1e-9)
+    finally:
+        cfg.max_iteration = 20
+
+
 def test_ue():
     summary, arcs_flow, turns_flow = user_equilibrium(net, matrix, link_table, cfg)
     return summary, arcs_flow,turns_flow
 
 test_ue()
-#test_all_or_nothing()
\ No newline at end of file
+#test_all_or_nothing()
+
+def test_tree_loading():
+    """Loading by sweeping the tree should agree with backtracking paths."""
+    arcs_flow1, turns_flow1 = all_or_nothing(net, matrix, link_table, cfg)
+    cfg.loading = 'tree'
+    try:
+        arcs_flow2, turns_flow2 = all_or_nothing(net, matrix, link_table,
+                                                 cfg)
+    finally:
+        cfg.loading = 'path'
+    np.testing.assert_allclose(arcs_flow1['AB_FLOW'], arcs_flow2['AB_FLOW'])
+    np.testing.assert_allclose(arcs_flow1['BA_FLOW'], arcs_flow2['BA_FLOW'])
+    np.testing.assert_allclose(turns_flow1['FLOW'], turns_flow2['FLOW'])
+
+
+def test_conjugate_fw():
+    """CFW and BFW should reach the gap with fewer iterations than FW."""
+    congested = scaled(8)
+    iterations = {}
+    cfg.max_iteration = 500
+    try:
+        for method in ('UE', 'CFW', 'BFW'):
+            cfg.method = method
+            _, _, summary = user_equilibrium(net, congested, link_table, cfg)
+            nt.assert_true(summary.relative_gap[-1] <= cfg.convergence)
+            iterations[method] = len(summary.step)
+    finally:
+        cfg.method = 'UE'
+        cfg.max_iteration = 20
+    nt.assert_true(iterations['CFW'] < iterations['UE'])
+    nt.assert_true(iterations['BFW'] < iterations['UE'])
+
+
+def test_bush_equilibrium():
+    """Bush-based UE should agree with BFW at a small gap."""
+    congested = scaled(8)
+    cfg.method = 'BFW'
+    cfg.convergence = 1e-6
+    cfg.max_iteration = 2000
+    cfg.turn_delay_type = 'no'
+    try:
+        arcs_flow1, _, summary1 = user_equilibrium(net, congested,
+                                                   link_table, cfg)
+        arcs_flow2, _, summary2 = bush_equilibrium(net, congested,
+                                                   link_table, cfg)
+    finally:
+        cfg.method = 'UE'
+        cfg.convergence = 0.001
+        cfg.max_iteration = 20
+        cfg.turn_delay_type = 'all'
+    nt.assert_true(summary2.equilibrium_reached)
+    nt.assert_true(len(summary2.relative_gap) < len(summary1.relative_gap))
+    np.testing.assert_allclose(arcs_flow1['AB_FLOW'], arcs_flow2['AB_FLOW'],
+                               rtol=1e-3, atol=10)
+    np.testing.assert_allclose(arcs_flow1['BA_FLOW'], arcs_flow2['BA_FLOW'],
+                               rtol=1e-3, atol=10)
+
+    # The kernel knows only BPR.
+    cfg.vdf = 'conical'
+    try:
+        nt.assert_raises(ValueError, bush_equilibrium, net, congested,
+                         link_table, cfg)
+    finally:
+        cfg.vdf = 'bpr'
+    nt.assert_raises(TypeError, bush_equilibrium, net,
+                     SparseMatrix.from_matrix(congested), link_table, cfg)
+
+
+def test_path_equilibrium():
+    """Path-based UE should agree with BFW and keep the OD demand."""
+    congested = scaled(8)
+    cfg.method = 'BFW'
+    cfg.convergence = 1e-6
+    cfg.max_iteration = 2000
+    cfg.turn_delay_type = 'no'
+    try:
+        arcs_flow1, _, summary1 = user_equilibrium(net, congested,
+                                                   link_table, cfg)
+        arcs_flow2, _, summary2 = path_equilibrium(net, congested,
+                                                   link_table, cfg)
+    finally:
+        cfg.method = 'UE'
+        cfg.convergence = 0.001
+        cfg.max_iteration = 20
+        cfg.turn_delay_type = 'all'
+    routes = summary2.routes
+    nt.assert_true(summary2.equilibrium_reached)
+    nt.assert_true(summary2.path_store_nbytes > 0)
+    np.testing.assert_allclose(arcs_flow1['AB_FLOW'], arcs_flow2['AB_FLOW'],
+                               rtol=1e-3, atol=10)
+    np.testing.assert_allclose(arcs_flow1['BA_FLOW'], arcs_flow2['BA_FLOW'],
+                               rtol=1e-3, atol=10)
+    row = dict(zip(congested.row_idx, range(len(congested.row_idx))))
+    col = dict(zip(congested.col_idx, range(len(congested.col_idx))))
+    demand = np.zeros(congested.data.shape)
+    np.add.at(demand, ([row[o] for o in routes.data['O']],
+                       [col[d] for d in routes.data['D']]),
+              routes.data['FLOW'])
+    np.fill_diagonal(demand, np.diag(congested.data))
+    np.testing.assert_allclose(demand, congested.data)
+
+    # Neither does the path kernel, even for one type of arcs.
+    cfg.arc_type_field = 'DIR'
+    cfg.arc_type_dict = [(1, {'vdf': 'akcelik'})]
+    try:
+        nt.assert_raises(ValueError, path_equilibrium, net, congested,
+                         link_table, cfg)
+    finally:
+        cfg.arc_type_field = cfg.arc_type_dict = None
+    nt.assert_raises(TypeError, path_equilibrium, net,
+                     SparseMatrix.from_matrix(congested), link_table, cfg)
+
+
+def test_phase_timing():
+    """Every phase is timed per iteration and written as a trace."""
+    fd, path = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    cfg.trace_file = path
+    try:
+        _, _, summary = user_equilibrium(net, matrix, link_table, cfg)
+        with open(path) as f:
+            trace = json.load(f)['traceEvents']
+    finally:
+        cfg.trace_file = None
+        os.remove(path)
+    iterations = len(summary.relative_gap) + 1
+    for phase in PHASES:
+        nt.assert_equal(len(summary.wall_time[phase]), iterations)
+        nt.assert_equal(len(summary.cpu_time[phase]), iterations)
+    nt.assert_true(sum(summary.wall_time['loading']) > 0)
+    nt.assert_equal(summary.searches, iterations * matrix.shape[0])
+    nt.assert_true(summary.workspace_nbytes > 0)
+    nt.assert_equal(len(trace), len(summary.trace))
+    loading = [e for e in trace if e['name'] == 'loading']
+    nt.assert_equal(len(loading), iterations)
+    nt.assert_almost_equal(sum(e['dur'] for e in loading) / 1e6,
+                           sum(summary.wall_time['loading']))
+
+
+def test_hooks():
+    """Hooks see every iteration read-only and may stop the assignment."""
+    seen = []
+
+    def hook(info):
+        nt.assert_raises(ValueError, info.arcs_flow.fill, 0)
+        nt.assert_raises(ValueError, info.time.fill, 0)
+        seen.append((info.iteration, info.step, info.relative_gap,
+                     info.arcs_flow.copy()))
+        return info.iteration == 3
+
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    log = logging.getLogger('transpy.compute.assignment')
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+    congested = scaled(8)
+    cfg.hooks = [hook]
+    try:
+        flow_data, _, summary = user_equilibrium(net, congested, link_table,
+                                                 cfg)
+    finally:
+        cfg.hooks = None
+        log.removeHandler(handler)
+        log.setLevel(logging.NOTSET)
+    nt.assert_true(summary.stopped_by_hook)
+    nt.assert_equal([x[0] for x in seen], [1, 2, 3])
+    nt.assert_equal([x[1] for x in seen], summary.step)
+    nt.assert_equal([x[2] for x in seen], summary.relative_gap)
+    nt.assert_equal([r.iteration for r in records], [1, 2, 3])
+    nt.assert_equal([r.relative_gap for r in records], summary.relative_gap)
+    expect = net_to_link_flow(link_table, net, seen[-1][3])
+    np.testing.assert_array_equal(flow_data['AB_FLOW'], expect['AB_FLOW'])
+
+
+def test_warm_start():
+    """Starting from a nearby solution saves iterations."""
+    congested = scaled(8)
+    busier = scaled(8.4)
+    cfg.method = 'BFW'
+    cfg.convergence = 1e-4
+    cfg.max_iteration = 500
+    cfg.turn_delay_type = 'no'
+    try:
+        for solver in (user_equilibrium, bush_equilibrium, path_equilibrium):
+            cold = solver(net, congested, link_table, cfg)[2]
+            warm_start = cold.warm_start
+            nt.assert_true(cold.iterations_saved is None)
+            result = solver(net, busier, link_table, cfg,
+                            warm_start=warm_start)
+            warm = result[2]
+            nt.assert_true(warm.relative_gap[-1] <= cfg.convergence)
+            nt.assert_true(warm.iterations_saved > 0)
+            nt.assert_equal(warm.iterations_saved,
+                            len(cold.relative_gap) - len(warm.relative_gap))
+            expect = solver(net, busier, link_table, cfg)[0]
+            np.testing.assert_allclose(result[0]['AB_FLOW'],
+                                       expect['AB_FLOW'], rtol=1e-2, atol=20)
+            np.testing.assert_allclose(result[0]['BA_FLOW'],
+                                       expect['BA_FLOW'], rtol=1e-2, atol=20)
+        # Only a multiple of the old demand is a feasible start.
+        factor = np.full(matrix.shape, 8.)
+        factor[0] *= 2
+        skewed = scaled(factor)
+        nt.assert_raises(ValueError, user_equilibrium, net, skewed,
+                         link_table, cfg, warm_start=warm_start)
+    finally:
+        cfg.method = 'UE'
+        cfg.convergence = 0.001
+        cfg.max_iteration = 20
+        cfg.turn_delay_type = 'all'
+
+
+def test_multi_period():
+    """Periods share the prepared net, each agrees with a single run."""
+    congested = scaled(8)
+    periods = [('AM', congested, 'flow', 2), ('IP', matrix, None, 6),
+               ('PM', congested, 'flow', 3)]
+    flow_data, turn_data, summaries = multi_period_equilibrium(
+        net, periods, link_table, cfg)
+    nt.assert_equal(flow_data.shape, (3, len(link_table)))
+    nt.assert_equal(list(summaries), ['AM', 'IP', 'PM'])
+    try:
+        for k, (name, od, preload_field, duration) in enumerate(periods):
+            cfg.preload_field = preload_field
+            arcs_flow, turns_flow, _ = user_equilibrium(net, od, link_table,
+                                                        cfg)
+            np.testing.assert_array_equal(flow_data[k]['PERIOD'], name)
+            np.testing.assert_allclose(flow_data[k]['AB_FLOW'],
+                                       arcs_flow['AB_FLOW'])
+            np.testing.assert_allclose(flow_data[k]['BA_VOLUME'],
+                                       arcs_flow['BA_FLOW'] * duration)
+            np.testing.assert_allclose(turn_data[k]['FLOW'],
+                                       turns_flow['FLOW'])
+    finally:
+        cfg.preload_field = 'flow'
+
+    # PM starts from the times of AM, which has the same demand.
+    _, _, summaries = multi_period_equilibrium(net, periods[::2], link_table,
+                                               cfg, warm_start=True)
+    nt.assert_equal(len(summaries['PM'].relative_gap),
+                    len(summaries['AM'].relative_gap))
+    nt.assert_true(summaries['PM'].relative_gap[-1] <
+                   summaries['AM'].relative_gap[-1])
+
+    # SUE loads PM once at the times of AM, not at free flow like AM.
+    warm_start = summaries['AM'].warm_start
+    cfg.method = 'SUE'
+    cfg.max_iteration = 1
+    try:
+        flow_data, _, summaries = multi_period_equilibrium(
+            net, periods[::2], link_table, cfg, warm_start=True)
+        nt.assert_raises(ValueError, user_equilibrium, net, congested,
+                         link_table, cfg, warm_start=warm_start)
+    finally:
+        cfg.method = 'UE'
+        cfg.max_iteration = 20
+    nt.assert_false(np.allclose(np.nan_to_num(flow_data[0]['AB_FLOW']),
+                                np.nan_to_num(flow_data[1]['AB_FLOW'])))
+
+
+def test_select_analysis():
+    """Select-link OD flows and select-zone flows add up to the link flows."""
+    flow_data, _, _ = user_equilibrium(net, matrix, link_table, cfg)
+    total = np.nan_to_num(flow_data['AB_FLOW']) + \
+        np.nan_to_num(flow_data['BA_FLOW'])
+    links = flow_data['ID'][np.argsort(total)[-3:]]
+    cfg.select_links = links
+    cfg.select_zones = matrix.row_idx
+    sparse = SparseMatrix.from_matrix(matrix)
+    try:
+        flow_data, _, summary = user_equilibrium(net, matrix, link_table, cfg)
+        _, _, sparse_summary = user_equilibrium(net, sparse, link_table, cfg)
+    finally:
+        cfg.select_links = cfg.select_zones = None
+    total = np.nan_to_num(flow_data['AB_FLOW']) + \
+        np.nan_to_num(flow_data['BA_FLOW'])
+    for link in links:
+        od = summary.select_link[link]
+        nt.assert_true(isinstance(od, SparseMatrix))
+        line = np.flatnonzero(flow_data['ID'] == link)[0]
+        nt.assert_almost_equal(od.values.sum(), total[line])
+        nt.assert_almost_equal(sparse_summary.select_link[link].values.sum(),
+                               total[line])
+        np.testing.assert_allclose(
+            od.to_matrix().data,
+            sparse_summary.select_link[link].to_matrix().data)
+    zone_flow = summary.select_zone
+    ab = sum(zone_flow['AB_FLOW_' + str(z)] for z in matrix.row_idx)
+    ba = sum(zone_flow['BA_FLOW_' + str(z)] for z in matrix.row_idx)
+    np.testing.assert_allclose(np.nan_to_num(ab),
+                               np.nan_to_num(flow_data['AB_FLOW']), atol=1e-6)
+    np.testing.assert_allclose(np.nan_to_num(ba),
+                               np.nan_to_num(flow_data['BA_FLOW']), atol=1e-6)
+
+    # SUE has no select analysis.
+    cfg.method = 'SUE'
+    cfg.select_links = links
+    try:
+        nt.assert_raises(ValueError, user_equilibrium, net, matrix,
+                         link_table, cfg)
+    finally:
+        cfg.method = 'UE'
+        cfg.select_links = None
+
+    # Repeated links or zones are rejected.
+    for field, ids in (('select_links', links[[0, 1, 0]]),
+                       ('select_zones', matrix.row_idx[[0, 0]])):
+        setattr(cfg, field, ids)
+        try:
+            nt.assert_raises(ValueError, user_equilibrium, net, matrix,
+                             link_table, cfg)
+        finally:
+            setattr(cfg, field, None)
+
+    # A dense AON without select settings refuses select flows.
+    time = get_assign_param(net._data, cfg.time_field, None, None)
+    a, b, turns = prepare_focus_nodes(net, None)
+    aon, _ = get_aon(net, matrix, cfg, a, b, turns)
+    nt.assert_raises(ValueError, aon, time, np.zeros(net._data.shape),
+                     turns, select=(np.zeros((1, 1)), np.zeros((1, 1))))
+
+
+def test_stochastic_user_equilibrium():
+    """STOCH loading keeps the demand and tends to AON as theta grows."""
+    cfg.method = 'SUE'
+    cfg.preload_field = None
+    cfg.max_iteration = 1
+    cfg.sue_theta = 100
+    try:
+        arcs_flow1, turns_flow1 = all_or_nothing(net, matrix, link_table,
+                                                 cfg)
+        arcs_flow2, turns_flow2, _ = user_equilibrium(net, matrix,
+                                                      link_table, cfg)
+    finally:
+        cfg.method = 'UE'
+        cfg.preload_field = 'flow'
+        cfg.max_iteration = 20
+        cfg.sue_theta = 1.0
+    np.testing.assert_allclose(arcs_flow1['AB_FLOW'], arcs_flow2['AB_FLOW'],
+                               atol=1e-6)
+    np.testing.assert_allclose(arcs_flow1['BA_FLOW'], arcs_flow2['BA_FLOW'],
+                               atol=1e-6)
+    np.testing.assert_allclose(turns_flow1['FLOW'], turns_flow2['FLOW'],
+                               atol=1e-6)
+
+    # Flow is kept at every node with a small theta.
+    data = net._data
+    flag, turn_idx, from_link, to_link, delay = get_sp_param(net, 'all')
+    trans = get_transitions(net, flag, turn_idx, from_link, to_link, delay)
+    kernel = StochKernel(trans['node_start'], trans['end_node'],
+                         trans['t_off'], trans['t_head'], trans['t_delay'])
+    time = np.ascontiguousarray(data['times'], np.float64)
+    source = np.intp(matrix.row_idx[0])
+    targets = np.asarray(matrix.col_idx, np.intp)
+    demand = np.asarray(matrix.data[0], np.float64)
+    arcs_flow = np.zeros(data.shape, np.float64)
+    kernel.load_origin(source, time, 0.5, targets, demand, arcs_flow)
+    node_num = trans['node_start'].shape[0]
+    balance = (np.bincount(trans['end_node'], arcs_flow, node_num) -
+               np.bincount(np.asarray(data['START_NODE'], np.intp),
+                           arcs_flow, node_num))
+    expect = np.zeros(node_num)
+    np.add.at(expect, targets, demand)
+    expect[source] = -demand[targets != source].sum()
+    np.testing.assert_allclose(balance, expect, atol=1e-8)
+
+    # Two routes from 1 to 2, direct (10) or by node 3 (4 + 8), are used in
+    # the shares of the logit model when the times do not change.
+    links = np.array([(1, 1, 2, 1, 10., 10., 1e9), (2, 1, 3, 1, 4., 4., 1e9),
+                      (3, 3, 2, 1, 8., 8., 1e9)],
+                     dtype={'names': ['ID', 'START_NODE', 'END_NODE', 'DIR',
+                                      'AB_times', 'BA_times', 'capacity'],
+                            'formats': ['u2', 'u2', 'u2', 'i1', 'f8', 'f8',
+                                        'f8']})
+    two_table = tp.IDTable(links)
+    two = tp.Net(two_table, ['AB_times', 'BA_times', 'capacity'])
+    od = Matrix(np.array([[100.]]))
+    od.row_idx = [1]
+    od.col_idx = [2]
+    theta = 0.1
+    sue_cfg = AssignConfig()
+    sue_cfg.method = 'SUE'
+    sue_cfg.time_field = 'times'
+    sue_cfg.capacity_field = 'capacity'
+    sue_cfg.print_frequency = 0
+    sue_cfg.sue_theta = theta
+    flow_data, _, _ = user_equilibrium(two, od, two_table, sue_cfg)
+    share = np.exp(-theta * 10) / (np.exp(-theta * 10) +
+                                   np.exp(-theta * 12))
+    np.testing.assert_allclose(flow_data['AB_FLOW'],
+                               [100 * share, 100 * (1 - share),
+                                100 * (1 - share)])
+
+
+def test_line_search():
+    """Newton line search should find the root of the numpy derivative."""
+    rng = np.random.RandomState(0)
+    n = 1000
+    time0 = rng.uniform(1, 10, n)
+    capacity = rng.uniform(500, 2000, n)
+    alpha = np.full(n, 0.15)
+    beta = np.full(n, 4.0)
+    preload = rng.uniform(0, 100, n)
+    arcs_flow = rng.uniform(0, 2500, n)
+    diff = np.where(arcs_flow > capacity, 0, 2 * capacity) - arcs_flow
+    step, _ = bpr_line_search(arcs_flow, diff, time0, alpha, beta, capacity,
+                              preload, 1e-10)
+    f = lambda x: derivative(x, arcs_flow, diff, time0, alpha, beta,
+                             capacity, preload)
+    nt.assert_true(0 < step < 1)
+    nt.assert_true(abs(f(step)) <= 1e-8 * abs(f(0)))
+    g, _ = bpr_line_derivative(step, arcs_flow, diff, time0, alpha, beta,
+                               capacity, preload)
+    nt.assert_almost_equal(g / f(0), f(step) / f(0))
@@ -4,6 +4,7 @@
 """
 from transpy.test.load_data import load_test_data
 from transpy.compute.shortest_way import single_source_shortest_way
+from transpy.compute.core import ShortestPathWorkspace
 import numpy as np
 import nose.tools as nt
 
@@ -61,3 +62,16 @@ class Test_single_source_shortest_way():
                                                      return_type='node')
         nt.assert_equal(dist, {})
         nt.assert_equal(node_path, {})
+
+    def test_workspace(self):
+        """Test a reused workspace gives the same result as a new one."""
+        ws = ShortestPathWorkspace(net)
+        single_source_shortest_way(net, 'LENGTH', 26, workspace=ws)
+        single_source_shortest_way(net, 'LENGTH', 1, max_node=5,
+                                   return_type='pred', workspace=ws)
+        for source in (26, 16):
+            dist, path = single_source_shortest_way(net, 'LENGTH', source,
+                                                    workspace=ws)
+            dist0, path0 = single_source_shortest_way(net, 'LENGTH', source)
+            nt.assert_equal(dist, dist0)
+            nt.assert_equal(path, path0)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Zhanhong Cheng
+"""
+from transpy.test.load_data import load_test_data
+from transpy.compute.assignment import user_equilibrium, AssignConfig
+from transpy.compute.vdf import VDF_REGISTRY, VDFGroups, Tabulated
+import numpy as np
+import nose.tools as nt
+
+_, link_table, _, net, matrix = load_test_data()
+
+PARAMS = {'bpr': {'alpha': np.full(5, 0.15), 'beta': np.full(5, 4.0)},
+          'conical': {'conical_alpha': np.full(5, 4.0)},
+          'akcelik': {'akcelik_period': np.full(5, 60.0),
+                      'akcelik_j': np.full(5, 0.5)},
+          'tabulated': {}}
+
+
+def get_vdf(name):
+    if name == 'tabulated':
+        return Tabulated([0, 0.5, 1, 1.5], [1, 1.1, 1.6, 3])
+    return VDF_REGISTRY[name]()
+
+
+def test_vdf_consistency():
+    """Derivative and integral should agree with the cost numerically."""
+    x = np.array([0, 300, 700, 1000, 1600], np.float64)
+    time0 = np.array([1, 2, 3, 4, 5], np.float64)
+    capacity = np.full(5, 1000, np.float64)
+    eps = 1e-3
+    for name in ('bpr', 'conical', 'akcelik', 'tabulated'):
+        vdf, p = get_vdf(name), PARAMS[name]
+        cost = np.empty(5)
+        vdf.cost(x, time0, capacity, p, cost)
+        np.testing.assert_allclose(cost[0], time0[0], err_msg=name)
+
+        der = np.empty(5)
+        vdf.derivative(x[1:] + eps, time0[1:], capacity[1:],
+                       {k: v[1:] for k, v in p.items()}, der[1:])
+        upper, lower = np.empty(4), np.empty(4)
+        sub = {k: v[1:] for k, v in p.items()}
+        vdf.cost(x[1:] + 2 * eps, time0[1:], capacity[1:], sub, upper)
+        vdf.cost(x[1:], time0[1:], capacity[1:], sub, lower)
+        np.testing.assert_allclose(der[1:], (upper - lower) / (2 * eps),
+                                   rtol=1e-4, err_msg=name)
+
+        integral = np.empty(5)
+        vdf.integral(x, time0, capacity, p, integral)
+        for i in range(5):
+            s = np.linspace(0, x[i], 2001)
+            values = np.empty(s.shape)
+            vdf.cost(s, np.full(s.shape, time0[i]),
+                     np.full(s.shape, capacity[i]),
+                     {k: np.full(s.shape, v[i]) for k, v in p.items()},
+                     values)
+            np.testing.assert_allclose(integral[i],
+                                       np.trapz(values, s), rtol=1e-4,
+                                       atol=1e-9, err_msg=name)
+
+
+def test_vdf_groups():
+    """UE with a VDF per arc type should reach equilibrium."""
+    cfg = AssignConfig()
+    cfg.method = 'BFW'
+    cfg.time_field = 'times'
+    cfg.capacity_field = 'capacity'
+    cfg.preload_field = 'flow'
+    cfg.print_frequency = 0
+    cfg.max_iteration = 200
+    cfg.convergence = 1e-4
+    cfg.turn_delay_type = 'no'
+    cfg.arc_type_field = 'DIR'
+    cfg.arc_type_dict = [(-1, {'vdf': 'akcelik'}),
+                         (0, {'vdf': 'conical'}),
+                         (1, {'vdf': 'tabulated',
+                              'vdf_options': {'ratio': [0, 1, 2],
+                                              'factor': [1, 2, 5]}})]
+    data = net._data
+    groups = VDFGroups(data, cfg, data['times'], data['capacity'])
+    nt.assert_equal(len(groups.groups), 3)
+    nt.assert_false(groups.single_bpr)
+    _, _, summary = user_equilibrium(net, matrix, link_table, cfg)
+    nt.assert_true(summary.relative_gap[-1] <= cfg.convergence)
+
+
+def test_global_options():
+    """The global VDF is created with cfg.vdf_options."""
+    cfg = AssignConfig()
+    cfg.time_field = 'times'
+    cfg.capacity_field = 'capacity'
+    cfg.print_frequency = 0
+    cfg.vdf = 'tabulated'
+    data = net._data
+    nt.assert_raises(ValueError, VDFGroups, data, cfg, data['times'],
+                     data['capacity'])
+    cfg.vdf_options = {'ratio': [0, 1, 2], 'factor': [1, 2, 5]}
+    groups = VDFGroups(data, cfg, data['times'], data['capacity'])
+    nt.assert_equal(len(groups.groups), 1)
+    nt.assert_true(isinstance(groups.groups[0].vdf, Tabulated))
+    _, _, summary = user_equilibrium(net, matrix, link_table, cfg)
+    nt.assert_true(np.isfinite(summary.relative_gap[-1]))
@@ -47,11 +47,7 @@ def load_raw_test_data():
                                 names=['ID', 'FROM', 'TO', 'DELAY'],
                                 formats=['u2', 'u2', 'u2', 'f8'],
                                 filing_values={'f': np.inf})
-    matrix_table = load_bin(path + 'matrix.bin')
-    matrix = tp.Matrix(matrix_table['pre'].copy().reshape((50, 50)))
-    matrix.row_idx = matrix_table['O'][0::50]
-    matrix.col_idx = matrix_table['D'][0:50]
-    matrix._data = np.asarray(matrix._data, dtype=np.float64)
+    matrix = load_bin_matrix(path + 'matrix.bin', 'pre')
 
     return point_data, line_data, link_data, turn_table, matrix
 
@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+"""
+Volume-delay functions (VDF) used in traffic assignment.
+
+A VDF gives the time of an arc from its volume `x` (flow plus preload),
+free-flow time `time0` and capacity, together with its derivative and its
+integral from 0 to `x`. All evaluations are vectorized and write into given
+arrays. New functions are added by `register_vdf`.
+
+@author: Zhanhong Cheng
+"""
+import numpy as np
+from transpy.compute.core import bpr_update, bpr_line_search
+
+VDF_REGISTRY = {}
+
+
+def register_vdf(name):
+    """Class decorator to register a VDF under `name`."""
+    def decorator(cls):
+        VDF_REGISTRY[name] = cls
+        cls.name = name
+        return cls
+    return decorator
+
+
+class VDF:
+    """Base class of volume-delay functions.
+
+    Subclasses define `params`, a tuple of parameter names, and implement
+    `cost`, `derivative` and `integral`. The parameters are read per arc by
+    `get_assign_param`, from the field of the same name or the arc type
+    dictionary, else `defaults` is used.
+    """
+    name = None
+    params = ()
+    defaults = {}
+
+    def param_fields(self, cfg):
+        """(name, field, global value) of each parameter."""
+        return [(p, p, self.defaults.get(p)) for p in self.params]
+
+    def update(self, x, time0, capacity, p, time, der=None):
+        """Fill `time`, and `der` if given, at volume `x`."""
+        self.cost(x, time0, capacity, p, time)
+        if der is not None:
+            self.derivative(x, time0, capacity, p, der)
+
+    def cost(self, x, time0, capacity, p, out):
+        raise NotImplementedError
+
+    def derivative(self, x, time0, capacity, p, out):
+        raise NotImplementedError
+
+    def integral(self, x, time0, capacity, p, out):
+        raise NotImplementedError
+
+
+@register_vdf('bpr')
+class BPR(VDF):
+    """BPR 函数.
+
+    t = time0 * (1 + alpha * (x / capacity) ** beta)
+    """
+    params = ('alpha', 'beta')
+
+    def param_fields(self, cfg):
+        return [('alpha', cfg.alpha_field, cfg.global_alpha),
+                ('beta', cfg.beta_field, cfg.global_beta)]
+
+    def update(self, x, time0, capacity, p, time, der=None):
+        bpr_update(time0, p['alpha'], p['beta'], capacity, None, x, time,
+                   der)
+
+    def cost(self, x, time0, capacity, p, out):
+        bpr_update(time0, p['alpha'], p['beta'], capacity, None, x, out)
+
+    def derivative(self, x, time0, capacity, p, out):
+        np.divide(x, capacity, out)
+        out **= p['beta'] - 1
+        out *= p['alpha']
+        out *= p['beta']
+        out *= time0
+        out /= capacity
+
+    def integral(self, x, time0, capacity, p, out):
+        beta1 = p['beta'] + 1
+        np.divide(x, capacity, out)
+        out **= beta1
+        out *= capacity
+        out *= p['alpha']
+        out /= beta1
+        out += x
+        out *= time0
+
+
+@register_vdf('conical')
+class Conical(VDF):
+    """锥形函数 (Spiess, 1990).
+
+    t = time0 * (2 + sqrt(a ** 2 * (1 - r) ** 2 + b ** 2) - a * (1 - r) - b)
+
+    其中 ``r = x / capacity``, `a` 为参数 `conical_alpha` (大于 1),
+    ``b = (2 * a - 1) / (2 * a - 2)``.
+    """
+    params = ('conical_alpha',)
+    defaults = {'conical_alpha': 4.0}
+
+    @staticmethod
+    def _terms(x, capacity, p):
+        a = p['conical_alpha']
+        b = (2 * a - 1) / (2 * a - 2)
+        u = a * (1 - x / capacity)
+        return a, b, u, np.sqrt(u * u + b * b)
+
+    def cost(self, x, time0, capacity, p, out):
+        a, b, u, root = self._terms(x, capacity, p)
+        np.subtract(root, u, out)
+        out += 2
+        out -= b
+        out *= time0
+
+    def derivative(self, x, time0, capacity, p, out):
+        a, b, u, root = self._terms(x, capacity, p)
+        np.divide(u, root, out)
+        out *= -a
+        out += a
+        out *= time0
+        out /= capacity
+
+    def integral(self, x, time0, capacity, p, out):
+        a, b, u, root = self._terms(x, capacity, p)
+
+        def g(v, s):
+            # Antiderivative of sqrt(v ** 2 + b ** 2) over v.
+            return v * s / 2 + b * b / 2 * np.arcsinh(v / b)
+
+        r = x / capacity
+        np.subtract(g(a, np.sqrt(a * a + b * b)), g(u, root), out)
+        out /= a
+        out += (2 - b) * r - a * (r - r * r / 2)
+        out *= time0
+        out *= capacity
+
+
+@register_vdf('akcelik')
+class Akcelik(VDF):
+    """Akcelik 函数 (Akcelik, 1991).
+
+    t = time0 + 0.25 * T * ((r - 1) + sqrt((r - 1) ** 2 + 8 * J * r /
+    (capacity * T)))
+
+    其中 ``r = x / capacity``, `T` 为参数 `akcelik_period`, 分析时段的长度,
+    与 `time0` 单位相同, 容量为该时段的容量; `J` 为参数 `akcelik_j`.
+    """
+    params = ('akcelik_period', 'akcelik_j')
+    defaults = {'akcelik_period': 60.0, 'akcelik_j': 0.5}
+
+    @staticmethod
+    def _terms(x, capacity, p):
+        period = p['akcelik_period']
+        r = x / capacity
+        k = 8 * p['akcelik_j'] / (capacity * period)
+        root = np.sqrt((r - 1) ** 2 + k * r)
+        return 0.25 * period, r, k, root
+
+    def cost(self, x, time0, capacity, p, out):
+        scale, r, k, root = self._terms(x, capacity, p)
+        np.add(r - 1, root, out)
+        out *= scale
+        out += time0
+
+    def derivative(self, x, time0, capacity, p, out):
+        scale, r, k, root = self._terms(x, capacity, p)
+        np.divide(r - 1 + k / 2, root, out)
+        out += 1
+        out *= scale
+        out /= capacity
+
+    def integral(self, x, time0, capacity, p, out):
+        scale, r, k, root = self._terms(x, capacity, p)
+        # (s - 1) ** 2 + k * s = (s + k / 2 - 1) ** 2 + m
+        m = k - k * k / 4
+
+        def g(v, s):
+            # Antiderivative of sqrt(v ** 2 + m) over v.
+            with np.errstate(divide='ignore', invalid='ignore'):
+                log = np.where(m != 0, np.log(np.abs(v + s)), 0)
+            return v * s / 2 + m / 2 * log
+
+        v0 = k / 2 - 1
+        np.subtract(g(r + v0, root), g(v0, 1.0), out)
+        out += r * r / 2 - r
+        out *= scale * capacity
+        out += time0 * x
+
+
+@register_vdf('tabulated')
+class Tabulated(VDF):
+    """按表格分段线性插值的函数.
+
+    t = time0 * f(x / capacity), `f` 由 `ratio` 与 `factor` 两列给出, 超出
+    表格的部分沿首尾两段线性外推.
+
+    Parameters
+    ----------
+    ratio : array_like
+        递增的饱和度, 第一个值为 0.
+    factor : array_like
+        每个饱和度对应的时间系数.
+    """
+    def __init__(self, ratio, factor):
+        self.ratio = np.asarray(ratio, np.float64)
+        self.factor = np.asarray(factor, np.float64)
+        if (self.ratio.ndim != 1 or self.ratio.shape != self.factor.shape or
+                self.ratio.shape[0] < 2 or self.ratio[0] != 0 or
+                np.any(np.diff(self.ratio) <= 0)):
+            raise ValueError('Wrong table of tabulated VDF.')
+        self.slope = np.diff(self.factor) / np.diff(self.ratio)
+        # Area under f from 0 to each ratio.
+        self.area = np.zeros(self.ratio.shape)
+        np.cumsum(np.diff(self.ratio) * (self.factor[1:] + self.factor[:-1])
+                  / 2, out=self.area[1:])
+
+    def _segment(self, r):
+        return np.clip(np.searchsorted(self.ratio, r, 'right') - 1, 0,
+                       self.slope.shape[0] - 1)
+
+    def cost(self, x, time0, capacity, p, out):
+        r = x / capacity
+        i = self._segment(r)
+        np.subtract(r, self.ratio[i], out)
+        out *= self.slope[i]
+        out += self.factor[i]
+        out *= time0
+
+    def derivative(self, x, time0, capacity, p, out):
+        i = self._segment(x / capacity)
+        np.divide(time0, capacity, out)
+        out *= self.slope[i]
+
+    def integral(self, x, time0, capacity, p, out):
+        r = x / capacity
+        i = self._segment(r)
+        dr = r - self.ratio[i]
+        np.multiply(dr, self.factor[i] + self.slope[i] * dr / 2, out)
+        out += self.area[i]
+        out *= time0
+        out *= capacity
+
+
+class VDFGroups:
+    """按路阻函数分组的弧, 每次分配只分组一次.
+
+    默认使用 `cfg.vdf`, 以 `cfg.vdf_options` 为创建函数时的参数 (如
+    'tabulated' 的 `ratio` 与 `factor`). 若 `cfg.arc_type_dict` 中某类弧的
+    字典有 'vdf', 则该类弧使用其指定的函数, 'vdf_options' 为其参数. 同一
+    函数且没有参数的弧并为一组.
+    每组的参数在分组时取出为连续数组, 迭代中每组只调用一次向量化的计算.
+
+    Parameters
+    ----------
+    data : structured array
+        Net 的数据.
+    cfg : AssignConfig
+    time0, capacity : ndarray
+        每条弧的自由流时间与容量.
+    preload : ndarray or None
+        每条弧的预加载流量.
+    """
+
+    def __init__(self, data, cfg, time0, capacity, preload=None):
+        from transpy.compute.assignment import get_assign_param, full_param
+        shape = data.shape
+        keys = [(_get_vdf_name(cfg.vdf), cfg.vdf_options)]
+        arc_key = np.zeros(shape, np.intp)
+        type_field = cfg.arc_type_field
+        if type_field is not None and cfg.arc_type_dict is not None:
+            for arc_type, arc_dict in cfg.arc_type_dict:
+                if 'vdf' not in arc_dict:
+                    continue
+                options = arc_dict.get('vdf_options')
+                key = (_get_vdf_name(arc_dict['vdf']), options)
+                if options is not None or key not in keys:
+                    keys.append(key)
+                    arc_key[data[type_field] == arc_type] = len(keys) - 1
+                else:
+                    arc_key[data[type_field] == arc_type] = keys.index(key)
+
+        self.shape = shape
+        self.groups = []
+        for k, (name, options) in enumerate(keys):
+            index = np.nonzero(arc_key == k)[0]
+            if index.shape[0] == 0:
+                continue
+            try:
+                vdf = VDF_REGISTRY[name](**(options or {}))
+            except TypeError as e:
+                raise ValueError('Wrong options of VDF "{}": {}'.format(
+                    name, e))
+            if index.shape[0] == shape[0]:
+                index = slice(None)
+            elif index[-1] - index[0] + 1 == index.shape[0]:
+                index = slice(index[0], index[-1] + 1)
+            params = {}
+            for param, field, default in vdf.param_fields(cfg):
+                value = full_param(get_assign_param(
+                    data, field, type_field, cfg.arc_type_dict, default),
+                    shape)
+                params[param] = np.ascontiguousarray(value[index])
+            self.groups.append(_ArcGroup(vdf, index, time0, capacity,
+                                         preload, params))
+
+    def set_preload(self, preload=None):
+        """更换每条弧的预加载流量, 分组与参数不变."""
+        for g in self.groups:
+            g.set_preload(preload)
+
+    @property
+    def single_bpr(self):
+        """Whether all arcs use the BPR function."""
+        return (len(self.groups) == 1 and
+                isinstance(self.groups[0].vdf, BPR))
+
+    def update(self, arcs_flow, time, der=None):
+        """由弧流量计算路阻 `time`, 若给出 `der` 同时计算其导数."""
+        for g in self.groups:
+            x = g.volume(arcs_flow)
+            if g.whole:
+                g.vdf.update(x, g.time0, g.capacity, g.params, time, der)
+            else:
+                g.vdf.update(x, g.time0, g.capacity, g.params, g.out,
+                             None if der is None else g.out2)
+                time[g.index] = g.out
+                if der is not None:
+                    der[g.index] = g.out2
+
+    def integral(self, arcs_flow, out):
+        """路阻函数从 0 到弧流量(含预加载)的积分."""
+        for g in self.groups:
+            x = g.volume(arcs_flow)
+            g.vdf.integral(x, g.time0, g.capacity, g.params, g.out)
+            out[g.index] = g.out
+
+    def line_derivative(self, step, arcs_flow, diff):
+        """目标函数沿 `diff` 方向在 `step` 处的一阶与二阶导数."""
+        first = second = 0
+        for g in self.groups:
+            x = g.volume(arcs_flow, step, diff)
+            g.vdf.update(x, g.time0, g.capacity, g.params, g.out, g.out2)
+            d = g.take(diff, g.diff)
+            first += d.dot(g.out)
+            g.out2 *= d
+            second += d.dot(g.out2)
+        return first, second
+
+    def line_search(self, arcs_flow, diff, tolerance=1e-4, max_iter=50,
+                    offset=0):
+        """求 [0, 1] 内的最优步长, 同 `core.bpr_line_search`.
+
+        `offset` 是目标函数中与流量成线性的部分(如多车种分配中的固定费用)
+        沿搜索方向的导数, 加在路阻部分的导数上.
+
+        Returns
+        -------
+        step : float
+        evaluations : int
+        """
+        if self.single_bpr and offset == 0:
+            g = self.groups[0]
+            return bpr_line_search(arcs_flow, diff, g.time0, g.params['alpha'],
+                                   g.params['beta'], g.capacity, g.preload,
+                                   tolerance, max_iter)
+
+        def fun(x):
+            g, h = self.line_derivative(x, arcs_flow, diff)
+            return g + offset, h
+        return newton_line_search(fun, tolerance, max_iter)
+
+
+class _ArcGroup:
+    """一组使用相同路阻函数的弧, 及其参数与工作数组."""
+    __slots__ = ('vdf', 'index', 'whole', 'time0', 'capacity', 'preload',
+                 'params', 'x', 'diff', 'out', 'out2')
+
+    def __init__(self, vdf, index, time0, capacity, preload, params):
+        self.vdf = vdf
+        self.index = index
+        self.whole = isinstance(index, slice) and index == slice(None)
+        self.time0 = np.ascontiguousarray(time0[index], np.float64)
+        self.capacity = np.ascontiguousarray(capacity[index], np.float64)
+        self.set_preload(preload)
+        self.params = params
+        self.x = np.empty(self.time0.shape)
+        self.diff = np.empty(self.time0.shape)
+        self.out = np.empty(self.time0.shape)
+        self.out2 = np.empty(self.time0.shape)
+
+    def set_preload(self, preload):
+        if preload is None:
+            self.preload = np.zeros(self.time0.shape)
+        else:
+            self.preload = np.ascontiguousarray(preload[self.index],
+                                                np.float64)
+
+    def take(self, arr, out):
+        if isinstance(self.index, slice):
+            np.copyto(out, arr[self.index])
+        else:
+            np.take(arr, self.index, out=out)
+        return out
+
+    def volume(self, arcs_flow, step=0, diff=None):
+        """Volume of the arcs, ``arcs_flow + step * diff + preload``."""
+        x = self.take(arcs_flow, self.x)
+        if diff is not None:
+            d = self.take(diff, self.diff)
+            d *= step
+            x += d
+        x += self.preload
+        return x
+
+
+def newton_line_search(fun, tolerance=1e-4, max_iter=50):
+    """Root of ``fun(x)[0]`` in [0, 1] by safeguarded Newton steps.
+
+    `fun` returns the first and second derivative of the objective along
+    the search direction, see `core.bpr_line_search` for the method.
+    """
+    lo, hi = 0.0, 1.0
+    g_lo, _ = fun(lo)
+    n = 1
+    if not g_lo < 0:
+        return lo, n
+    target = -tolerance * g_lo
+    g_hi, _ = fun(hi)
+    n += 1
+    if not g_hi > 0:
+        return hi, n
+    x = lo - g_lo * (hi - lo) / (g_hi - g_lo)
+    while n < max_iter + 2:
+        g, h = fun(x)
+        n += 1
+        if abs(g) <= target:
+            break
+        if g < 0:
+            lo, g_lo = x, g
+        else:
+            hi, g_hi = x, g
+        if hi - lo <= 1e-12:
+            break
+        x_new = x - g / h if h > 0 else lo
+        if not lo < x_new < hi:
+            x_new = lo - g_lo * (hi - lo) / (g_hi - g_lo)
+        x = x_new
+    return x, n
+
+
+def _get_vdf_name(name):
+    name = name.lower()
+    if name not in VDF_REGISTRY:
+        raise ValueError('Unknown VDF "{}", use one of {}.'.format(
+            name, sorted(VDF_REGISTRY)))
+    return name
@@ -5,6 +5,7 @@
 import numpy as np
 import os
 import re
+import transpy as tp
 
 D_ENCODE = 'utf-8'
 
@@ -29,14 +30,85 @@ def skip(f, num):
 #     effect_line = find_effect_line(data['ID'])
 #    return np.array(data[effect_line])
 
-def load_bin(file):
+def load_bin(file, mmap=False):
+    """读取二进制表格文件(*.bin), 格式由同名的 *.dcb 文件给出.
+
+    Parameters
+    ----------
+    file : str
+        要读取的文件路径.
+    mmap : bool, optional
+        为 True 时不读入内存, 而是返回映射到文件上的 `np.memmap`, 数据在
+        使用时才从磁盘读取. 映射为写时复制(copy-on-write)模式, 对数据的
+        修改不会写回文件. Default: False.
+
+    Return
+    ------
+    data : numpy structured array or np.memmap
+    """
     path = os.path.splitext(file)[0]
-    try:
-        dtype = get_bin_format(path + '.dcb')
-        data = np.fromfile(file, dtype=dtype)
-        return data
-    except BaseException as e:
-        raise
+    dtype = get_bin_format(path + '.dcb')
+    if mmap:
+        return np.memmap(file, dtype=dtype, mode='c')
+    return np.fromfile(file, dtype=dtype)
+
+
+def load_bin_matrix(file, field, o_field='O', d_field='D', cols=None,
+                    id_type=tp.ID_TYPE):
+    """把以 (起点, 终点, 值) 表格形式保存的二进制文件映射为 `Matrix`.
+
+    文件中的记录须按起点, 终点排列, 每个起点的终点相同. `Matrix` 的数据
+    直接是文件中 `field` 列的 `np.memmap` 视图, 不经过任何复制, 所以可以
+    打开比内存还大的矩阵. 分配时按行分块读入, 见 ``AssignConfig.block_rows``.
+
+    Parameters
+    ----------
+    file : str
+        要读取的 *.bin 文件路径, 格式由同名的 *.dcb 文件给出.
+    field : str
+        矩阵的值所在的列.
+    o_field, d_field : str, optional
+        起点与终点所在的列. Default: 'O', 'D'.
+    cols : int, optional
+        矩阵的列数, 默认为第一个起点的记录数.
+    id_type : data-type, optional
+        `row_idx` 与 `col_idx` 的类型. Default: `ID_TYPE`.
+
+    Return
+    ------
+    matrix : Matrix
+
+    Raises
+    ------
+    ValueError :
+        如果记录不能按 `cols` 列对齐: 记录数不是 `cols` 的整数倍, 某行首尾
+        的起点不同, 或有两行的起点相同.
+    """
+    table = load_bin(file, mmap=True)
+    origin = table[o_field]
+    if cols is None:
+        # Records before the second origin, read only as much as needed.
+        cols = origin.shape[0]
+        step = 4096
+        for start in range(0, origin.shape[0], step):
+            change = np.flatnonzero(origin[start:start + step] != origin[0])
+            if change.shape[0]:
+                cols = start + change[0]
+                break
+    if cols == 0 or origin.shape[0] % cols:
+        raise ValueError("{} records can't be reshaped to {} columns.".
+                         format(origin.shape[0], cols))
+    rows = origin.shape[0] // cols
+    # A cheap strided check: each row starts and ends with its own origin.
+    first = np.asarray(origin[::cols])
+    if np.any(np.asarray(origin[cols - 1::cols]) != first) or \
+            np.unique(first).shape[0] != rows:
+        raise ValueError("Records aren't aligned to {} columns.".
+                         format(cols))
+    matrix = tp.Matrix(table[field].reshape((rows, cols)), id_type)
+    matrix.row_idx = origin[::cols]
+    matrix.col_idx = table[d_field][:cols]
+    return matrix
 
 
 def get_bin_format(file):